@@ -25,18 +25,25 @@
     1. Load the file in list and filtered the comments line based on the user's setting.
     2. Users can customized the comments line identify char for the lines they want to igore.
     3. Append the new data line into the config file with time stamps.
+    4. Parse the lines once into typed records (parseFun), memoize the getJson(),
+       getRecords() and getLines() results and reload only when the file's mtime
+       or size changed, the unchanged lines' records are reused.
+    5. Stream the records of a very large file with iterRecords() without loading
+       the whole file in memory.
 """
 import os
 import datetime
 
 FILTER_CHAR = ('#', '', '\n', '\r', '\t') # comment lines 1st identify charactors.
 ENCODE = 'utf-8'    # file encode format.
+FILTER_MEMO_MAX = 8 # max number of getLines() filter functions memoized (oldest dropped first).
 
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
 class ConfigLoader(object):
 
-    def __init__(self, filePath, mode='r', filterChars=None, logFlg=True):
+    def __init__(self, filePath, mode='r', filterChars=None, logFlg=True, parseFun=None,
+                 autoReload=False, loadFlg=True):
         """ Init the config loader.
             example: cfg = ConfigLoader('cfg.txt', mode='r', filterChars=('#', '\n'), logFlg=False)
         Args:
@@ -44,37 +51,92 @@ class ConfigLoader(object):
             mode (str, optional): 'r'-read, 'w'-write ,'rw'-read&write, 'a'-append. Defaults to 'r'.
             filterChars ([str], optional): Comment lines 1st identify charators list.
             logFlg (bool, optional): Flag to show the running log. Defaults to True.
+            parseFun ([function], optional): function to convert the value string to
+                the typed record used by getRecords()/iterRecords(), example: json.loads.
+            autoReload (bool, optional): Flag to check the file change (mtime/size) 
+                before each get__ call. Defaults to False (call reload() manually).
+            loadFlg (bool, optional): Flag to load the file during init, set False if
+                only iterRecords() is used. Defaults to True.
         """
         self.filePath = filePath
         self.mode = mode
         self.logFlg = logFlg
+        self.parseFun = parseFun
+        self.autoReload = autoReload
         self.filterCharList = filterChars if not filterChars is None and len(filterChars) > 0 else FILTER_CHAR
+        self.configLines = []
+        self.fileSig = None     # (mtime_ns, size) of the loaded file.
+        self.recordCache = {}   # (line, specChar) -> parsed record (key, value) of the loaded lines.
+        self.memo = {}          # get__ call args -> memoized result of the loaded lines.
         if self.mode == 'r' and not os.path.exists(filePath):
             if self.logFlg: print('> Error: can not find the config file %s' % str(filePath))
             return
-        self.configLines = []
-        if 'r' in self.mode:
-            try:
-                with open(filePath) as fp:
-                    for line in fp.readlines():
-                        if line[0] in self.filterCharList: continue
-                        line = line.strip()
-                        self.configLines.append(line)
-                if self.logFlg: print('> Init(): load %s lines of config' %str(len(self.configLines)))
-            except:
-                if self.logFlg: print('> Error: can not find the config file %s' % str(filePath))
-                return
-    
+        if 'r' in self.mode and loadFlg:
+            if self.reload() is not None and self.logFlg: 
+                print('> Init(): load %s lines of config' %str(len(self.configLines)))
+
+    #-----------------------------------------------------------------------------
+    def _iterFileLines(self):
+        """ Yield the stripped not comments lines of the file one by one."""
+        with open(self.filePath, encoding=ENCODE) as fp:
+            for line in fp:
+                if line[0] in self.filterCharList: continue
+                yield line.strip()
+
+    #-----------------------------------------------------------------------------
+    def _parseLine(self, line, specChar=':'):
+        """ Split the line to a (key, value) record, the value is converted by 
+            <parseFun> if it is set. Returns None if the line has no <specChar>.
+        """
+        if specChar not in line: return None
+        key, val = line.split(specChar, 1)
+        return (key, self.parseFun(val) if self.parseFun else val)
+
+    #-----------------------------------------------------------------------------
+    def reload(self):
+        """ Reload the file if its mtime or size changed since the last load, only 
+            the changed lines are parsed again.
+        Returns:
+            [bool]: True if the file is reloaded, False if not changed, None if error.
+        """
+        try:
+            stat = os.stat(self.filePath)
+            fileSig = (stat.st_mtime_ns, stat.st_size)
+            if fileSig == self.fileSig: return False
+            self.configLines = list(self._iterFileLines())
+        except:
+            if self.logFlg: print('> Error: can not find the config file %s' % str(self.filePath))
+            return None
+        self.fileSig = fileSig
+        self.memo = {}
+        # drop the parsed records of the removed/changed lines.
+        if self.recordCache:
+            lineSet = set(self.configLines)
+            self.recordCache = {key: rcd for key, rcd in self.recordCache.items() if key[0] in lineSet}
+        return True
+
+    #-----------------------------------------------------------------------------
+    def _checkReload(self):
+        if self.autoReload or self.fileSig is None: self.reload()
+
     #-----------------------------------------------------------------------------
     def getLines(self, filterFun=None):
         """ Get all the filered lines of the config file.
         Args:
             filterFun ([function], optional): function for filter. Defaults to None.
         Returns:
-            list[str]: configfile lines data after filtered.
+            list[str]: configfile lines data after filtered (a new list, changing it 
+                does not affect the memoized result).
         """
+        self._checkReload()
         if not filterFun: return self.configLines
-        return list(filter(filterFun, self.configLines))
+        key = ('lines', filterFun)
+        if key not in self.memo:
+            # a new filter function object per call must not grow the memo without bound.
+            filterKeys = [memoKey for memoKey in self.memo if memoKey[0] == 'lines']
+            for memoKey in filterKeys[:max(0, len(filterKeys) - FILTER_MEMO_MAX + 1)]: del self.memo[memoKey]
+            self.memo[key] = list(filter(filterFun, self.configLines))
+        return list(self.memo[key])
     
     #-----------------------------------------------------------------------------
     def getJson(self, specChar=':'):
@@ -83,14 +145,51 @@ class ConfigLoader(object):
             specChar (str, optional): The key/value pair split char: key<specChar>value. 
                 Defaults to ':'.
         Returns:
-            dict: data json dict.
+            dict: data json dict (a copy of the memoized result).
+        """
+        self._checkReload()
+        memoKey = ('json', specChar)
+        if memoKey not in self.memo:
+            result = {}
+            for line in self.configLines:
+                if specChar in line:
+                    key, val = line.split(specChar, 1)
+                    result[key] = val
+            self.memo[memoKey] = result
+        return dict(self.memo[memoKey])
+
+    #-----------------------------------------------------------------------------
+    def getRecords(self, specChar=':'):
+        """ Get the config data as {key: typed record} dict, the value string is 
+            converted by <parseFun> once per line and reused until the line changed.
+        Args:
+            specChar (str, optional): The key/value pair split char. Defaults to ':'.
+        Returns:
+            dict: key -> record dict (a copy of the memoized dict, the records are
+                shared with the other callers and should be treated as read only).
+        """
+        self._checkReload()
+        memoKey = ('records', specChar)
+        if memoKey not in self.memo:
+            result = {}
+            for line in self.configLines:
+                cacheKey = (line, specChar)
+                if cacheKey in self.recordCache:
+                    rcd = self.recordCache[cacheKey]
+                else:
+                    rcd = self.recordCache[cacheKey] = self._parseLine(line, specChar=specChar)
+                if rcd is not None: result[rcd[0]] = rcd[1]
+            self.memo[memoKey] = result
+        return dict(self.memo[memoKey])
+
+    #-----------------------------------------------------------------------------
+    def iterRecords(self, specChar=':'):
+        """ Stream the (key, typed record) tuples from the file line by line, the 
+            file is not loaded in memory (used for very large files).
         """
-        result = {}
-        for line in self.configLines:
-            if specChar in line:
-                key, val = line.split(':', 1)
-                result[key] = val
-        return result
+        for line in self._iterFileLines():
+            rcd = self._parseLine(line, specChar=specChar)
+            if rcd is not None: yield rcd
 
     #-----------------------------------------------------------------------------
     def setMode(self, mode):
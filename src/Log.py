@@ -12,19 +12,144 @@
 # License:     
 #-----------------------------------------------------------------------------
 import os
+import re
+import gzip
 import time
+import queue
+import atexit
+import shutil
+import threading
 import logging
 import logging.handlers
 import traceback
 
 DEFAULT_LOGGER_NAME = 'Log'
 ROLLOVER_LENGTH = 1.0e7 + 1 # Python 'handlers' compares >= length(roll at 10MB)
+QUEUE_SIZE = 10000          # max number of log records buffered under async mode.
+SIZE_BUDGET = 1.0e9         # max total size (bytes) of one logger's log files.
+# log argument types which can not change after the call, the records with only these
+# arguments are formatted by the async listener thread instead of the caller thread.
+IMMUTABLE_ARGS = (str, int, float, bool, bytes, type(None))
+# RotateFileHandler file name after the file prefix: _<yyyymmdd>_<hhmmss>_<idx>.txt[.gz]
+ROTATED_NAME = r'_\d{8}_\d{6}_\d+\.txt(\.gz)?'
 # Init global parametersL
 gLogger = None              # logger generator object
 gHandler = None             # logging handler
 gLogDir = None              # log directory path
 gCrtDir = ''                # current log 
 gPutLogsUnderDate = False   # flag to identify whether put log file under data folder.
+gQueueHandler = None        # queue handler used by the logger under async mode.
+gListener = None            # queue listener thread writing the records to gHandler under async mode.
+gModuleLevels = {}          # module name -> min log level, see setModuleLevel().
+gRotationMgr = None         # log rotation manager thread.
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """ Queue handler putting the log records in a bounded queue, the file is
+        written by the QueueListener thread. When the queue is full the record 
+        is dropped (blockFlg=False) or the caller waits (blockFlg=True). The 
+        records are formatted by the listener thread unless an argument may be
+        changed by the caller before it is written (dict, list, object ...).
+    """
+    def __init__(self, recordQueue, blockFlg=False):
+        logging.handlers.QueueHandler.__init__(self, recordQueue)
+        self.blockFlg = blockFlg
+        self.dropCount = 0      # number of the records dropped as the queue is full.
+
+#--BoundedQueueHandler---------------------------------------------------------
+    def prepare(self, record):
+        args = record.args or ()
+        # a single dict argument is kept as the record's args dict (also mutable).
+        if record.exc_info or not isinstance(record.msg, str) or not isinstance(args, tuple) or \
+                not all(isinstance(arg, IMMUTABLE_ARGS) for arg in args):
+            return logging.handlers.QueueHandler.prepare(self, record)
+        return record   # formatted by the listener thread's file handler.
+
+#--BoundedQueueHandler---------------------------------------------------------
+    def enqueue(self, record):
+        if self.blockFlg:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropCount += 1
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class LogRotationMgr(threading.Thread):
+    """ Background thread to gzip the rotated log files and remove the oldest log
+        files to keep no more than <cnt> files and <sizeBudget> bytes. The writer
+        thread only puts the rotated file path in the task queue.
+    """
+    def __init__(self, dirName, fileNameBase, cnt, sizeBudget=SIZE_BUDGET, compressFlg=True, subDirFlg=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dirName = dirName
+        self.fileNameBase = fileNameBase
+        # exact name match, other loggers' prefixes may start with this prefix.
+        self.namePattern = re.compile(re.escape(fileNameBase) + ROTATED_NAME + '$')
+        self.cnt = cnt
+        self.sizeBudget = sizeBudget
+        self.compressFlg = compressFlg
+        self.subDirFlg = subDirFlg  # log files are under the date sub folders of <dirName>.
+        self.activePath = None      # log file being written, never removed.
+        self.tasks = queue.Queue()  # rotated file path, None: clean only, False: stop.
+
+#--LogRotationMgr--------------------------------------------------------------
+    def addRotated(self, filePath, activePath=None):
+        """ Called by the log writer after the file <filePath> is rotated."""
+        if activePath: self.activePath = activePath
+        self.tasks.put(filePath)
+
+#--LogRotationMgr--------------------------------------------------------------
+    def compress(self, filePath):
+        """ Gzip the rotated log file to <filePath>.gz and remove the original file."""
+        if not self.compressFlg or not os.path.isfile(filePath): return
+        try:
+            with open(filePath, 'rb') as src, gzip.open(filePath + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(filePath)
+        except OSError as e:
+            print('Log: could not compress <%s>: %s' % (filePath, e))
+
+#--LogRotationMgr--------------------------------------------------------------
+    def clean(self):
+        """ Remove the oldest log files over the file count or the size budget."""
+        dirNames = [self.dirName]
+        if self.subDirFlg:
+            with os.scandir(self.dirName) as entries:
+                dirNames += [entry.path for entry in entries if entry.is_dir()]
+        exclude = {self.activePath} if self.activePath else set()
+        cleanOldFiles(dirNames, self.fileNameBase, self.cnt, sizeBudget=self.sizeBudget, exclude=exclude,
+                      namePattern=self.namePattern)
+        if self.subDirFlg:
+            # remove the empty date folders.
+            for dirName in dirNames[1:]:
+                if os.path.abspath(dirName) == os.path.dirname(os.path.abspath(self.activePath or '')): continue
+                try:
+                    os.rmdir(dirName)
+                except OSError:
+                    pass # not empty.
+
+#--LogRotationMgr--------------------------------------------------------------
+    def run(self):
+        while True:
+            filePath = self.tasks.get()
+            try:
+                if filePath: self.compress(filePath)
+                # clean once after a burst of rotations, and before stop.
+                if self.tasks.empty() or filePath is False: self.clean()
+            except Exception as e:
+                print('Log: rotation manager exception: %s' % e)
+            if filePath is False: break
+
+#--LogRotationMgr--------------------------------------------------------------
+    def stop(self, timeout=None):
+        """ Finish the pending tasks then stop the thread."""
+        self.tasks.put(False)
+        if self.is_alive(): self.join(timeout)
 
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
@@ -64,9 +189,12 @@ class RotateFileHandler(logging.handlers.RotatingFileHandler):
             # in case someone still tries to write & opens file
             #self.baseFilename = 'TempBogusLog.txt'
         fResetTime = fResetTime or self.autoTReset
+        rotatedFile = self.baseFilename
         self.baseFilename = self.buildFilename(fResetTime)
         self.mode = 'w'
         self.stream = self._open()
+        # compress and clean up in the rotation manager thread.
+        if gRotationMgr: gRotationMgr.addRotated(rotatedFile, activePath=self.baseFilename)
 
 #--RotateFileHandler-----------------------------------------------------------
     def handleError(self, record):
@@ -101,24 +229,40 @@ def printArgs(*args):
     print(s)
 
 #-----------------------------------------------------------------------------
-def info(*args, printFlag=None):
-    """ Log normal information message: Log.info("message %s", str(value))"""
+def setModuleLevel(module, level):
+    """ Set the min log level of the messages logged with <module> name, example:
+        Log.setModuleLevel('DataMgr', 'INFO') then Log.debug(..., module='DataMgr') 
+        is skipped before its arguments are formatted. Set level None to remove.
+    """
+    if level is None:
+        gModuleLevels.pop(module, None)
+    else:
+        gModuleLevels[module] = logging.getLevelName(level) if isinstance(level, str) else level
+
+#-----------------------------------------------------------------------------
+def info(*args, printFlag=None, module=None):
+    """ Log normal information message: Log.info("message %s", value), the message 
+        is formatted only when it is handled, so pass the value object directly.
+    """
+    if module is not None and logging.INFO < gModuleLevels.get(module, logging.NOTSET): return
     if gLogger:
         gLogger.info(*args)
     elif printFlag is None or printFlag:
         printArgs(*args)
 
 #-----------------------------------------------------------------------------
-def warning(*args, printFlag=None):
+def warning(*args, printFlag=None, module=None):
     """ Log wanring message:  Log.wanring("message %s", str(value))"""
+    if module is not None and logging.WARNING < gModuleLevels.get(module, logging.NOTSET): return
     if gLogger:
         gLogger.warning(*args)
     elif printFlag is None or printFlag:
         printArgs(*args)
 
 #-----------------------------------------------------------------------------
-def debug(*args, onFlag=True, printFlag=None):
-    """ log debug message: Log.debug("message %s", str(value))"""
+def debug(*args, onFlag=True, printFlag=None, module=None):
+    """ log debug message: Log.debug("message %s", value)"""
+    if module is not None and logging.DEBUG < gModuleLevels.get(module, logging.NOTSET): return
     if gLogger and onFlag:
         gLogger.debug(*args)
     elif printFlag is None or printFlag:
@@ -167,8 +311,8 @@ def getLogFilePath(*args, logDir=None, folderFlg=False):
     myArgs = [logDir] if logDir else [gLogDir]
     _ = myArgs.extend(args) if folderFlg else myArgs.extend(args[:-1])
     gCrtDir = os.path.join(*myArgs)
-    if not os.path.exists(gCrtDir):
-        os.makedirs(gCrtDir)
+    # exist_ok: the processes of the multiple process host may create the folder together.
+    os.makedirs(gCrtDir, exist_ok=True)
     filePath = gCrtDir if folderFlg else os.path.join(gCrtDir, args[-1])
     return filePath
 
@@ -203,35 +347,75 @@ def setLogger(strm):
 
 
 #-----------------------------------------------------------------------------
-def cleanOldFiles(dirName, fileNameBase, cnt):
-    """ Examine files in 'dirName', and if we find any that start with
-        'fileNameBase', remove the oldest of those to keep no more
-        than 'cnt' files in that dir
+def cleanOldFiles(dirName, fileNameBase, cnt, sizeBudget=None, exclude=(), namePattern=None):
+    """ Examine files in 'dirName' (a dir path or a list of dir paths), and if we 
+        find any that start with 'fileNameBase', remove the oldest of those to keep
+        no more than 'cnt' files and no more than 'sizeBudget' bytes in total.
         This may be used for apps own logs, as well as the Log.xxx logs
+        - exclude: file paths never removed (the log file being written).
+        - namePattern: compiled regex the whole file name must match instead of
+            the 'fileNameBase' prefix.
     """
-
     log_list = []
-    for f in os.listdir(dirName):
-        # added every log file found into the log file list
-        if f[0:len(fileNameBase)] == fileNameBase: log_list.append(f)
-    if len(log_list) > cnt:     # if # of log files found more than the maximum number
-        # set current working directory
-        prevDir = os.getcwd()
-        os.chdir(dirName)
-        # sort the file list according to modification time
-        log_list.sort(key=lambda x: (os.stat(x).st_mtime, x))
-        # keep most recent log files and remove the old ones
-        for i in range(len(log_list) - cnt):
-            try:
-                #print('Log.cleanOldFiles deleted: ', log_list[i])
-                os.remove(log_list[i])
-            except Exception:
-                warning('Log: cleanOldFiles could not delete <%s>', log_list[i])
-        os.chdir(prevDir)
+    for dirPath in ([dirName] if isinstance(dirName, str) else dirName):
+        # scandir entries cache the stat result, no chdir needed.
+        with os.scandir(dirPath) as entries:
+            for entry in entries:
+                if namePattern is not None:
+                    if not namePattern.match(entry.name): continue
+                elif not entry.name.startswith(fileNameBase): continue
+                if not entry.is_file(): continue
+                st = entry.stat()
+                log_list.append((st.st_mtime, entry.name, entry.path, st.st_size))
+    totalSize = sum(data[3] for data in log_list)
+    if len(log_list) <= cnt and (sizeBudget is None or totalSize <= sizeBudget): return
+    # sort the file list according to modification time, keep most recent 
+    # log files and remove the old ones
+    log_list.sort()
+    fileNum = len(log_list)
+    for _, _, filePath, fileSize in log_list:
+        if fileNum <= cnt and (sizeBudget is None or totalSize <= sizeBudget): break
+        if filePath in exclude: continue
+        try:
+            os.remove(filePath)
+            fileNum -= 1
+            totalSize -= fileSize
+        except Exception:
+            warning('Log: cleanOldFiles could not delete <%s>', filePath)
+
+#-----------------------------------------------------------------------------
+def getDropCount():
+    """ Return the number of log records dropped under async mode."""
+    return gQueueHandler.dropCount if gQueueHandler else 0
+
+#-----------------------------------------------------------------------------
+def stopLogger():
+    """ Flush the async log queue, close the log file and remove the logger."""
+    global gLogger, gHandler, gQueueHandler, gListener, gRotationMgr
+    if gLogger is not None:
+        try:
+            if gListener is not None:
+                gListener.stop()    # write all the queued records then stop the thread.
+                gLogger.removeHandler(gQueueHandler)
+            else:
+                gLogger.removeHandler(gHandler)
+            if gQueueHandler is not None and gQueueHandler.dropCount:
+                gHandler.handle(logging.makeLogRecord({'name': gLogger.name, 'levelno': logging.WARNING,
+                    'levelname': 'WARNING', 'msg': 'Log: %d records dropped as the log queue is full.' % gQueueHandler.dropCount}))
+            gHandler.close()
+        except Exception:
+            exception('stopLogger:  Log could not delete gLogger')
+        gLogger = gHandler = gQueueHandler = gListener = None
+    if gRotationMgr is not None:
+        gRotationMgr.stop() # after the queued records are written (which may rotate the file).
+        gRotationMgr = None
+
+atexit.register(stopLogger)
 
 #-----------------------------------------------------------------------------
 def initLogger(pwd, logDirName, appName, filePrefix, historyCnt=100,
-        fPutLogsUnderDate=False, loggerName=DEFAULT_LOGGER_NAME, autoRestTime=False):
+        fPutLogsUnderDate=False, loggerName=DEFAULT_LOGGER_NAME, autoRestTime=False,
+        asyncFlg=False, queueSize=QUEUE_SIZE, blockFlg=False, sizeBudget=SIZE_BUDGET, compressFlg=True):
     """ Initialize logging
         - pwd: pathname of working directory under which we put logs
         - logDirName: put all logs into this dir, i.e. 'Logs'
@@ -241,19 +425,19 @@ def initLogger(pwd, logDirName, appName, filePrefix, historyCnt=100,
         - fPutLogsUnderDate: if True, we arrange to put log files into a daily
             folder, otherwise, they go directly into the Logs folder.
         - loggerName: name of this logger.
+        - asyncFlg: if True, the caller only puts the record in a bounded queue 
+            and a QueueListener thread writes the log file.
+        - queueSize: max number of the queued records under async mode.
+        - blockFlg: if True, the caller waits when the queue is full, otherwise 
+            the record is dropped (see getDropCount()).
+        - sizeBudget: max total size (bytes) of the log files, None for no limit.
+        - compressFlg: if True, gzip the rotated log files in background.
     """
-    global gLogger, gHandler, gLogDir, gPutLogsUnderDate 
+    global gLogger, gHandler, gLogDir, gPutLogsUnderDate, gQueueHandler, gListener, gRotationMgr
     assert pwd is not None       # caller must set this up
     try:
-        if gLogger is not None:
-            # handling reinitializing
-            try:
-                gLogger.removeHandler(gHandler)
-                del gLogger
-            except Exception:
-                exception('initLogger:  Log could not delete gLogger')
-            gLogger = None
-            gHandler = None
+        # handling reinitializing
+        stopLogger()
         gPutLogsUnderDate = fPutLogsUnderDate
 
         gLogDir = getLogFilePath(logDirName, appName, logDir=pwd, folderFlg=True) if appName else getLogFilePath(
@@ -264,14 +448,24 @@ def initLogger(pwd, logDirName, appName, filePrefix, historyCnt=100,
         gHandler.setFormatter(logging.Formatter(
             '%(asctime)-15s %(levelname)-8s %(message)s'))
         gHandler.setAutoTimeRest(autoRestTime)
-        gLogger.addHandler(gHandler)
+        if asyncFlg:
+            recordQueue = queue.Queue(maxsize=queueSize)
+            gQueueHandler = BoundedQueueHandler(recordQueue, blockFlg=blockFlg)
+            gListener = logging.handlers.QueueListener(recordQueue, gHandler)
+            gListener.start()
+            gLogger.addHandler(gQueueHandler)
+        else:
+            gLogger.addHandler(gHandler)
         gLogger.setLevel(logging.DEBUG)
 
     except Exception as e:
         print('Logging setup exception:', e)
 
-    # parse the directory to look for all the log files
-    cleanOldFiles(os.path.dirname(gHandler.baseFilename), filePrefix, historyCnt)
+    # parse the directory to look for all the log files in background.
+    gRotationMgr = LogRotationMgr(gLogDir, filePrefix, historyCnt, sizeBudget=sizeBudget,
+                                  compressFlg=compressFlg, subDirFlg=fPutLogsUnderDate)
+    gRotationMgr.start()
+    gRotationMgr.addRotated(None, activePath=gHandler.baseFilename)
 
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
@@ -0,0 +1,653 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        benchmark.py [python3]
+#
+# Purpose:     This module is used to measure the performance of the topology
+#              map host, the data fetcher and the state ingest paths with the
+#              synthetic gateway topology and traffic, and save the result to a
+#              json file to catch the regressions between releases.
+#
+# Author:      Liu Yuancheng
+#
+# Version:     v_0.2
+# Created:     2021/12/20
+# Copyright:   Singtel Cyber Security Research & Development Laboratory
+# License:
+#-----------------------------------------------------------------------------
+""" Program Design:
+    Create a temporary sqlite database filled with a synthetic topology (N control
+    hubs, M gateways), feed the state records generated by the traffic model, run
+    the target data processing function and record the time used.
+    Result file format:
+        {'meta': {'time': ..., 'python': ..., 'sqlite': ..., 'numpy': ..., 'commit': ...},
+         'results': [{'bench': 'host', 'params': {'hubs': 10, 'gateways': 500},
+                      'metrics': {'updateLinkMs': 1.2, ...}}, ...]}
+    Metric name suffix: '...Ms' (lower is better), '...PerSec' (higher is better),
+    the other metrics are only informative and not compared.
+    Usage:
+        python3 benchmark.py [--quick] [--bench host fetcher ...] [--out benchResult.json]
+        python3 benchmark.py --baseline lastRelease.json --threshold 0.2
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import Log
+import globalVal as gv
+import databaseCreater as dbc
+import dbConnPool
+import dbSchema
+import inventoryLoader
+
+LINK_BUILD_SIZES = (10, 100, 500, 1000, 2000)   # node number used by link build test.
+INGEST_ROWS = 2000                              # state rows number used by ingest test.
+LINK_STATE_SIZES = (1000, 10000, 100000)        # link number used by link state update test.
+TICK_LOG_NODES = 500                            # node number used by tick logging test.
+# tick logging test modes: (name, log file mode: None/'sync'/'async', DataMgr payload log level)
+TICK_LOG_MODES = (('off', None, None),
+                  ('sync', 'sync', 'DEBUG'),
+                  ('sync-gated', 'sync', 'INFO'),
+                  ('async', 'async', 'DEBUG'),
+                  ('async-gated', 'async', 'INFO'))
+HOST_SIZES = ((1, 50), (10, 500), (50, 5000))   # (hubs, gateways) used by the map host test.
+FETCH_NODES = (10, 1000)                        # (hubs, gateways) used by the data fetcher test.
+FETCH_ROWS = 20000                              # state rows number used by the data fetcher test.
+EMIT_CLIENTS = (1, 10, 100)                     # SocketIO client number used by the emit latency test.
+EMIT_NODES = (5, 200)                           # (hubs, gateways) used by the emit latency test.
+SERVICE_ROWS = 100000                           # state rows number used by the ingest service test.
+SERVICE_WORKERS = (1, 2, 4)                     # parse worker number used by the ingest service test.
+BENCH_SEED = 1                                  # random seed of the synthetic topology and traffic.
+RESULT_FILE = 'benchResult.json'
+REGRESS_THRESHOLD = 0.2                         # relative change of a metric reported as regression.
+
+GEO_CENTER = (1.3521, 103.8198) # synthetic topology center GPS position (Singapore).
+GEO_SPREAD = (0.15, 0.25)       # max (lat, lng) offset of the control hubs to the center.
+HUB_RADIUS = 0.03               # max (lat, lng) offset of the gateways to their control hub.
+DAY_SEC = 86400
+
+#-----------------------------------------------------------------------------
+def genTopology(hubNum, gwNum, seed=None):
+    """ Generate a synthetic topology, the gateways are placed around and report
+        to a random control hub.
+    Args:
+        hubNum ([int]): control hub number, node ID 0 ~ hubNum-1.
+        gwNum ([int]): gateway number, node ID hubNum ~ hubNum+gwNum-1.
+        seed ([int], optional): random seed. Defaults to None.
+    Returns:
+        [list]: node dicts (inventoryLoader record format).
+    """
+    rand = random.Random(seed)
+    nodes = []
+    for i in range(hubNum + gwNum):
+        if i < hubNum:
+            nodeType, rptTo, name = 'HB', i, 'Control Hub %s' % i
+            lat = GEO_CENTER[0] + rand.uniform(-GEO_SPREAD[0], GEO_SPREAD[0])
+            lng = GEO_CENTER[1] + rand.uniform(-GEO_SPREAD[1], GEO_SPREAD[1])
+        else:
+            nodeType, rptTo, name = 'GW', rand.randrange(hubNum), 'Node %s' % i
+            lat = nodes[rptTo]['lat'] + rand.uniform(-HUB_RADIUS, HUB_RADIUS)
+            lng = nodes[rptTo]['lng'] + rand.uniform(-HUB_RADIUS, HUB_RADIUS)
+        nodes.append({'no': i, 'name': name, 'ipAddr': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                      'lat': round(lat, 7), 'lng': round(lng, 7), 'actF': 0, 'rptTo': rptTo, 'type': nodeType})
+    return nodes
+
+#-----------------------------------------------------------------------------
+def createTestDB(dbPath, nodeNum, hubNum=1, seed=None):
+    """ Create a test database with <hubNum> control hubs and (nodeNum - hubNum)
+        gateways in the gatewayInfo table, returns the node dicts.
+    """
+    nodes = genTopology(hubNum, nodeNum - hubNum, seed=seed)
+    conn = sqlite3.connect(dbPath)
+    conn.execute(dbc.gwInfoTable)
+    dbSchema.migrate(conn)
+    inventoryLoader.loadInventory(conn, nodes, strictFlg=True)
+    conn.close()
+    return nodes
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class TrafficModel(object):
+    """ Synthetic gateway traffic (the realistic version of databaseCreater's
+        getRandomStateInfo()):
+        - each gateway talks to a fixed symmetric peer set, mostly the gateways
+            under the same control hub plus a few gateways under other hubs.
+        - the active flag is a two state Markov chain (fail / recover rate per report).
+        - the throughput follows a daily sine wave around the gateway's base
+            throughput with random noise, 0 if the gateway is inactive.
+    """
+    def __init__(self, nodes, peerNum=4, crossRatio=0.1, failRate=0.02, recoverRate=0.3,
+                 reportRatio=1.0, seed=None):
+        self.rand = random.Random(seed)
+        self.failRate = failRate
+        self.recoverRate = recoverRate
+        self.reportRatio = reportRatio
+        gateways = [node for node in nodes if node['type'] == 'GW']
+        self.gwIDs = [node['no'] for node in gateways]
+        hubGws = {}
+        for node in gateways: hubGws.setdefault(node['rptTo'], []).append(node['no'])
+        self.peers = {gwID: set() for gwID in self.gwIDs}
+        for node in gateways:
+            gwID = node['no']
+            siblings = hubGws[node['rptTo']]
+            for _ in range(peerNum):
+                pairID = self.rand.choice(self.gwIDs if self.rand.random() < crossRatio else siblings)
+                if pairID == gwID: continue
+                self.peers[gwID].add(pairID)
+                self.peers[pairID].add(gwID)
+        self.peers = {gwID: sorted(peerIDs) for gwID, peerIDs in self.peers.items()}
+        self.baseThr = {gwID: self.rand.uniform(1, 10) for gwID in self.gwIDs}
+        self.phase = {gwID: self.rand.uniform(0, 2*math.pi) for gwID in self.gwIDs}
+        self.actF = {gwID: 1 for gwID in self.gwIDs}
+
+#-----------------------------------------------------------------------------
+    def getStateInfo(self, gwID, crtT=None):
+        """ Return the next state info dict of the gateway (same format as the
+            databaseCreater.getRandomStateInfo()'s state dict).
+        """
+        crtT = time.time() if crtT is None else crtT
+        rand = self.rand
+        if self.actF[gwID]:
+            if rand.random() < self.failRate: self.actF[gwID] = 0
+        elif rand.random() < self.recoverRate:
+            self.actF[gwID] = 1
+        actF = self.actF[gwID]
+        if not actF: return {'comTo': [], 'throughputIn': 0, 'throughputOut': 0, 'actF': 0}
+        load = 1 + 0.5*math.sin(2*math.pi*(crtT % DAY_SEC)/DAY_SEC + self.phase[gwID])
+        thrIn = max(0.01, self.baseThr[gwID] * load * rand.gauss(1, 0.1))
+        return {'comTo': [pairID for pairID in self.peers[gwID] if rand.random() < 0.9],
+                'throughputIn': round(thrIn, 2),
+                'throughputOut': round(thrIn * rand.uniform(0.8, 1.2), 2),
+                'actF': actF}
+
+#-----------------------------------------------------------------------------
+    def nextStates(self, crtT=None):
+        """ Return the state records of one report round: list of (time, gatewayID,
+            infoDict) of <reportRatio> of the gateways (dbSchema.insertStates() format).
+        """
+        crtT = time.time() if crtT is None else crtT
+        return [(crtT, gwID, self.getStateInfo(gwID, crtT)) for gwID in self.gwIDs
+                if self.reportRatio >= 1 or self.rand.random() < self.reportRatio]
+
+#-----------------------------------------------------------------------------
+def _record(bench, params, **metrics):
+    """ Create a benchmark result record."""
+    return {'bench': bench, 'params': params, 'metrics': metrics}
+
+def _percentile(values, pct):
+    """ Return the <pct> percentile (0~100) of the values."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct/100.0*(len(values) - 1))))]
+
+def _newDataMgr(hubNum, gwNum, tmpDir, linkMode='observed'):
+    """ Create the test database in <tmpDir> and a map host data manager on it."""
+    import topologyMapHost as host
+    host.LOG_FLAG = False
+    host.LINK_MODE = linkMode
+    gv.DB_PATH = os.path.join(tmpDir, 'bench.db')
+    nodes = createTestDB(gv.DB_PATH, hubNum + gwNum, hubNum=hubNum, seed=BENCH_SEED)
+    return host.DataMgr(None, 0, "bench thread"), nodes
+
+#-----------------------------------------------------------------------------
+def benchLinkBuild(sizes=LINK_BUILD_SIZES):
+    """ Measure the DataMgr.loadNodesData() (node load + link build) time used
+        under different node number.
+    """
+    import topologyMapHost as host
+    host.LOG_FLAG = False
+    host.LINK_MODE = 'mesh' # worst case: every gateway pair has a link.
+    print("Link build benchmark:\n----")
+    print("%8s %10s %10s %12s" % ('nodes', 'links', 'time(s)', 'links/sec'))
+    results = []
+    for nodeNum in sizes:
+        with tempfile.TemporaryDirectory() as tmpDir:
+            gv.DB_PATH = os.path.join(tmpDir, 'bench.db')
+            createTestDB(gv.DB_PATH, nodeNum, seed=BENCH_SEED)
+            dataMgr = host.DataMgr(None, 0, "bench thread")
+            startT = time.perf_counter()
+            dataMgr.loadNodesData()
+            timeUsed = time.perf_counter() - startT
+            linkNum = len(dataMgr.linkReg)
+            dataMgr.dbPool.closeAll()
+        print("%8d %10d %10.3f %12.0f" % (nodeNum, linkNum, timeUsed, linkNum/timeUsed))
+        results.append(_record('linkBuild', {'nodes': nodeNum}, links=linkNum,
+                               loadMs=timeUsed*1000, linksPerSec=linkNum/timeUsed))
+    return results
+
+#-----------------------------------------------------------------------------
+def benchIngest(rowNum=INGEST_ROWS):
+    """ Compare the gatewayState ingest rate of the per-row commit API
+        updateStateTable() and the batched API bulkUpdateStateTable().
+    """
+    print("State ingest benchmark (%s rows):\n----" % rowNum)
+    print("%10s %10s %12s" % ('mode', 'time(s)', 'rows/sec'))
+    nodes = genTopology(1, 49, seed=BENCH_SEED)
+    model = TrafficModel(nodes, seed=BENCH_SEED)
+    states = []
+    while len(states) < rowNum:
+        states.extend((gwID, info) for _, gwID, info in model.nextStates())
+    states = states[:rowNum]
+    results = []
+    for mode in ('per-row', 'batched'):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            dbPath = os.path.join(tmpDir, 'bench.db')
+            createTestDB(dbPath, len(nodes), seed=BENCH_SEED)
+            connector = dbc.databaseCreater(dbPath)
+            startT = time.perf_counter()
+            if mode == 'per-row':
+                for gwID, info in states: connector.updateStateTable(gwID, info)
+            else:
+                connector.bulkUpdateStateTable(states)
+            timeUsed = time.perf_counter() - startT
+            connector.closeConnection()
+        print("%10s %10.3f %12.0f" % (mode, timeUsed, rowNum/timeUsed))
+        results.append(_record('ingest', {'mode': mode, 'rows': rowNum}, rowsPerSec=rowNum/timeUsed))
+    return results
+
+#-----------------------------------------------------------------------------
+def _randomNodeState(dataMgr, ratio=1.0):
+    """ Set random state to <ratio> of the nodes of the data manager."""
+    nodeIDs = [node.devID for node in dataMgr.nodeDict.values()]
+    for node in dataMgr.nodeDict.values():
+        if random.random() > ratio: continue
+        node.activeFlag = 0 if random.random() < 0.3 else 1
+        node.inThrput = round(random.uniform(1, 10), 2)
+        node.keyExchange = random.sample(nodeIDs, k=min(len(nodeIDs), 5))
+
+def benchLinkState(sizes=LINK_STATE_SIZES, rounds=3, ratio=0.1):
+    """ Compare the full link state update time of the per link Python loop
+        (DataMgr._refreshLink) and the NumPy link state engine, <ratio> of the
+        nodes change state in each round.
+    """
+    import topologyMapHost as host
+    import linkEngine
+    if linkEngine.np is None:
+        print("Link state update benchmark: skipped (numpy is not installed).")
+        return []
+    host.LOG_FLAG = False
+    host.LINK_MODE = 'mesh'
+    print("Link state update benchmark:\n----")
+    print("%8s %8s %12s %12s %8s" % ('links', 'nodes', 'loop(s)', 'numpy(s)', 'speedup'))
+    results = []
+    for linkNum in sizes:
+        # full mesh: links = n*(n-1)/2, 1 hub + (n-1) gateways.
+        nodeNum = int((1 + (1 + 8*linkNum)**0.5) / 2)
+        with tempfile.TemporaryDirectory() as tmpDir:
+            gv.DB_PATH = os.path.join(tmpDir, 'bench.db')
+            createTestDB(gv.DB_PATH, nodeNum, seed=BENCH_SEED)
+            dataMgr = host.DataMgr(None, 0, "bench thread")
+            dataMgr.loadNodesData()
+            dataMgr.dbPool.closeAll()
+        engine = linkEngine.LinkStateEngine(dataMgr.linkReg)
+        _randomNodeState(dataMgr)
+        for link in dataMgr.linkReg: dataMgr._refreshLink(link)
+        engine.compute(dataMgr.nodeDict)
+        loopT = numpyT = 0.0
+        for _ in range(rounds):
+            _randomNodeState(dataMgr, ratio)
+            startT = time.perf_counter()
+            for link in dataMgr.linkReg: dataMgr._refreshLink(link)
+            loopT += time.perf_counter() - startT
+            _randomNodeState(dataMgr, ratio)
+            startT = time.perf_counter()
+            engine.compute(dataMgr.nodeDict)
+            numpyT += time.perf_counter() - startT
+        loopT, numpyT = loopT/rounds, numpyT/rounds
+        print("%8d %8d %12.4f %12.4f %8.1f" % (len(dataMgr.linkReg), nodeNum, loopT, numpyT, loopT/numpyT))
+        results.append(_record('linkState', {'links': len(dataMgr.linkReg), 'nodes': nodeNum},
+                               loopMs=loopT*1000, numpyMs=numpyT*1000))
+    return results
+
+#-----------------------------------------------------------------------------
+def benchTickLog(nodeNum=TICK_LOG_NODES, rounds=20, modes=TICK_LOG_MODES):
+    """ Measure the DataMgr.updateLink() tick latency (all the nodes report a new
+        state in each tick) with the logging off, synchronous file logging and
+        async queue logging, with and without the node/link payload messages.
+    """
+    import topologyMapHost as host
+    host.LINK_MODE = 'observed'
+    print("Tick logging benchmark (%s nodes):\n----" % nodeNum)
+    print("%12s %12s %12s %8s" % ('mode', 'avg(ms)', 'max(ms)', 'dropped'))
+    results = []
+    for name, logMode, payloadLevel in modes:
+        with tempfile.TemporaryDirectory() as tmpDir:
+            gv.DB_PATH = os.path.join(tmpDir, 'bench.db')
+            createTestDB(gv.DB_PATH, nodeNum, seed=BENCH_SEED)
+            host.LOG_FLAG = False
+            if logMode:
+                Log.initLogger(tmpDir, 'Logs', None, 'bench', asyncFlg=(logMode == 'async'))
+                Log.setModuleLevel(host.LOG_MODULE, payloadLevel)
+            dataMgr = host.DataMgr(None, 0, "bench thread")
+            dataMgr.loadNodesData()
+            conn = dataMgr.dbPool.getConnection()
+            nodeIDs = dataMgr.nodeDict.keys()
+            tickT = []
+            for _ in range(rounds):
+                crtT = time.time()
+                dbSchema.insertStates(conn, [(crtT, nodeID, {'comTo': random.sample(nodeIDs, k=5),
+                                                             'throughputIn': round(random.uniform(1, 10), 2),
+                                                             'throughputOut': round(random.uniform(1, 10), 2),
+                                                             'actF': int(random.random() > 0.3)}) for nodeID in nodeIDs])
+                startT = time.perf_counter()
+                dataMgr.updateLink()
+                tickT.append(time.perf_counter() - startT)
+            dropped = Log.getDropCount()
+            Log.stopLogger()
+            Log.setModuleLevel(host.LOG_MODULE, None)
+            dataMgr.dbPool.closeAll()
+        avgT = sum(tickT)/len(tickT)
+        print("%12s %12.2f %12.2f %8d" % (name, avgT*1000, max(tickT)*1000, dropped))
+        results.append(_record('tickLog', {'mode': name, 'nodes': nodeNum}, tickMs=avgT*1000,
+                               maxTickMs=max(tickT)*1000, dropped=dropped))
+    return results
+
+#-----------------------------------------------------------------------------
+def benchHost(sizes=HOST_SIZES, rounds=10):
+    """ Measure the map host data manager's loadNodesData(), updateNodes(),
+        updateLink() (delta and full tick) and getCommJSON() time used, all the
+        gateways report a traffic model state in each round.
+    """
+    print("Map host benchmark:\n----")
+    print("%6s %8s %8s %10s %12s %12s %12s %12s" % ('hubs', 'gateways', 'links', 'load(ms)', 'nodes(ms)',
+                                                   'delta(ms)', 'full(ms)', 'json(ms)'))
+    results = []
+    for hubNum, gwNum in sizes:
+        with tempfile.TemporaryDirectory() as tmpDir:
+            dataMgr, nodes = _newDataMgr(hubNum, gwNum, tmpDir)
+            model = TrafficModel(nodes, seed=BENCH_SEED)
+            conn = dataMgr.dbPool.getConnection()
+            startT = time.perf_counter()
+            dataMgr.loadNodesData()
+            loadT = time.perf_counter() - startT
+            dbSchema.insertStates(conn, model.nextStates())
+            dataMgr.updateLink()   # first tick creates the observed links.
+            nodesT, deltaT, fullT, jsonT = [], [], [], []
+            for _ in range(rounds):
+                dbSchema.insertStates(conn, model.nextStates())
+                startT = time.perf_counter()
+                dataMgr.updateNodes()
+                nodesT.append(time.perf_counter() - startT)
+                dbSchema.insertStates(conn, model.nextStates())
+                startT = time.perf_counter()
+                dataMgr.updateLink()
+                deltaT.append(time.perf_counter() - startT)
+                dbSchema.insertStates(conn, model.nextStates())
+                dataMgr.requestFullSync()
+                startT = time.perf_counter()
+                dataMgr.updateLink()
+                fullT.append(time.perf_counter() - startT)
+                startT = time.perf_counter()
+                dataMgr.getCommJSON()
+                jsonT.append(time.perf_counter() - startT)
+            linkNum = len(dataMgr.linkReg)
+            dataMgr.dbPool.closeAll()
+        metrics = {'links': linkNum, 'loadNodesMs': loadT*1000}
+        for name, values in (('updateNodes', nodesT), ('updateLink', deltaT), ('fullTick', fullT), ('commJSON', jsonT)):
+            metrics[name + 'Ms'] = sum(values)/len(values)*1000
+            metrics[name + 'P95Ms'] = _percentile(values, 95)*1000
+        print("%6d %8d %8d %10.2f %12.2f %12.2f %12.2f %12.2f" % (hubNum, gwNum, linkNum, loadT*1000,
+              metrics['updateNodesMs'], metrics['updateLinkMs'], metrics['fullTickMs'], metrics['commJSONMs']))
+        results.append(_record('host', {'hubs': hubNum, 'gateways': gwNum}, **metrics))
+    return results
+
+#-----------------------------------------------------------------------------
+def benchFetcher(size=FETCH_NODES, rowNum=FETCH_ROWS, requests=50, limit=1000):
+    """ Measure the data fetcher's /nodes (cached and reloaded), /updates?since=
+        (paged read of <rowNum> state records), shared cursor /updates and /states
+        (snapshot and cursor) request time by the flask test client.
+    """
+    hubNum, gwNum = size
+    print("Data fetcher benchmark (%s nodes, %s state rows):\n----" % (hubNum + gwNum, rowNum))
+    print("%16s %10s %10s %12s" % ('request', 'avg(ms)', 'p95(ms)', 'rows/sec'))
+    results = []
+    with tempfile.TemporaryDirectory() as tmpDir:
+        gv.DB_PATH = os.path.join(tmpDir, 'bench.db')
+        nodes = createTestDB(gv.DB_PATH, hubNum + gwNum, hubNum=hubNum, seed=BENCH_SEED)
+        model = TrafficModel(nodes, seed=BENCH_SEED)
+        conn = sqlite3.connect(gv.DB_PATH)
+        while conn.execute('SELECT COUNT(*) FROM gatewayState').fetchone()[0] < rowNum:
+            dbSchema.insertStates(conn, model.nextStates())
+        import dataFetcher  # the module loads the nodes from gv.DB_PATH when imported.
+        dataFetcher.dbPool = dbConnPool.getPool(gv.DB_PATH)
+        gv.gLatestSeq = dbSchema.fetchStates(conn, 0)[-1][0]
+        client = dataFetcher.app.test_client()
+
+        def timeRequest(url, reloadFlg=False):
+            if reloadFlg: dataFetcher.gNodesCache['version'] = None
+            startT = time.perf_counter()
+            response = client.get(url)
+            timeUsed = time.perf_counter() - startT
+            if response.status_code != 200: raise RuntimeError('%s: HTTP %s' % (url, response.status_code))
+            return timeUsed, response.get_json()
+
+        for name, reloadFlg in (('nodes', False), ('nodesReload', True)):
+            timeUsed = [timeRequest('/nodes', reloadFlg)[0] for _ in range(requests)]
+            results.append(_record('fetcher', {'request': name, 'nodes': hubNum + gwNum},
+                                   requestMs=sum(timeUsed)/requests*1000, p95Ms=_percentile(timeUsed, 95)*1000))
+        # page through all the state records by the 'since' cursor.
+        timeUsed, cursor, rows, more = [], 0, 0, True
+        while more:
+            reqT, data = timeRequest('/updates?since=%d&limit=%d' % (cursor, limit))
+            timeUsed.append(reqT)
+            cursor, more, rows = data['cursor'], data['more'], rows + len(data['updates'])
+        results.append(_record('fetcher', {'request': 'updatesSince', 'rows': rows, 'limit': limit},
+                               requestMs=sum(timeUsed)/len(timeUsed)*1000, p95Ms=_percentile(timeUsed, 95)*1000,
+                               rowsPerSec=rows/sum(timeUsed)))
+        # shared cursor: one traffic round committed before each request.
+        timeUsed, rows = [], 0
+        for _ in range(requests):
+            dbSchema.insertStates(conn, model.nextStates())
+            reqT, data = timeRequest('/updates')
+            timeUsed.append(reqT)
+            rows += len(data)
+        results.append(_record('fetcher', {'request': 'updates', 'gateways': gwNum},
+                               requestMs=sum(timeUsed)/requests*1000, p95Ms=_percentile(timeUsed, 95)*1000,
+                               rowsPerSec=rows/sum(timeUsed)))
+        # latest state snapshot, then the changed states after each traffic round.
+        timeUsed = [timeRequest('/states')[0] for _ in range(requests)]
+        results.append(_record('fetcher', {'request': 'statesSnapshot', 'gateways': gwNum},
+                               requestMs=sum(timeUsed)/requests*1000, p95Ms=_percentile(timeUsed, 95)*1000))
+        timeUsed, version = [], timeRequest('/states')[1]['version']
+        for _ in range(requests):
+            dbSchema.insertStates(conn, model.nextStates())
+            reqT, data = timeRequest('/states?since=%d' % version)
+            timeUsed.append(reqT)
+            version = data['version']
+        results.append(_record('fetcher', {'request': 'statesSince', 'gateways': gwNum},
+                               requestMs=sum(timeUsed)/requests*1000, p95Ms=_percentile(timeUsed, 95)*1000))
+        conn.close()
+        dataFetcher.dbPool.closeAll()
+    for record in results:
+        metrics = record['metrics']
+        print("%16s %10.2f %10.2f %12s" % (record['params']['request'], metrics['requestMs'], metrics['p95Ms'],
+                                           '%.0f' % metrics['rowsPerSec'] if 'rowsPerSec' in metrics else '-'))
+    return results
+
+#-----------------------------------------------------------------------------
+def benchEmit(clientNums=EMIT_CLIENTS, size=EMIT_NODES, rounds=10, wireFormats=('json', 'binary')):
+    """ Measure the SocketIO 'newrequest' emit-to-receive latency of the map host
+        with <clientNums> connected clients (flask_socketio test clients, the
+        latency is the time from the updateLink() call until each client got
+        the message, so it covers the encode, fan out and the client decode).
+    """
+    import topologyMapHost as host
+    hubNum, gwNum = size
+    print("SocketIO emit latency benchmark (%s nodes):\n----" % (hubNum + gwNum))
+    print("%8s %8s %10s %10s %10s" % ('format', 'clients', 'avg(ms)', 'p95(ms)', 'max(ms)'))
+    results = []
+    wireFormat, dataMgr = host.WIRE_FORMAT, gv.iDataMgr
+    try:
+        for fmt in wireFormats:
+            host.WIRE_FORMAT = fmt
+            for clientNum in clientNums:
+                with tempfile.TemporaryDirectory() as tmpDir:
+                    gv.iDataMgr, nodes = _newDataMgr(hubNum, gwNum, tmpDir)
+                    gv.iDataMgr.loadNodesData()
+                    model = TrafficModel(nodes, seed=BENCH_SEED)
+                    conn = gv.iDataMgr.dbPool.getConnection()
+                    clients = [gv.iSocketIO.test_client(host.app, namespace='/test') for _ in range(clientNum)]
+                    latency = []
+                    for _ in range(rounds):
+                        for client in clients: client.get_received('/test')
+                        dbSchema.insertStates(conn, model.nextStates())
+                        startT = time.perf_counter()
+                        gv.iDataMgr.updateLink()
+                        for client in clients:
+                            if any(msg['name'] == 'newrequest' for msg in client.get_received('/test')):
+                                latency.append(time.perf_counter() - startT)
+                    for client in clients: client.disconnect(namespace='/test')
+                    gv.iDataMgr.dbPool.closeAll()
+                if not latency: continue
+                avgT = sum(latency)/len(latency)
+                print("%8s %8d %10.2f %10.2f %10.2f" % (fmt, clientNum, avgT*1000, _percentile(latency, 95)*1000,
+                                                       max(latency)*1000))
+                results.append(_record('emit', {'format': fmt, 'clients': clientNum, 'nodes': hubNum + gwNum},
+                                       latencyMs=avgT*1000, p95Ms=_percentile(latency, 95)*1000,
+                                       maxMs=max(latency)*1000))
+    finally:
+        host.WIRE_FORMAT, gv.iDataMgr = wireFormat, dataMgr
+    return results
+
+#-----------------------------------------------------------------------------
+def benchIngestService(rowNum=SERVICE_ROWS, workerNums=SERVICE_WORKERS, senders=4, chunkRows=1000):
+    """ Measure the ingest service (ingestService.py) end to end rate: <senders>
+        socket clients send <rowNum> json line reports, until all written.
+    """
+    import threading
+    import ingestService
+    print("Ingest service benchmark (%s rows, %s senders):\n----" % (rowNum, senders))
+    print("%8s %12s %10s %10s %8s" % ('workers', 'rows/sec', 'lag(s)', 'maxLag(s)', 'batches'))
+    nodes = genTopology(1, 49, seed=BENCH_SEED)
+    model = TrafficModel(nodes, seed=BENCH_SEED)
+    records = []
+    while len(records) < rowNum:
+        records.extend({'id': gwID, 'info': info} for _, gwID, info in model.nextStates())
+    records = records[:rowNum]
+    chunks = [records[i:i+chunkRows] for i in range(0, rowNum, chunkRows)]
+    results = []
+    for workerNum in workerNums:
+        with tempfile.TemporaryDirectory() as tmpDir:
+            service = ingestService.IngestService(dbPath=os.path.join(tmpDir, 'bench.db'), workerNum=workerNum)
+            service.start()
+            port = service.serveSocket(0).server_address[1]
+            startT = time.perf_counter()
+            threads = [threading.Thread(target=lambda idx=idx: [ingestService.sendReports(chunk, port=port)
+                                                                for chunk in chunks[idx::senders]])
+                       for idx in range(senders)]
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+            while service.stats.get('written') + service.stats.get('invalid') < rowNum: time.sleep(0.01)
+            timeUsed = time.perf_counter() - startT
+            report = service.getReport()
+            service.stop()
+        print("%8d %12.0f %10.3f %10.3f %8d" % (workerNum, rowNum/timeUsed, report['lag'], report['maxLag'],
+                                                report['batches']))
+        results.append(_record('ingestService', {'workers': workerNum, 'rows': rowNum, 'senders': senders},
+                               rowsPerSec=rowNum/timeUsed, maxLagMs=report['maxLag']*1000,
+                               batches=report['batches']))
+    return results
+
+#-----------------------------------------------------------------------------
+# benchmark name: (function, default kwargs, --quick kwargs)
+BENCHES = {
+    'linkBuild': (benchLinkBuild, {}, {'sizes': (10, 100, 500)}),
+    'ingest': (benchIngest, {}, {'rowNum': 500}),
+    'linkState': (benchLinkState, {}, {'sizes': (1000, 10000)}),
+    'tickLog': (benchTickLog, {}, {'nodeNum': 100, 'rounds': 5}),
+    'host': (benchHost, {}, {'sizes': ((1, 50), (10, 500)), 'rounds': 3}),
+    'fetcher': (benchFetcher, {}, {'size': (5, 100), 'rowNum': 2000, 'requests': 10}),
+    'emit': (benchEmit, {}, {'clientNums': (1, 10), 'rounds': 3}),
+    'ingestService': (benchIngestService, {}, {'rowNum': 20000, 'workerNums': (1, 2)}),
+}
+
+#-----------------------------------------------------------------------------
+def getMetaInfo():
+    """ Return the test environment information saved with the results."""
+    import linkEngine
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sqlite': sqlite3.sqlite_version,
+            'numpy': linkEngine.np.__version__ if linkEngine.np else None,
+            'commit': commit or None,
+            'seed': BENCH_SEED}
+
+#-----------------------------------------------------------------------------
+def _recordKey(record):
+    return (record['bench'], json.dumps(record['params'], sort_keys=True))
+
+def compareResults(baseline, results, threshold=REGRESS_THRESHOLD):
+    """ Compare the results with the baseline results.
+    Args:
+        baseline ([list]): baseline result records.
+        results ([list]): current result records.
+        threshold ([float], optional): relative change reported as regression.
+    Returns:
+        [list]: regression messages.
+    """
+    baseDict = {_recordKey(record): record['metrics'] for record in baseline}
+    regressions = []
+    for record in results:
+        baseMetrics = baseDict.get(_recordKey(record))
+        if not baseMetrics: continue
+        for name, value in record['metrics'].items():
+            baseVal = baseMetrics.get(name)
+            if not baseVal or value is None: continue
+            if name.endswith('Ms'):
+                change = (value - baseVal) / baseVal
+            elif name.endswith('PerSec'):
+                change = (baseVal - value) / baseVal
+            else:
+                continue
+            if change > threshold:
+                regressions.append('%s %s %s: %.3f -> %.3f (%+.0f%%)' % (record['bench'], json.dumps(record['params'],
+                                   sort_keys=True), name, baseVal, value, change*100))
+    return regressions
+
+#-----------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='Topology map performance benchmark.')
+    parser.add_argument('--bench', nargs='+', choices=tuple(BENCHES.keys()), default=tuple(BENCHES.keys()),
+                        help='benchmarks to run (default: all).')
+    parser.add_argument('--quick', action='store_true', help='run the small size version of the benchmarks.')
+    parser.add_argument('--out', default=RESULT_FILE, help='result json file path.')
+    parser.add_argument('--baseline', help='baseline result json file to compare with.')
+    parser.add_argument('--threshold', type=float, default=REGRESS_THRESHOLD,
+                        help='relative metric change reported as regression (default: %(default)s).')
+    args = parser.parse_args()
+    dbPath = gv.DB_PATH
+    results = []
+    try:
+        for name in args.bench:
+            func, kwargs, quickKwargs = BENCHES[name]
+            results.extend(func(**(quickKwargs if args.quick else kwargs)))
+            print('')
+    finally:
+        gv.DB_PATH = dbPath
+    output = {'meta': getMetaInfo(), 'results': results}
+    output['meta']['quick'] = args.quick
+    with open(args.out, 'w') as fh:
+        json.dump(output, fh, indent=1)
+    print("> Saved %d results to %s" % (len(results), args.out))
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = compareResults(json.load(fh)['results'], results, threshold=args.threshold)
+        for msg in regressions: print("> Regression: %s" % msg)
+        print("> %d regressions found (threshold %.0f%%)." % (len(regressions), args.threshold*100))
+        if regressions: sys.exit(1)
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -15,13 +15,33 @@
 
 # import python built in modules.
 import json
-import sqlite3
+import math
+import time
+import threading
 
 # import pip installed modules.
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
 
 # import project local modules.
 import globalVal as gv
+import dbConnPool
+import dbSchema
+import metrics
+import stateCache
+import stateWatcher
+
+UPDATE_LIMIT = 1000      # default max number of state records returned by one /updates request.
+UPDATE_MAX_LIMIT = 5000  # max value of the /updates 'limit' parameter.
+POLL_TIMEOUT = 30        # default wait time (sec) of the /updates/poll long-poll request.
+POLL_MAX_TIMEOUT = 120   # max value of the /updates/poll 'timeout' parameter.
+SSE_HEARTBEAT = 15       # sec, idle time before sending a keep alive comment to the SSE client.
+NODES_CACHE_T = 10       # sec, max age of the /nodes result if the inventory is not changed.
+METRICS_FLAG = True      # serve the Prometheus metrics at /metrics.
+PROFILE_FLAG = False     # also serve the POST /metrics/profile profiler toggle route (needs METRICS_FLAG).
+
+gRowsServed = metrics.counter('fetcher_state_rows_total', 'State records returned to the clients.', labelNames=('route',))
+gRowsUpdates, gRowsPoll, gRowsStream, gRowsStates = (gRowsServed.labels(route) for route in
+                                                      ('/updates', '/updates/poll', '/stream', '/states'))
 
 #-----------------------------------------------------------------------------
 # Init the dummy nodes information list for testing.
@@ -39,17 +59,22 @@ import globalVal as gv
 
 #--------------------------------------------------------------------------------------------------------
 
-def parseNodes(info):
+def parseNodes(info, pairs=()):
     """ Parse input database data 
 
     Args:
-        info ([type]): [description]
+        info ([list]): gatewayInfo table rows.
+        pairs ([iterable], optional): gateway (id1, id2) communication pairs. Defaults to ().
 
     Returns:
-        [type]: [description]
+        [list]: list of the node dict.
     """
     result = []
-        
+    comToDict = {}  # gateway ID -> communication gateway ID list.
+    for id1, id2 in pairs:
+        comToDict.setdefault(id1, []).append(id2)
+        comToDict.setdefault(id2, []).append(id1)
+
     for nodes in info:
         currNode = {}
         currList = list(nodes)
@@ -64,52 +89,194 @@ def parseNodes(info):
         currNode['rptTo'] = currList[6]
         currNode['type'] = currList[7]
 
-        for i in info:
-            appendList = list(i)
-            if currList[7] == 'HB':
-                connection.append(currList[0])
-                break
-            if appendList[7] == 'GW' and appendList[0] != currList[0]: 
-                connection.append(appendList[0])
+        if currList[7] == 'HB':
+            connection.append(currList[0])
+        else:
+            connection = sorted(comToDict.get(currList[0], []))
 
         currNode['comTo'] = connection
 
         result.append(currNode)
     return result
 
-connection = sqlite3.connect('node_database.db')
-node_cursor = connection.cursor() # Cursor can be used to call execute method for SQL queries
+dbPool = dbConnPool.getPool(gv.DB_PATH) # each flask thread reuses its own pooled connection.
+dbSchema.migrate(dbPool.getConnection())
 
-node_cursor.execute("SELECT * FROM gatewayInfo")
-db_data = node_cursor.fetchall()
+def loadNodes():
+    """ Load the nodes list from the gatewayInfo table."""
+    conn = dbPool.getConnection()
+    db_data = dbPool.fetchall("SELECT * FROM gatewayInfo")
+    # only the explicit adjacency pairs and the pairs seen in the state records within the link TTL.
+    com_pairs = set(dbSchema.fetchLinkPairs(conn)) | dbSchema.fetchComPairs(conn, time.time() - gv.LINK_TTL)
+    return parseNodes(db_data, com_pairs)
+
+DUMMY_NODES = None  # loaded by the first getNodes() call.
+gNodesCache = {'version': None, 'time': 0}
+gNodesLock = threading.Lock()
+
+def getNodes():
+    """ Return the nodes list, reloaded when the inventory change counter changed
+        or the cached list is older than NODES_CACHE_T.
+    """
+    global DUMMY_NODES
+    version = dbSchema.getInfoVersion(dbPool.getConnection())
+    with gNodesLock:
+        if version != gNodesCache['version'] or time.time() - gNodesCache['time'] > NODES_CACHE_T:
+            DUMMY_NODES = loadNodes()
+            gNodesCache.update({'version': version, 'time': time.time()})
+        return DUMMY_NODES
 
-DUMMY_NODES = parseNodes(db_data)
+gWatcher = None # single database watcher shared by all the streaming clients.
+gWatcherLock = threading.Lock()
+
+def getStateCache():
+    """ Return the latest state cache of the fetcher's database."""
+    return stateCache.getCache(dbPool.dbPath)
+
+def getWatcher():
+    """ Return the running state watcher, start it when the first client subscribes."""
+    global gWatcher
+    with gWatcherLock:
+        if gWatcher is None:
+            gWatcher = stateWatcher.StateWatcher(gv.DB_PATH)
+            gWatcher.start()
+        return gWatcher
+
+def formatUpdates(update_list):
+    """ Convert the state records to the /updates json list: [{id: updateInfo}, ...]"""
+    return [{str(data[2]): data[3]} for data in update_list]
 
 #--------------------------------------------------------------------------------------------------------
 # Initialize the Flask application
 app = Flask(__name__)
+if METRICS_FLAG: metrics.instrumentApp(app, 'dataFetcher', profileFlg=PROFILE_FLAG)
+
+@app.teardown_appcontext
+def closeDbConnection(exc):
+    """ Close the request thread's pooled connection, every request runs in a new thread."""
+    dbPool.closeConnection()
 
 @app.route('/nodes', methods=['GET'])
 def home():
     """ Handle the node init request."""
-    return jsonify(DUMMY_NODES)
+    return jsonify(getNodes())
 
 @app.route('/updates', methods=['GET'])
 def updateNodeAct():
-    """ Handle the node state update request.d"""
-    update_connection = sqlite3.connect('node_database.db') # Reconnect due to new thread
-    update_cursor = update_connection.cursor()
-    update_cursor.execute("SELECT * FROM gatewayState WHERE time > {}".format(gv.gLatestTime))
-    update_json_list = update_cursor.fetchall()
-    if len(update_json_list) > 0: gv.gLatestTime = update_json_list[-1][0]
-
-    changeList = [] # e.g. [{'no': [1], 'updateInfo': {'id1': {'comTo': [], 'throughputIn': 0, 'throughputOut': 0, 'actF': 0}}}]
-
-    for data in update_json_list:
-        curr_data_info = {str(data[1]):json.loads(data[2])}
-        changeList.append(curr_data_info)
-   
-    return jsonify(changeList)
+    """ Handle the node state update request.
+        - Without 'since' parameter: return the latest state of the gateways updated
+            since the last /updates request (shared cursor, a list of {id: updateInfo}).
+        - With 'since' parameter: return the state records after the client's 
+            cursor: {'cursor': <next since>, 'more': <has more page>, 'updates': [...]}
+            'limit' sets the page size. The response carries an ETag, a request
+            with the same If-None-Match gets 304 when nothing changed.
+        example: /updates?since=120&limit=500
+    """
+    if 'since' not in request.args:
+        # latest state of the gateways changed since the last request (one record per gateway).
+        gv.gLatestSeq, update_list = getStateCache().getChanges(gv.gLatestSeq)
+        gRowsUpdates.inc(len(update_list))
+
+        changeList = [] # e.g. [{'1': {'comTo': [], 'throughputIn': 0, 'throughputOut': 0, 'actF': 0}}]
+
+        for data in update_list:
+            curr_data_info = {str(data[2]): data[3]}
+            changeList.append(curr_data_info)
+       
+        return jsonify(changeList)
+
+    try:
+        since = int(request.args['since'])
+        limit = min(int(request.args.get('limit', UPDATE_LIMIT)), UPDATE_MAX_LIMIT)
+        if since < 0 or limit <= 0: raise ValueError
+    except ValueError:
+        return jsonify({'error': "'since' and 'limit' must be non-negative integers."}), 400
+    # fetch one more record to check whether there is next page.
+    update_list = dbSchema.fetchStates(dbPool.getConnection(), since, limit=limit+1)
+    more = len(update_list) > limit
+    update_list = update_list[:limit]
+    gRowsUpdates.inc(len(update_list))
+    cursor = update_list[-1][0] if update_list else since
+    response = jsonify({'cursor': cursor,
+                        'more': more,
+                        'updates': formatUpdates(update_list)})
+    # 'more' changes when a new record arrives after a full last page (same cursor).
+    response.set_etag('%d-%d-%d-%d' % (since, limit, cursor, more))
+    return response.make_conditional(request)
+
+@app.route('/states', methods=['GET'])
+def latestStates():
+    """ Handle the latest gateway state request (snapshot + cursor):
+        - since=0 (default): all the gateways' latest state.
+        - since=<version>: only the gateways changed after the version.
+        Returns: {'version': <next since>, 'full': <since is 0>, 'states': {id: updateInfo}}
+        example: /states?since=1520
+    """
+    try:
+        since = int(request.args.get('since', 0))
+        if since < 0: raise ValueError
+    except ValueError:
+        return jsonify({'error': "'since' must be a non-negative integer."}), 400
+    version, changes = getStateCache().getChanges(since)
+    gRowsStates.inc(len(changes))
+    response = jsonify({'version': version,
+                        'full': since == 0,
+                        'states': {str(data[2]): data[3] for data in changes}})
+    response.set_etag('%d-%d' % (since, version))
+    return response.make_conditional(request)
+
+@app.route('/updates/poll', methods=['GET'])
+def pollNodeAct():
+    """ Long-poll version of /updates?since=: return as soon as there are state 
+        records after the 'since' cursor, or return an empty update list after
+        'timeout' seconds.
+        example: /updates/poll?since=120&timeout=30
+    """
+    try:
+        since = int(request.args.get('since', 0))
+        timeout = float(request.args.get('timeout', POLL_TIMEOUT))
+        if since < 0 or not math.isfinite(timeout) or timeout < 0: raise ValueError
+        timeout = min(timeout, POLL_MAX_TIMEOUT)
+    except ValueError:
+        return jsonify({'error': "'since' and 'timeout' must be non-negative numbers."}), 400
+    watcher = getWatcher()
+    sub = watcher.subscribe(since)
+    try:
+        update_list = sub.get(timeout=timeout)
+    finally:
+        watcher.unsubscribe(sub)
+    gRowsPoll.inc(len(update_list))
+    return jsonify({'cursor': sub.cursor, 'updates': formatUpdates(update_list)})
+
+@app.route('/stream', methods=['GET'])
+def streamNodeAct():
+    """ Server-Sent Events stream, each new committed state records batch is sent
+        as one event: 'id' is the batch's last seq, 'data' is the /updates json list.
+        The stream resumes after 'since' or the 'Last-Event-ID' header.
+        example: /stream?since=120
+    """
+    try:
+        since = int(request.headers.get('Last-Event-ID', request.args.get('since', 0)))
+        if since < 0: raise ValueError
+    except ValueError:
+        return jsonify({'error': "'since' must be a non-negative integer."}), 400
+    watcher = getWatcher()
+    sub = watcher.subscribe(since)
+
+    def eventStream():
+        try:
+            while True:
+                update_list = sub.get(timeout=SSE_HEARTBEAT)
+                if update_list:
+                    gRowsStream.inc(len(update_list))
+                    yield 'id: %d\ndata: %s\n\n' % (sub.cursor, json.dumps(formatUpdates(update_list)))
+                else:
+                    yield ': keep-alive\n\n'
+        finally:
+            watcher.unsubscribe(sub)
+
+    return Response(stream_with_context(eventStream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 if __name__ == '__main__':
     app.run(host="0.0.0.0", debug=False, threaded=True)
\ No newline at end of file
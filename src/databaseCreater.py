@@ -17,9 +17,13 @@ import os
 import json
 import time
 import random
-import sqlite3
-from sqlite3 import Error
+import threading
+from sqlite3 import Error, OperationalError
 import ConfigLoader as cl 
+import dbConnPool
+import dbSchema
+import inventoryLoader
+import metrics
 import globalVal as gv
 
 print("Current working directory is : %s" % os.getcwd())
@@ -29,56 +33,75 @@ GV_FLG = True  # Flag to identify whether use global value
 
 DB_PATH = gv.DB_PATH if GV_FLG else os.path.join(dirpath , "node_database.db")
 NODES_FILE = gv.NODES_FILE if GV_FLG else  os.path.join(dirpath, 'NodesRcd.txt')
+FLUSH_SIZE = 500    # number of buffered state rows to trigger a batch write.
+FLUSH_INTV = 1.0    # max time (sec) a state row stays in the buffer before written.
+FLUSH_RETRY = 3     # failed flushes (database locked) before the buffered rows are dropped.
+METRICS_PORT = 9101 # port of the write path /metrics http server, None: not serve.
 
-# gateway information table query.
-gwInfoTable = "CREATE TABLE IF NOT EXISTS gatewayInfo(id integer PRIMARY KEY,\
-                                                                name text NOT NULL,\
-                                                                ipAddr text NOT NULL,\
-                                                                lat float NOT NULL,\
-                                                                lng float NOT NULL,\
-                                                                actF integer NOT NULL,\
-                                                                rptTo integer NOT NULL,\
-                                                                type text NOT NULL)"
-# gateway current state table query.
-gwStateTable = "CREATE TABLE IF NOT EXISTS gatewayState(time float PRIMARY KEY,\
-                                                                 id text NOT NULL,\
-                                                                 updateInfo text NOT NULL)"
+gBufferRows = metrics.gauge('ingest_buffer_rows', 'State rows buffered by databaseCreater.addState().')
+gFlushRows = metrics.histogram('ingest_flush_rows', 'State rows number of each flushStates() batch.',
+                               buckets=(1, 10, 50, 100, 500, 1000, 5000, 10000))
+gWriteErrors = metrics.counter('ingest_write_errors_total', 'Failed databaseCreater state writes.')
+gDroppedRows = metrics.counter('ingest_dropped_rows_total', 'Buffered state rows dropped after the failed flushes.')
+
+# gateway info/state table queries, the state tables are created by dbSchema.migrate().
+gwInfoTable = dbSchema.gwInfoTable
+gwStateTable = dbSchema.gwStateTable
+gwInfoInsert = "INSERT INTO gatewayInfo VALUES(?, ?, ?, ?, ?, ?, ?, ?)"
 
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
 class databaseCreater(object):
 
-    """ Download the webpage screen shot base on the input url."""
-    def __init__(self, dataBasePath):
+    """ Create the gateway database tables and insert the gateway state records."""
+    def __init__(self, dataBasePath, flushSize=FLUSH_SIZE, flushIntv=FLUSH_INTV):
         try:
-            # Create a connection with the database
-            self.connection = sqlite3.connect(dataBasePath)
+            # Create a connection with the database (WAL mode pooled connection)
+            self.dbPool = dbConnPool.getPool(dataBasePath)
+            self.connection = self.dbPool.getConnection()
+            dbSchema.migrate(self.connection)
             print("Connection is established: Database is created in node_database.db")
             self.cursorObj = self.connection.cursor() # Cursor can be used to call execute method for SQL queries
-            self.cfgLoader = cl.ConfigLoader(NODES_FILE, mode='r', filterChars=('#', '', '\n'))
+            # the node records are streamed from the file by createTables().
+            self.cfgLoader = cl.ConfigLoader(NODES_FILE, mode='r', filterChars=('#', '', '\n'),
+                                             parseFun=json.loads, loadFlg=False)
         except Error: print("__init__ error: %s" %str(Error))
+        # batch ingest parameters.
+        self.flushSize = flushSize  # buffered rows number to trigger flush.
+        self.flushIntv = flushIntv  # buffer max hold time to trigger flush.
+        self.stateBuf = []          # buffered gatewayState rows.
+        self.lastFlushT = time.time()
+        self.flushFails = 0         # continuous failed flushes of the buffered rows.
+        self.ingestCount = 0        # total number of state rows written.
+        self.ingestTime = 0.0       # total time used to write the state rows.
+        self.droppedCount = 0       # total number of state rows dropped.
+        # the buffer and the connection are shared with the background flush thread.
+        self.lock = threading.RLock()
+        self.stopEvent = threading.Event()
+        self.flushThread = None
 
 #-----------------------------------------------------------------------------
     def createTables(self):
-        """ Ceate the node info and state table. """
+        """ Ceate the node info table or update it with the nodes file, the 
+            unchanged nodes are not written.
+        """
         try:
-            self.cursorObj.execute(gwInfoTable)
-            self.connection.commit()
-            self.cursorObj.execute(gwStateTable)
-            self.connection.commit()
-            for val in self.cfgLoader.getJson().values():
-                node = json.loads(val)
-                insertQuery = 'INSERT INTO gatewayInfo VALUES({}, "{}", "{}", {}, {}, {}, {}, "{}")'.\
-                    format(node["no"], node["name"], node["ipAddr"], node["lat"], node["lng"],\
-                         node["actF"], node["rptTo"], node["type"])
-                self.cursorObj.execute(insertQuery)
-                self.connection.commit()
-        except Error: print("createTables error: %s" %str(Error))
+            report = inventoryLoader.loadInventory(self.connection, inventoryLoader.iterNodesRcd(self.cfgLoader.filePath))
+            for msg in report['errors']: print("createTables invalid %s" %msg)
+            print("createTables: %(rows)d nodes, %(changed)d changed (%(rowsPerSec).0f rows/sec)" %report)
+        except Error as err: print("createTables error: %s" %str(err))
 
 #-----------------------------------------------------------------------------
     def clearStateTable(self):
-        self.cursorObj.execute('DELETE FROM gatewayState')
-        self.connection.commit()
+        with self.lock, self.connection:
+            self.cursorObj.execute('DELETE FROM gatewayState')
+            self.cursorObj.execute('DELETE FROM gatewayComTo')
+
+#-----------------------------------------------------------------------------
+    def _getStateRow(self, gatewayID, infoStr):
+        """ Build a gatewayState record with the current time stamp."""
+        if isinstance(infoStr, str): infoStr = json.loads(infoStr)
+        return (time.time(), int(gatewayID), infoStr)
 
 #-----------------------------------------------------------------------------
     def updateStateTable(self, gatewayID, infoStr):
@@ -87,16 +110,108 @@ class databaseCreater(object):
             gatewayID ([int]): gateway ID
             infoStr ([json/dict]): state dict. Example: {"comTo": [2], "throughputIn": 0, "throughputOut": 0, "actF": 0}
         """
-        insertQuery = "INSERT INTO gatewayState(time, id, updateInfo) VALUES({}, '{}', '{}')".\
-                        format(time.time(), str(gatewayID), json.dumps(infoStr))
-        self.cursorObj.execute(insertQuery)
-        self.connection.commit()
-        time.sleep(1) # optional
+        startT = time.time()
+        with self.lock:
+            dbSchema.insertStates(self.connection, [self._getStateRow(gatewayID, infoStr)])
+        self.ingestCount += 1
+        self.ingestTime += time.time() - startT
+
+#-----------------------------------------------------------------------------
+    def addState(self, gatewayID, infoStr):
+        """ Buffer a gateway state record, the buffer will be written to the data
+            base when the buffer size reach <flushSize> or the buffered time 
+            reach <flushIntv> (checked by the background flush thread when no 
+            more record is added).
+        Args:
+            gatewayID ([int]): gateway ID
+            infoStr ([json/dict]): state dict, same as updateStateTable().
+        """
+        row = self._getStateRow(gatewayID, infoStr)
+        with self.lock:
+            if self.flushThread is None: self.startFlushThread()
+            self.stateBuf.append(row)
+            gBufferRows.set(len(self.stateBuf))
+            if len(self.stateBuf) >= self.flushSize or time.time() - self.lastFlushT >= self.flushIntv:
+                self.flushStates()
+
+#-----------------------------------------------------------------------------
+    def startFlushThread(self):
+        """ Start the background thread which flushes the buffer every <flushIntv>."""
+        self.stopEvent.clear()
+        self.flushThread = threading.Thread(target=self._flushLoop, name='stateFlush', daemon=True)
+        self.flushThread.start()
+
+    def _flushLoop(self):
+        while not self.stopEvent.wait(self.flushIntv / 2):
+            with self.lock:
+                if self.stateBuf and time.time() - self.lastFlushT >= self.flushIntv:
+                    self.flushStates()
+
+#-----------------------------------------------------------------------------
+    def flushStates(self):
+        """ Write all the buffered state rows into the data base in one transaction.
+            If the database is locked the rows are put back to the buffer and written 
+            by the next flush, they are dropped after <FLUSH_RETRY> failed flushes 
+            or if the rows can not be written.
+            Returns: number of rows written.
+        """
+        with self.lock:
+            self.lastFlushT = time.time()
+            if not self.stateBuf: return 0
+            rows, self.stateBuf = self.stateBuf, []
+            try:
+                dbSchema.insertStates(self.connection, rows)
+            except (Error, OverflowError, ValueError) as err:
+                print("flushStates error: %s" %str(err))
+                gWriteErrors.inc()
+                if self.connection.in_transaction: self.connection.rollback()
+                self.flushFails += 1
+                if isinstance(err, OperationalError) and self.flushFails < FLUSH_RETRY:
+                    self.stateBuf[:0] = rows    # keep the time order.
+                else:
+                    print("flushStates: %d rows dropped." %len(rows))
+                    gDroppedRows.inc(len(rows))
+                    self.droppedCount += len(rows)
+                    self.flushFails = 0
+                gBufferRows.set(len(self.stateBuf))
+                return 0
+            self.flushFails = 0
+            gBufferRows.set(len(self.stateBuf))
+            gFlushRows.observe(len(rows))
+            self.ingestCount += len(rows)
+            self.ingestTime += time.time() - self.lastFlushT
+            return len(rows)
+
+#-----------------------------------------------------------------------------
+    def bulkUpdateStateTable(self, stateIter):
+        """ Insert a batch of gateway state records in to the state table.
+        Args:
+            stateIter ([iterable]): iterable of (gatewayID, infoDict) tuple.
+        Returns:
+            [int]: number of rows inserted.
+        """
+        startCount = self.ingestCount
+        for gatewayID, infoStr in stateIter:
+            self.addState(gatewayID, infoStr)
+        self.flushStates()
+        return self.ingestCount - startCount
+
+#-----------------------------------------------------------------------------
+    def getIngestStats(self):
+        """ Return the state ingest throughput report dict."""
+        rate = self.ingestCount / self.ingestTime if self.ingestTime > 0 else 0
+        return {'rows': self.ingestCount, 'time': self.ingestTime, 'rowsPerSec': rate,
+                'dropped': self.droppedCount}
 
 #-----------------------------------------------------------------------------
     def closeConnection(self):
         print("Closing database connection")
-        self.connection.close()
+        self.stopEvent.set()
+        if self.flushThread is not None:
+            self.flushThread.join()
+            self.flushThread = None
+        self.flushStates()
+        self.dbPool.closeConnection()
 
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
@@ -122,9 +237,9 @@ def getRandomStateInfo():
 
 def main():
     print("Start Database Insert Simulation")
-    tableCheck = os.path.exists(DB_PATH)
+    if METRICS_PORT: metrics.startHttpServer(METRICS_PORT)
     connector = databaseCreater(DB_PATH)
-    if not tableCheck: connector.createTables()
+    connector.createTables() # no-op if the nodes file is not changed.
     connector.clearStateTable()
     #for _ in range(2):
     while True:
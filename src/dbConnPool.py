@@ -0,0 +1,132 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        dbConnPool.py [python3]
+#
+# Purpose:     This module provides a small sqlite3 connection pool shared by the
+#              map host, data fetcher and database creater. Each thread reuses
+#              its own connection, all the connections run under WAL journal
+#              mode so the readers and the writer will not block each other.
+#
+# Author:      Liu Yuancheng
+#
+# Version:     v_0.2
+# Created:     2021/12/20
+# Copyright:   Singtel Cyber Security Research & Development Laboratory
+# License:
+#-----------------------------------------------------------------------------
+""" Program Design:
+    Usage example:
+        pool = dbConnPool.getPool(gv.DB_PATH)
+        rows = pool.fetchall("SELECT * FROM gatewayInfo")
+        with pool.getConnection() as conn:  # transaction
+            conn.executemany(query, rows)
+"""
+import time
+import sqlite3
+import threading
+
+import metrics
+
+BUSY_TIMEOUT = 5.0          # sec, sqlite wait time when the db is locked by other connection.
+BUSY_RETRY = 3              # retry times if the query still failed by 'database is locked'.
+BUSY_RETRY_DELAY = 0.1      # sec, delay before first retry, doubled for each retry.
+# Pragmas set on every new connection.
+PRAGMAS = (
+    # retention engine releases the pruned pages, only applied to a new db file 
+    # and must be set before WAL mode (existing file: dbRetention.py --vacuum).
+    ('auto_vacuum', 'INCREMENTAL'),
+    ('journal_mode', 'WAL'),    # readers not block the writer and vice versa.
+    ('synchronous', 'NORMAL'),  # safe under WAL mode, no fsync per commit.
+    ('cache_size', -16000),     # 16MB page cache (negative value means KiB).
+    ('mmap_size', 67108864),    # 64MB memory mapped IO.
+    ('temp_store', 'MEMORY'),
+)
+
+gLockRetries = metrics.counter('db_lock_retries_total', "Queries retried after 'database is locked'.")
+gLockWait = metrics.histogram('db_lock_retry_wait_seconds', "Time slept before the 'database is locked' retries.")
+gPools = {}                 # db path -> ConnectionPool
+gPoolsLock = threading.Lock()
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class ConnectionPool(object):
+    """ Keep one sqlite3 connection per thread for the database file."""
+    def __init__(self, dbPath, timeout=BUSY_TIMEOUT, pragmas=PRAGMAS):
+        self.dbPath = dbPath
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self.local = threading.local()
+        self.connections = []   # all the opened connections, used by closeAll().
+        self.lock = threading.Lock()
+
+#-----------------------------------------------------------------------------
+    def _connect(self):
+        """ Open a new connection and set the pragmas."""
+        conn = sqlite3.connect(self.dbPath, timeout=self.timeout, check_same_thread=False)
+        conn.execute('PRAGMA busy_timeout = %d' % int(self.timeout*1000))
+        for key, val in self.pragmas:
+            conn.execute('PRAGMA %s = %s' % (key, str(val)))
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+#-----------------------------------------------------------------------------
+    def getConnection(self):
+        """ Return the connection of the current thread, create one if not exist."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self._connect()
+        return conn
+
+#-----------------------------------------------------------------------------
+    def execute(self, query, params=()):
+        """ Execute the query with the current thread's connection and retry if the
+            database is locked. Returns the cursor.
+        """
+        delay = BUSY_RETRY_DELAY
+        for i in range(BUSY_RETRY + 1):
+            try:
+                return self.getConnection().execute(query, params)
+            except sqlite3.OperationalError as err:
+                if 'locked' not in str(err) or i == BUSY_RETRY: raise
+                gLockRetries.inc()
+                gLockWait.observe(delay)
+                time.sleep(delay)
+                delay *= 2
+
+#-----------------------------------------------------------------------------
+    def fetchall(self, query, params=()):
+        """ Execute the select query and return all the result rows."""
+        return self.execute(query, params).fetchall()
+
+#-----------------------------------------------------------------------------
+    def closeConnection(self):
+        """ Close the connection of the current thread."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None: return
+        self.local.conn = None
+        with self.lock:
+            if conn in self.connections: self.connections.remove(conn)
+        conn.close()
+
+#-----------------------------------------------------------------------------
+    def closeAll(self):
+        """ Close all the connections opened by the pool."""
+        with self.lock:
+            conns, self.connections = self.connections, []
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self.local = threading.local()
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def getPool(dbPath):
+    """ Return the shared connection pool of the database file."""
+    with gPoolsLock:
+        pool = gPools.get(dbPath)
+        if pool is None:
+            pool = gPools[dbPath] = ConnectionPool(dbPath)
+        return pool
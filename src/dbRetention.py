@@ -0,0 +1,195 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        dbRetention.py [python3]
+#
+# Purpose:     This module provides the background retention engine to keep the
+#              gatewayState history bounded: raw state rows older than the keep
+#              window are rolled up into per-gateway per-minute and per-hour
+#              aggregates then pruned, the aggregates are pruned after their own
+#              keep window and the free pages are released by incremental vacuum.
+#
+# Author:      Liu Yuancheng
+#
+# Version:     v_0.2
+# Created:     2021/12/22
+# Copyright:   Singtel Cyber Security Research & Development Laboratory
+# License:
+#-----------------------------------------------------------------------------
+""" Program Design:
+    All the deletes are done in small batches (one short write transaction per
+    batch) and the database runs under WAL mode, so the DataMgr readers are never
+    blocked and the ingest writer only waits for one batch at most. The newest
+    state row is never pruned so the gatewayState seq cursor keeps increasing.
+    The new database is created in incremental auto vacuum mode by dbSchema.migrate(),
+    an existing database file is converted offline (full VACUUM rewrites the file
+    under the write lock): stop the host/ingest programs then run
+        python3 dbRetention.py --db node_database.db --vacuum
+    Usage example:
+        retentionMgr = RetentionMgr(gv.DB_PATH, rawKeep=86400)
+        retentionMgr.start()
+"""
+import time
+import sqlite3
+import argparse
+import threading
+from sqlite3 import Error
+
+import Log
+import dbConnPool
+import dbSchema
+import globalVal as gv
+
+RAW_KEEP = 24*3600          # sec, time window to keep the raw state rows.
+MINUTE_KEEP = 7*24*3600     # sec, time window to keep the per-minute aggregates.
+HOUR_KEEP = 365*24*3600     # sec, time window to keep the per-hour aggregates.
+PRUNE_BATCH = 2000          # max rows deleted in one transaction.
+VACUUM_PAGES = 500          # max free pages released in one incremental vacuum.
+PERIOD = 60                 # sec, retention check interval.
+
+AGG_UPSERT = "INSERT INTO %s(id, bucket, cnt, inMin, inMax, inSum, outMin, outMax, outSum, actCnt) \
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id, bucket) DO UPDATE SET \
+    cnt = cnt + excluded.cnt, \
+    inMin = min(inMin, excluded.inMin), inMax = max(inMax, excluded.inMax), inSum = inSum + excluded.inSum, \
+    outMin = min(outMin, excluded.outMin), outMax = max(outMax, excluded.outMax), outSum = outSum + excluded.outSum, \
+    actCnt = actCnt + excluded.actCnt"
+# oldest raw rows out of the keep window, the newest row is always kept.
+RAW_EXPIRED_QUERY = "SELECT seq, time, id, throughputIn, throughputOut, actF FROM gatewayState \
+    WHERE time < ? AND seq < (SELECT MAX(seq) FROM gatewayState) ORDER BY seq LIMIT ?"
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class RetentionMgr(threading.Thread):
+    """ Retention engine thread to roll up, prune and vacuum the state history."""
+    def __init__(self, dbPath, rawKeep=RAW_KEEP, minuteKeep=MINUTE_KEEP, hourKeep=HOUR_KEEP,
+                 batchSize=PRUNE_BATCH, periodic=PERIOD):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dbPool = dbConnPool.getPool(dbPath)
+        self.rawKeep = rawKeep
+        self.aggKeep = {'minute': minuteKeep, 'hour': hourKeep}
+        self.batchSize = batchSize
+        self.periodic = periodic
+        self.terminate = False
+        self.stopEvent = threading.Event()
+
+#-----------------------------------------------------------------------------
+    @staticmethod
+    def _rollup(rows, bucketSec):
+        """ Aggregate the raw state rows into (id, bucket) upsert rows."""
+        aggDict = {}
+        for _, stateT, gwID, thrIn, thrOut, actF in rows:
+            key = (gwID, int(stateT//bucketSec)*bucketSec)
+            agg = aggDict.get(key)
+            if agg is None:
+                aggDict[key] = [1, thrIn, thrIn, thrIn, thrOut, thrOut, thrOut, 1 if actF else 0]
+                continue
+            agg[0] += 1
+            agg[1], agg[2], agg[3] = min(agg[1], thrIn), max(agg[2], thrIn), agg[3] + thrIn
+            agg[4], agg[5], agg[6] = min(agg[4], thrOut), max(agg[5], thrOut), agg[6] + thrOut
+            if actF: agg[7] += 1
+        return [key + tuple(agg) for key, agg in aggDict.items()]
+
+#-----------------------------------------------------------------------------
+    def pruneRawBatch(self, conn, cutoffT):
+        """ Roll up and delete one batch of expired raw state rows.
+            Returns: number of rows pruned.
+        """
+        with conn:
+            rows = conn.execute(RAW_EXPIRED_QUERY, (cutoffT, self.batchSize)).fetchall()
+            if not rows: return 0
+            for table, bucketSec in dbSchema.AGG_TABLES.values():
+                conn.executemany(AGG_UPSERT % table, self._rollup(rows, bucketSec))
+            seqList = [(row[0],) for row in rows]
+            conn.executemany('DELETE FROM gatewayComTo WHERE seq = ?', seqList)
+            conn.executemany('DELETE FROM gatewayState WHERE seq = ?', seqList)
+        return len(rows)
+
+#-----------------------------------------------------------------------------
+    def pruneAggBatch(self, conn, level, cutoffT):
+        """ Delete one batch of expired aggregate rows. Returns: number of rows pruned."""
+        table = dbSchema.AGG_TABLES[level][0]
+        with conn:
+            cursor = conn.execute('DELETE FROM %s WHERE (id, bucket) IN (SELECT id, bucket FROM %s \
+                WHERE bucket < ? LIMIT ?)' % (table, table), (int(cutoffT), self.batchSize))
+        return cursor.rowcount
+
+#-----------------------------------------------------------------------------
+    def runOnce(self, crtTime=None):
+        """ Run one retention cycle. Returns: dict of pruned rows number."""
+        crtTime = time.time() if crtTime is None else crtTime
+        conn = self.dbPool.getConnection()
+        result = {'raw': 0, 'minute': 0, 'hour': 0}
+        while not self.terminate:
+            count = self.pruneRawBatch(conn, crtTime - self.rawKeep)
+            result['raw'] += count
+            if count < self.batchSize: break
+            time.sleep(0) # yield to the other threads between batches.
+        for level, keepT in self.aggKeep.items():
+            while not self.terminate:
+                count = self.pruneAggBatch(conn, level, crtTime - keepT)
+                result[level] += count
+                if count < self.batchSize: break
+                time.sleep(0)
+        if any(result.values()):
+            conn.execute('PRAGMA incremental_vacuum(%d)' % VACUUM_PAGES).fetchall()
+            Log.info("RetentionMgr: pruned rows %s", str(result))
+        return result
+
+#-----------------------------------------------------------------------------
+    def run(self):
+        """ Thread run() function call by start(). """
+        try:
+            if self.dbPool.getConnection().execute('PRAGMA auto_vacuum').fetchone()[0] != dbSchema.AUTO_VACUUM_INCREMENTAL:
+                Log.warning("RetentionMgr: incremental vacuum is off, the pruned pages are not released "
+                            "(convert the db offline: python3 dbRetention.py --vacuum).")
+        except Error as err:
+            Log.warning("RetentionMgr: can not read the auto vacuum mode: %s", str(err))
+        while not self.terminate:
+            try:
+                self.runOnce()
+            except Error as err:
+                Log.error("RetentionMgr: retention cycle error: %s", str(err))
+            self.stopEvent.wait(self.periodic)
+        self.dbPool.closeConnection()
+
+#-----------------------------------------------------------------------------
+    def stop(self):
+        """ Stop the thread."""
+        self.terminate = True
+        self.stopEvent.set()
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def enableIncrementalVacuum(dbPath):
+    """ Convert an existing db file to incremental auto vacuum mode, the full VACUUM 
+        rewrites the whole file: run it offline when no other program uses the db.
+        Returns True if the file is converted, False if it is already incremental.
+    """
+    conn = sqlite3.connect(dbPath, timeout=dbConnPool.BUSY_TIMEOUT)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == dbSchema.AUTO_VACUUM_INCREMENTAL: return False
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        return True
+    finally:
+        conn.close()
+
+#-----------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='State history retention tools.')
+    parser.add_argument('--db', default=gv.DB_PATH, help='database file path.')
+    parser.add_argument('--vacuum', action='store_true', 
+                        help='convert the db file to incremental auto vacuum mode (offline, full VACUUM).')
+    args = parser.parse_args()
+    if args.vacuum:
+        startT = time.time()
+        if enableIncrementalVacuum(args.db):
+            print('> Converted %s to incremental auto vacuum in %.3f sec.' % (args.db, time.time() - startT))
+        else:
+            print('> %s is already in incremental auto vacuum mode.' % args.db)
+    else:
+        parser.print_help()
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        dbSchema.py [python3]
+#
+# Purpose:     This module defines the gateway database schema, the versioned
+#              schema migration and the gatewayState read/write helpers used by
+#              the map host, data fetcher and database creater.
+#
+# Author:      Liu Yuancheng
+#
+# Version:     v_0.2
+# Created:     2021/12/21
+# Copyright:   Singtel Cyber Security Research & Development Laboratory
+# License:
+#-----------------------------------------------------------------------------
+""" Program Design:
+    The schema version is saved in sqlite 'PRAGMA user_version':
+    - version 0: gatewayState(time float PRIMARY KEY, id text, updateInfo text(json))
+    - version 1: gatewayState rows use an integer monotonic sequence <seq> (the
+        table rowid) as cursor, integer gateway id and real metric columns. The
+        comTo list is saved in the side table gatewayComTo. Polling the new rows
+        by "seq > ?" is a rowid range scan, no json decoding needed.
+    - version 2: add the per-gateway per-minute/per-hour aggregate tables used 
+        by the retention engine (dbRetention.py) to roll up the old raw rows.
+    - version 3: add the explicit gateway adjacency table gatewayLink, the pairs
+        in this table are always shown as links on the map (never expire).
+    - version 4: add the inventory change counter gatewayInfoVersion, increased 
+        by triggers when gatewayInfo or gatewayLink rows are changed.
+    - version 5: add the latest state table gatewayLatest (one row per gateway),
+        upserted by insertStates() once per batch, the row's seq is its version 
+        so the changed gateways are read by "seq > ?" (see stateCache.py).
+    - version 6: add the gatewayState time index used by the link TTL pair query
+        fetchComPairs().
+    Call migrate(conn) after the connection is created, it is idempotent and will
+    convert the old version database file in place. A new database file is created
+    in incremental auto vacuum mode by the dbConnPool connection pragmas.
+"""
+import json
+import time
+import sqlite3
+
+import metrics
+
+SCHEMA_VERSION = 6
+AUTO_VACUUM_INCREMENTAL = 2 # 'PRAGMA auto_vacuum' value of the incremental mode.
+
+# state write path metrics (the writer's process exposes them at /metrics).
+gWriteLockWait = metrics.histogram('db_write_lock_wait_seconds', 'insertStates() wait time for the write lock.')
+gWriteTime = metrics.histogram('db_state_write_seconds', 'insertStates() transaction duration (lock wait excluded).')
+gRowsWritten = metrics.counter('db_state_rows_written_total', 'State records written by insertStates().')
+
+# gateway information table query.
+gwInfoTable = "CREATE TABLE IF NOT EXISTS gatewayInfo(id integer PRIMARY KEY,\
+                                                                name text NOT NULL,\
+                                                                ipAddr text NOT NULL,\
+                                                                lat float NOT NULL,\
+                                                                lng float NOT NULL,\
+                                                                actF integer NOT NULL,\
+                                                                rptTo integer NOT NULL,\
+                                                                type text NOT NULL)"
+# gateway current state table query.
+gwStateTable = "CREATE TABLE IF NOT EXISTS gatewayState(seq integer PRIMARY KEY,\
+                                                                 time real NOT NULL,\
+                                                                 id integer NOT NULL,\
+                                                                 throughputIn real NOT NULL,\
+                                                                 throughputOut real NOT NULL,\
+                                                                 actF integer NOT NULL)"
+# gateway state communication (key exchange) pair table query.
+gwComToTable = "CREATE TABLE IF NOT EXISTS gatewayComTo(seq integer NOT NULL,\
+                                                                 comTo integer NOT NULL,\
+                                                                 PRIMARY KEY(seq, comTo)) WITHOUT ROWID"
+# covering index for the per gateway history query, the seq cursor query uses the rowid.
+gwStateIndex = "CREATE INDEX IF NOT EXISTS gatewayState_id_seq ON gatewayState(id, seq)"
+# time range index (rowid seq included) for the recent state rows query.
+gwStateTimeIndex = "CREATE INDEX IF NOT EXISTS gatewayState_time ON gatewayState(time)"
+
+# gateway state aggregate table query, %s is the table name. Avg and active ratio
+# are calculated when reading: avg = sum/cnt, ratio = actCnt/cnt.
+gwAggTable = "CREATE TABLE IF NOT EXISTS %s(id integer NOT NULL,\
+                                                bucket integer NOT NULL,\
+                                                cnt integer NOT NULL,\
+                                                inMin real NOT NULL,\
+                                                inMax real NOT NULL,\
+                                                inSum real NOT NULL,\
+                                                outMin real NOT NULL,\
+                                                outMax real NOT NULL,\
+                                                outSum real NOT NULL,\
+                                                actCnt integer NOT NULL,\
+                                                PRIMARY KEY(id, bucket)) WITHOUT ROWID"
+AGG_TABLES = {'minute': ('gatewayStateMinute', 60), 'hour': ('gatewayStateHour', 3600)} # level -> (table, bucket sec)
+
+# explicit gateway adjacency table query, pair saved as id1 < id2.
+gwLinkTable = "CREATE TABLE IF NOT EXISTS gatewayLink(id1 integer NOT NULL,\
+                                                                id2 integer NOT NULL,\
+                                                                PRIMARY KEY(id1, id2)) WITHOUT ROWID"
+
+# inventory change counter table query, single row (id = 0).
+gwInfoVersionTable = "CREATE TABLE IF NOT EXISTS gatewayInfoVersion(id integer PRIMARY KEY CHECK(id = 0),\
+                                                                version integer NOT NULL)"
+gwInfoVersionTrigger = "CREATE TRIGGER IF NOT EXISTS %s_%s_version AFTER %s ON %s BEGIN \
+    UPDATE gatewayInfoVersion SET version = version + 1 WHERE id = 0; END"
+
+# latest state per gateway table query, comTo saved as json list text, seq is the row version.
+gwLatestTable = "CREATE TABLE IF NOT EXISTS gatewayLatest(id integer PRIMARY KEY,\
+                                                                seq integer NOT NULL,\
+                                                                time real NOT NULL,\
+                                                                throughputIn real NOT NULL,\
+                                                                throughputOut real NOT NULL,\
+                                                                actF integer NOT NULL,\
+                                                                comTo text NOT NULL)"
+gwLatestIndex = "CREATE INDEX IF NOT EXISTS gatewayLatest_seq ON gatewayLatest(seq)"
+gwLatestUpsert = "INSERT INTO gatewayLatest(id, seq, time, throughputIn, throughputOut, actF, comTo) \
+    VALUES(?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET seq = excluded.seq, time = excluded.time, \
+    throughputIn = excluded.throughputIn, throughputOut = excluded.throughputOut, actF = excluded.actF, \
+    comTo = excluded.comTo WHERE excluded.time >= gatewayLatest.time"
+gwLatestQuery = "SELECT seq, time, id, throughputIn, throughputOut, actF, comTo FROM gatewayLatest \
+    WHERE seq > ? ORDER BY seq"
+
+gwStateInsert = "INSERT INTO gatewayState(seq, time, id, throughputIn, throughputOut, actF) VALUES(?, ?, ?, ?, ?, ?)"
+gwComToInsert = "INSERT INTO gatewayComTo(seq, comTo) VALUES(?, ?)"
+gwStateQuery = "SELECT seq, time, id, throughputIn, throughputOut, actF FROM gatewayState WHERE seq > ? ORDER BY seq"
+gwComToQuery = "SELECT seq, comTo FROM gatewayComTo WHERE seq > ? AND seq <= ? ORDER BY seq"
+
+#-----------------------------------------------------------------------------
+def getVersion(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+#-----------------------------------------------------------------------------
+def _getColumns(conn, table):
+    return [row[1] for row in conn.execute('PRAGMA table_info(%s)' % table)]
+
+#-----------------------------------------------------------------------------
+def _migrateV1(conn):
+    """ Convert the version 0 gatewayState table (json updateInfo) to version 1."""
+    if 'updateInfo' in _getColumns(conn, 'gatewayState'):
+        conn.execute('ALTER TABLE gatewayState RENAME TO gatewayState_v0')
+    conn.execute(gwStateTable)
+    conn.execute(gwComToTable)
+    conn.execute(gwStateIndex)
+    if 'gatewayState_v0' not in [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'")]: return
+    stateRows, comToRows = [], []
+    for seq, (stateT, gwID, infoStr) in enumerate(conn.execute(
+            'SELECT time, id, updateInfo FROM gatewayState_v0 ORDER BY time'), start=1):
+        info = json.loads(infoStr)
+        stateRows.append((seq, stateT, int(gwID), info['throughputIn'], info['throughputOut'], info['actF']))
+        comToRows.extend((seq, int(pairID)) for pairID in set(info['comTo']))
+    conn.executemany(gwStateInsert, stateRows)
+    conn.executemany(gwComToInsert, comToRows)
+    conn.execute('DROP TABLE gatewayState_v0')
+
+#-----------------------------------------------------------------------------
+def _migrateV2(conn):
+    """ Add the state aggregate tables."""
+    for table, _ in AGG_TABLES.values():
+        conn.execute(gwAggTable % table)
+        conn.execute('CREATE INDEX IF NOT EXISTS %s_bucket ON %s(bucket)' % (table, table))
+
+#-----------------------------------------------------------------------------
+def _migrateV3(conn):
+    """ Add the explicit gateway adjacency table."""
+    conn.execute(gwLinkTable)
+
+#-----------------------------------------------------------------------------
+def _migrateV4(conn):
+    """ Add the inventory change counter and its triggers."""
+    conn.execute(gwInfoTable)
+    conn.execute(gwInfoVersionTable)
+    conn.execute('INSERT OR IGNORE INTO gatewayInfoVersion(id, version) VALUES(0, 0)')
+    for table in ('gatewayInfo', 'gatewayLink'):
+        for action in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(gwInfoVersionTrigger % (table, action.lower(), action, table))
+
+#-----------------------------------------------------------------------------
+def _migrateV5(conn):
+    """ Add the latest state table, filled with each gateway's last state record."""
+    conn.execute(gwLatestTable)
+    conn.execute(gwLatestIndex)
+    rows = conn.execute('SELECT s.seq, s.time, s.id, s.throughputIn, s.throughputOut, s.actF FROM gatewayState s \
+        JOIN (SELECT id, MAX(seq) AS seq FROM gatewayState GROUP BY id) m ON s.seq = m.seq').fetchall()
+    comToDict = {}
+    for seq, pairID in conn.execute('SELECT seq, comTo FROM gatewayComTo WHERE seq IN \
+            (SELECT MAX(seq) FROM gatewayState GROUP BY id) ORDER BY seq, comTo'):
+        comToDict.setdefault(seq, []).append(pairID)
+    conn.executemany(gwLatestUpsert, [(gwID, seq, stateT, thrIn, thrOut, actF, json.dumps(comToDict.get(seq, [])))
+                                      for (seq, stateT, gwID, thrIn, thrOut, actF) in rows])
+
+#-----------------------------------------------------------------------------
+def _migrateV6(conn):
+    """ Add the gatewayState time index."""
+    conn.execute(gwStateTimeIndex)
+
+MIGRATIONS = {1: _migrateV1, 2: _migrateV2, 3: _migrateV3, 4: _migrateV4, 5: _migrateV5,
+              6: _migrateV6} # target version -> migration function.
+
+#-----------------------------------------------------------------------------
+def migrate(conn):
+    """ Create the state tables or upgrade them to SCHEMA_VERSION in one write
+        transaction. Returns the schema version.
+    """
+    if getVersion(conn) >= SCHEMA_VERSION: return SCHEMA_VERSION
+    isoLevel = conn.isolation_level
+    conn.isolation_level = None     # manage the transaction manually.
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = getVersion(conn) # check again, other process may have done it.
+            for target in range(version+1, SCHEMA_VERSION+1):
+                MIGRATIONS[target](conn)
+            conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.isolation_level = isoLevel
+    return SCHEMA_VERSION
+
+#-----------------------------------------------------------------------------
+def insertStates(conn, states):
+    """ Insert the gateway state records in one transaction.
+    Args:
+        conn ([sqlite3.Connection]): database connection.
+        states ([list]): list of (time, gatewayID, infoDict) tuple, infoDict example:
+            {"comTo": [2], "throughputIn": 0, "throughputOut": 0, "actF": 0}
+    Returns:
+        [int]: the seq of the last inserted row.
+    Raises:
+        sqlite3.ProgrammingError: the connection has an open transaction (commit 
+            or roll back the caller's own transaction first).
+    """
+    if conn.in_transaction: raise sqlite3.ProgrammingError('insertStates: the connection has an open transaction.')
+    startT = time.perf_counter()
+    conn.execute('BEGIN IMMEDIATE') # lock before reading the max seq.
+    lockT = time.perf_counter()
+    gWriteLockWait.observe(lockT - startT)
+    try:
+        # the pruned raw rows never make the seq (latest state version) go back.
+        seq = conn.execute('SELECT MAX(IFNULL((SELECT MAX(seq) FROM gatewayState), 0), \
+            IFNULL((SELECT MAX(seq) FROM gatewayLatest), 0))').fetchone()[0]
+        stateRows, comToRows, latestRows = [], [], {}
+        for stateT, gwID, info in states:
+            seq += 1
+            gwID, comTo = int(gwID), sorted(set(int(pairID) for pairID in info['comTo']))
+            stateRows.append((seq, stateT, gwID, info['throughputIn'], info['throughputOut'], info['actF']))
+            comToRows.extend((seq, pairID) for pairID in comTo)
+            if gwID in latestRows and stateT < latestRows[gwID][2]: continue # older report in the batch.
+            latestRows[gwID] = (gwID, seq, stateT, info['throughputIn'], info['throughputOut'], info['actF'],
+                                json.dumps(comTo))
+        conn.executemany(gwStateInsert, stateRows)
+        conn.executemany(gwComToInsert, comToRows)
+        # the latest state table is updated once per batch (newest record of each gateway),
+        # a late report older than the saved state does not replace it (upsert WHERE clause).
+        conn.executemany(gwLatestUpsert, latestRows.values())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    gWriteTime.observe(time.perf_counter() - lockT)
+    gRowsWritten.inc(len(stateRows))
+    return seq
+
+#-----------------------------------------------------------------------------
+def fetchStates(conn, sinceSeq=0, limit=None):
+    """ Fetch the gateway state records whose seq > sinceSeq.
+    Args:
+        limit ([int], optional): max number of records to fetch. Defaults to None (no limit).
+    Returns:
+        [list]: list of (seq, time, gatewayID, infoDict) tuple under seq order.
+    """
+    if limit is None:
+        rows = conn.execute(gwStateQuery, (sinceSeq,)).fetchall()
+    else:
+        rows = conn.execute(gwStateQuery + ' LIMIT ?', (sinceSeq, limit)).fetchall()
+    if not rows: return []
+    comToDict = {}
+    for seq, pairID in conn.execute(gwComToQuery, (sinceSeq, rows[-1][0])):
+        comToDict.setdefault(seq, []).append(pairID)
+    return [(seq, stateT, gwID, {'comTo': comToDict.get(seq, []),
+                                 'throughputIn': thrIn,
+                                 'throughputOut': thrOut,
+                                 'actF': actF}) for (seq, stateT, gwID, thrIn, thrOut, actF) in rows]
+
+#-----------------------------------------------------------------------------
+def fetchLatest(conn, sinceSeq=0):
+    """ Fetch the latest state of the gateways changed after <sinceSeq>.
+    Returns:
+        [list]: list of (seq, time, gatewayID, infoDict) tuple under seq order
+            (same as fetchStates()), one record per gateway.
+    """
+    return [(seq, stateT, gwID, {'comTo': json.loads(comTo),
+                                 'throughputIn': thrIn,
+                                 'throughputOut': thrOut,
+                                 'actF': actF})
+            for (seq, stateT, gwID, thrIn, thrOut, actF, comTo) in conn.execute(gwLatestQuery, (sinceSeq,))]
+
+#-----------------------------------------------------------------------------
+def fetchAggregates(conn, gatewayID, level='minute', sinceT=0):
+    """ Fetch the gateway state aggregate records.
+    Args:
+        gatewayID ([int]): gateway ID.
+        level ([str]): 'minute' or 'hour'.
+        sinceT ([float]): only return the buckets start from this time.
+    Returns:
+        [list]: list of dict, example: {'time': 1639468800, 'cnt': 12, 'throughputIn': (min, max, avg), 
+            'throughputOut': (min, max, avg), 'actRatio': 0.75}
+    """
+    table = AGG_TABLES[level][0]
+    rows = conn.execute('SELECT bucket, cnt, inMin, inMax, inSum, outMin, outMax, outSum, actCnt FROM %s \
+        WHERE id = ? AND bucket >= ? ORDER BY bucket' % table, (int(gatewayID), int(sinceT))).fetchall()
+    return [{'time': bucket, 'cnt': cnt,
+             'throughputIn': (inMin, inMax, inSum/cnt),
+             'throughputOut': (outMin, outMax, outSum/cnt),
+             'actRatio': actCnt/cnt} for (bucket, cnt, inMin, inMax, inSum, outMin, outMax, outSum, actCnt) in rows]
+
+#-----------------------------------------------------------------------------
+def getInfoVersion(conn):
+    """ Return the inventory (gatewayInfo/gatewayLink) change counter."""
+    return conn.execute('SELECT version FROM gatewayInfoVersion WHERE id = 0').fetchone()[0]
+
+#-----------------------------------------------------------------------------
+def fetchLinkPairs(conn):
+    """ Return the explicit adjacency pairs list [(id1, id2), ...] of gatewayLink table."""
+    return conn.execute('SELECT id1, id2 FROM gatewayLink').fetchall()
+
+#-----------------------------------------------------------------------------
+def fetchComPairs(conn, sinceT=0):
+    """ Return the set of (id1, id2) (id1 < id2) gateway pairs observed in the 
+        gatewayState comTo records with time > sinceT.
+    """
+    # the planner prefers the (id, seq) index for DISTINCT, which scans the whole table.
+    rows = conn.execute('SELECT DISTINCT s.id, c.comTo FROM gatewayState s INDEXED BY gatewayState_time \
+        JOIN gatewayComTo c ON c.seq = s.seq WHERE s.time > ?', (sinceT,)).fetchall()
+    return {(min(id1, id2), max(id1, id2)) for (id1, id2) in rows if id1 != id2}
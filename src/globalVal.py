@@ -43,15 +43,19 @@ HB_IB_LK = '../static/images/hub.jpg'
 
 CH_GPS = (1.2988469, 103.8360123) # control hub gps location currently we use Singtel Comcenter POS.
 
+LINK_TTL = 300  # sec, a gateway pair link expires if the pair is not seen in the state records within this time.
+
 #-------<GLOBAL VARIABLES (start with "g")>------------------------------------
 # VARIABLES are the built in data type.
 gPeriod = 10
 gMapFilter = ['show-inactive', 'show-gateway', 'show-control']
 gMapSetting = [1, 1, 1] # Inactive, gateway, control hub communications respectively
 gDevNode = []   
-gLatestTime = 0.0
+gLatestSeq = 0  # gatewayState seq of the latest record returned by the shared /updates cursor.
 
 #-------<GLOBAL INSTANCES (start with "i")>-----------------------------------------------------
 # INSTANCES are the object. 
 iDataMgr = None
+iRetentionMgr = None
+iMarkerView = None  # read only markers view of the web worker process.
 iSocketIO = None
\ No newline at end of file
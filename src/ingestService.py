@@ -0,0 +1,460 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        ingestService.py [python3]
+#
+# Purpose:     This module provides the multi-process gateway state ingest service
+#              (the service mode front-end of databaseCreater): it accepts the
+#              gateway state reports over HTTP or a local socket, parses and
+#              validates them in parallel worker processes and writes them to the
+#              database by one writer process in batched transactions.
+#
+# Author:      Liu Yuancheng
+#
+# Version:     v_0.2
+# Created:     2022/01/07
+# Copyright:   Singtel Cyber Security Research & Development Laboratory
+# License:
+#-----------------------------------------------------------------------------
+""" Program Design:
+    front-end threads --rawQueue--> N parse worker processes --rowQueue--> 1 writer process
+    - front-end: HTTP 'POST /report' (rejected by 503 if the raw queue is still full
+        after PUT_TIMEOUT sec) and a TCP/UNIX line socket (the reader blocks when the
+        queue is full, so the sender is slowed down by the TCP flow control).
+    - both queues are bounded (QUEUE_SIZE chunks), a burst can not exhaust the memory.
+    - the writer drains all the queued row batches (max BATCH_SIZE rows) into one
+        transaction, so the batch grows with the load (group commit).
+    - ingest lag: commit time - receive time of the oldest report in the batch.
+    - the writer counts the rows taken from the row queue as 'inflight' until they
+        are written or dropped, if the writer process dies they are counted as
+        dropped when it is restarted. A writer killed while waiting in get() leaves
+        the queue's read lock held, the watcher releases it for the new writer (a
+        writer killed in the middle of reading a chunk may still leave a partial
+        chunk in the pipe, restart the service if the new writer can not read).
+    Report record format (HTTP body: a record, a json list of records or json lines;
+    socket: json lines):
+        {"id": 3, "info": {"comTo": [2], "throughputIn": 1.2, "throughputOut": 1.0, "actF": 1}}
+        {"3": {"comTo": [2], "throughputIn": 1.2, "throughputOut": 1.0, "actF": 1}}
+    The optional "time" field of the first format sets the state time stamp, the
+    receive time is used if not set.
+    Usage:
+        python3 ingestService.py [--db path] [--http-port 5010] [--sock-port 5011] [--workers 2]
+        curl -d '{"id": 1, "info": {...}}' http://127.0.0.1:5010/report
+        curl http://127.0.0.1:5010/stats
+"""
+import os
+import json
+import math
+import time
+import queue
+import socket
+import sqlite3
+import argparse
+import threading
+import socketserver
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import globalVal as gv
+import dbConnPool
+import dbSchema
+import metrics
+
+HOST_IP = '127.0.0.1'
+HTTP_PORT = 5010        # HTTP front-end port.
+SOCK_PORT = 5011        # json lines TCP socket front-end port.
+PARSE_WORKERS = 2       # number of parse worker processes.
+QUEUE_SIZE = 1000       # max number of chunks in each of the raw and row queues.
+BATCH_SIZE = 5000       # max number of rows written in one transaction.
+MAX_BODY = 4194304      # max HTTP body / socket line size (bytes).
+PUT_TIMEOUT = 1.0       # sec, HTTP request wait time for the raw queue space.
+SOCK_BUF = 65536        # socket recv() buffer size.
+WRITE_RETRY = 3         # retry times of a failed batch transaction.
+WRITE_RETRY_DELAY = 0.2 # sec, delay before the first retry, doubled for each retry.
+WRITER_CHECK_INTV = 1.0 # sec, interval to check (and restart) the writer process.
+MAX_ID = 2**63 - 1      # max gateway ID (sqlite signed 64-bit integer).
+
+# shared stats fields, updated by all the processes.
+STAT_FIELDS = ('chunks', 'rejected', 'rows', 'invalid', 'written', 'dropped', 'inflight', 'batches',
+               'lag', 'maxLag', 'lastWriteT', 'writerRestarts')
+STAT_IDX = {name: idx for idx, name in enumerate(STAT_FIELDS)}
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class IngestStats(object):
+    """ Ingest counters in shared memory, can be passed to the worker processes."""
+    def __init__(self):
+        self.values = multiprocessing.Array('d', len(STAT_FIELDS))
+
+    def add(self, **kwargs):
+        with self.values.get_lock():
+            for name, val in kwargs.items(): self.values[STAT_IDX[name]] += val
+
+    def set(self, **kwargs):
+        with self.values.get_lock():
+            for name, val in kwargs.items(): self.values[STAT_IDX[name]] = val
+
+    def get(self, name):
+        return self.values[STAT_IDX[name]]
+
+    def getReport(self):
+        with self.values.get_lock():
+            return {name: self.values[idx] for idx, name in enumerate(STAT_FIELDS)}
+
+#-----------------------------------------------------------------------------
+def validateState(record, recvT):
+    """ Validate the report record and convert it to a dbSchema.insertStates() row.
+        Raises ValueError if the record is invalid.
+    Returns:
+        [tuple]: (time, gatewayID, infoDict)
+    """
+    if not isinstance(record, dict): raise ValueError('record is not a json object')
+    if 'id' in record:
+        gwID, info, stateT = record['id'], record.get('info'), record.get('time', recvT)
+    elif len(record) == 1:
+        (gwID, info), = record.items()
+        stateT = recvT
+    else:
+        raise ValueError('missing gateway id')
+    if not isinstance(info, dict): raise ValueError('missing state info')
+    try:
+        gwID, stateT = int(gwID), float(stateT)
+        comTo = [int(pairID) for pairID in info.get('comTo', ())]
+        thrIn, thrOut = float(info['throughputIn']), float(info['throughputOut'])
+        actF = int(info['actF'])
+    except KeyError as err:
+        raise ValueError('missing field %s' % str(err))
+    except (TypeError, OverflowError) as err:
+        raise ValueError(str(err))
+    if not 0 <= gwID <= MAX_ID: raise ValueError('gateway id out of range')
+    if any(not 0 <= pairID <= MAX_ID for pairID in comTo): raise ValueError('comTo id out of range')
+    if not math.isfinite(stateT): raise ValueError('invalid time')
+    if not (math.isfinite(thrIn) and math.isfinite(thrOut) and thrIn >= 0 and thrOut >= 0):
+        raise ValueError('invalid throughput')
+    if actF not in (0, 1): raise ValueError('invalid actF %s' % actF)
+    return (stateT, gwID, {'comTo': comTo, 'throughputIn': thrIn, 'throughputOut': thrOut, 'actF': actF})
+
+#-----------------------------------------------------------------------------
+def parseReports(data, recvT):
+    """ Parse the raw report chunk (a json record, a json list or json lines).
+    Returns:
+        [tuple]: (list of the valid rows, number of the invalid records)
+    """
+    text = data.decode('utf-8', 'replace') if isinstance(data, bytes) else data
+    try:
+        records = json.loads(text)
+        records = records if isinstance(records, list) else [records]
+    except ValueError:
+        records = []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line: continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                records.append(None)
+    rows, invalid = [], 0
+    for record in records:
+        try:
+            rows.append(validateState(record, recvT))
+        except ValueError:
+            invalid += 1
+    return rows, invalid
+
+#-----------------------------------------------------------------------------
+def parseWorker(rawQueue, rowQueue, stats):
+    """ Parse worker process: raw chunk -> validated rows."""
+    while True:
+        item = rawQueue.get()
+        if item is None: break
+        recvT, data = item
+        rows, invalid = parseReports(data, recvT)
+        stats.add(rows=len(rows), invalid=invalid)
+        if rows: rowQueue.put((recvT, rows)) # blocks when the writer is behind.
+
+#-----------------------------------------------------------------------------
+def _writeBatch(conn, rows, recvT, stats):
+    """ Write the rows in one transaction, retry if the database is locked. A batch 
+        which still fails (or can not be written) is dropped, the writer keeps running.
+    """
+    # reports of one gateway may be parsed by different workers, keep them in time order.
+    rows.sort(key=lambda row: row[0])
+    delay = WRITE_RETRY_DELAY
+    for i in range(WRITE_RETRY + 1):
+        try:
+            dbSchema.insertStates(conn, rows)
+            break
+        except (sqlite3.Error, OverflowError, ValueError) as err:
+            if i == WRITE_RETRY or not isinstance(err, sqlite3.OperationalError):
+                print("ingestService: batch of %d rows dropped: %s" % (len(rows), str(err)))
+                if conn.in_transaction: conn.rollback()
+                stats.add(dropped=len(rows), inflight=-len(rows))
+                return
+            time.sleep(delay)
+            delay *= 2
+    crtT = time.time()
+    lag = crtT - recvT
+    with stats.values.get_lock():
+        stats.values[STAT_IDX['written']] += len(rows)
+        stats.values[STAT_IDX['inflight']] -= len(rows)
+        stats.values[STAT_IDX['batches']] += 1
+        stats.values[STAT_IDX['lag']] = lag
+        stats.values[STAT_IDX['maxLag']] = max(lag, stats.values[STAT_IDX['maxLag']])
+        stats.values[STAT_IDX['lastWriteT']] = crtT
+
+def writeWorker(dbPath, rowQueue, stats, batchSize=BATCH_SIZE):
+    """ Writer process: drain the queued row batches into batched transactions."""
+    # open its own connection, the shared pool's connections may be inherited from 
+    # the parent process by fork and must not be used here.
+    conn = dbConnPool.ConnectionPool(dbPath).getConnection()
+    dbSchema.migrate(conn)
+    stopFlg = False
+    while not stopFlg:
+        item = rowQueue.get()
+        if item is None: break
+        recvT, rows = item
+        stats.add(inflight=len(rows))   # acknowledged by _writeBatch().
+        while len(rows) < batchSize:
+            try:
+                item = rowQueue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                stopFlg = True
+                break
+            recvT = min(recvT, item[0])
+            rows.extend(item[1])
+            stats.add(inflight=len(item[1]))
+        _writeBatch(conn, rows, recvT, stats)
+    conn.close()
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class _HttpHandler(BaseHTTPRequestHandler):
+    """ POST /report, GET /stats, GET /metrics"""
+    def _reply(self, code, body, contentType='application/json', headers=()):
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for key, val in headers: self.send_header(key, val)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.split('?')[0] != '/report': return self._reply(404, '{"error": "not found"}')
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length <= 0: return self._reply(411, '{"error": "Content-Length required"}')
+        if length > MAX_BODY: return self._reply(413, '{"error": "body too large"}')
+        body = self.rfile.read(length)
+        if not self.server.service.submit(body, timeout=PUT_TIMEOUT):
+            return self._reply(503, '{"error": "ingest queue full"}', headers=(('Retry-After', '1'),))
+        self._reply(202, '{"accepted": true}')
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/stats': return self._reply(200, json.dumps(self.server.service.getReport()))
+        if path == '/metrics': return self._reply(200, metrics.render(), contentType=metrics.CONTENT_TYPE)
+        self._reply(404, '{"error": "not found"}')
+
+    def log_message(self, *args):
+        pass
+
+#-----------------------------------------------------------------------------
+class _SocketHandler(socketserver.BaseRequestHandler):
+    """ Read the json lines, each recv() of complete lines is one chunk."""
+    def handle(self):
+        service, tail = self.server.service, b''
+        while True:
+            data = self.request.recv(SOCK_BUF)
+            if not data: break
+            data = tail + data
+            idx = data.rfind(b'\n')
+            if idx < 0:
+                if len(data) > MAX_BODY: return # line too long, close the connection.
+                tail = data
+                continue
+            tail = data[idx+1:]
+            service.submit(data[:idx+1], timeout=None)
+        if tail.strip(): service.submit(tail, timeout=None)
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class IngestService(object):
+    """ Gateway state ingest service: front-end servers, parse worker processes
+        and the single writer process.
+    """
+    def __init__(self, dbPath=gv.DB_PATH, workerNum=PARSE_WORKERS, queueSize=QUEUE_SIZE, batchSize=BATCH_SIZE):
+        self.dbPath = dbPath
+        self.rawQueue = multiprocessing.Queue(queueSize)
+        self.rowQueue = multiprocessing.Queue(queueSize)
+        self.stats = IngestStats()
+        self.parsers = [multiprocessing.Process(target=parseWorker, args=(self.rawQueue, self.rowQueue, self.stats),
+                                                name='ingestParser%d' % i, daemon=True) for i in range(workerNum)]
+        self.batchSize = batchSize
+        self.writer = self._newWriter()
+        self.stopFlg = False
+        self.servers = []
+        self.startT = time.time()
+        rowGauge = metrics.gauge('ingest_service_rows', 'Ingest service records number by stage.', labelNames=('stage',))
+        for name in ('rows', 'invalid', 'written', 'dropped'):
+            rowGauge.labels(name).setFunction(lambda name=name: self.stats.get(name))
+        metrics.gauge('ingest_service_rejected', 'HTTP reports rejected by the full queue.').setFunction(
+            lambda: self.stats.get('rejected'))
+        metrics.gauge('ingest_service_lag_seconds', 'Last batch commit time - oldest report receive time.').setFunction(
+            lambda: self.stats.get('lag'))
+        queueGauge = metrics.gauge('ingest_service_queue_chunks', 'Chunks waiting in the queues.', labelNames=('queue',))
+        queueGauge.labels('raw').setFunction(lambda: _qsize(self.rawQueue))
+        queueGauge.labels('row').setFunction(lambda: _qsize(self.rowQueue))
+        metrics.gauge('ingest_service_writer_up', 'Ingest writer process is alive.').setFunction(
+            lambda: int(self.writer.is_alive()))
+
+#-----------------------------------------------------------------------------
+    def _newWriter(self):
+        return multiprocessing.Process(target=writeWorker, args=(self.dbPath, self.rowQueue, self.stats, self.batchSize),
+                                       name='ingestWriter', daemon=True)
+
+#-----------------------------------------------------------------------------
+    def start(self):
+        """ Start the writer and the parse worker processes."""
+        pool = dbConnPool.getPool(self.dbPath)
+        dbSchema.migrate(pool.getConnection())
+        pool.closeConnection()  # not carry the open connection into the forked workers.
+        self.writer.start()
+        for parser in self.parsers: parser.start()
+        threading.Thread(target=self._watchWriter, name='ingestWriterWatch', daemon=True).start()
+
+#-----------------------------------------------------------------------------
+    def _watchWriter(self):
+        """ Restart the writer process if it exits unexpectedly, the rows it had
+            taken from the row queue are counted as dropped.
+        """
+        while not self.stopFlg:
+            time.sleep(WRITER_CHECK_INTV)
+            if self.stopFlg or self.writer.is_alive(): continue
+            with self.stats.values.get_lock():
+                lost = self.stats.values[STAT_IDX['inflight']]
+                self.stats.values[STAT_IDX['dropped']] += lost
+                self.stats.values[STAT_IDX['inflight']] = 0
+            print("ingestService: writer exited (code %s), %d rows lost, restart it." % (str(self.writer.exitcode), lost))
+            # the writer is the only reader of the row queue: if the read lock can not
+            # be taken the dead writer was holding it (killed in get()), release it.
+            readLock = self.rowQueue._rlock
+            if not readLock.acquire(block=False):
+                print("ingestService: release the row queue read lock held by the dead writer.")
+            readLock.release()
+            self.stats.add(writerRestarts=1)
+            self.writer = self._newWriter()
+            self.writer.start()
+
+#-----------------------------------------------------------------------------
+    def submit(self, data, timeout=PUT_TIMEOUT):
+        """ Queue a raw report chunk (bytes), wait max <timeout> sec (None: no limit)
+            for the queue space. Returns False if the queue is still full.
+        """
+        try:
+            self.rawQueue.put((time.time(), data), timeout=timeout)
+        except queue.Full:
+            self.stats.add(rejected=1)
+            return False
+        self.stats.add(chunks=1)
+        return True
+
+#-----------------------------------------------------------------------------
+    def _serve(self, server):
+        server.service = self
+        threading.Thread(target=server.serve_forever, name='ingestFrontEnd', daemon=True).start()
+        self.servers.append(server)
+        return server
+
+    def serveHttp(self, port=HTTP_PORT, host=HOST_IP):
+        """ Start the HTTP front-end (port 0: any free port), returns the server."""
+        return self._serve(ThreadingHTTPServer((host, port), _HttpHandler))
+
+    def serveSocket(self, port=SOCK_PORT, host=HOST_IP, unixPath=None):
+        """ Start the json lines TCP (or UNIX socket if <unixPath>) front-end."""
+        if unixPath:
+            if os.path.exists(unixPath): os.remove(unixPath)
+            return self._serve(_UnixServer(unixPath, _SocketHandler))
+        return self._serve(_TCPServer((host, port), _SocketHandler))
+
+#-----------------------------------------------------------------------------
+    def getReport(self):
+        """ Return the ingest stats report dict, 'pending': rows parsed but not
+            written yet ('inflight': taken by the writer), 'lag': last batch ingest
+            lag (sec), 'writerAlive': writer process health ('writerRestarts': times
+            the writer was restarted).
+        """
+        report = self.stats.getReport()
+        report.update({'rawQueue': _qsize(self.rawQueue),
+                       'rowQueue': _qsize(self.rowQueue),
+                       'writerAlive': self.writer.is_alive(),
+                       'pending': report['rows'] - report['written'] - report['dropped'],
+                       'uptime': time.time() - self.startT})
+        return report
+
+#-----------------------------------------------------------------------------
+    def stop(self, timeout=10):
+        """ Stop the front-ends, write all the queued reports, then stop the workers."""
+        self.stopFlg = True
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+        for _ in self.parsers: self.rawQueue.put(None)
+        for parser in self.parsers: parser.join(timeout)
+        self.rowQueue.put(None)
+        self.writer.join(timeout)
+
+#-----------------------------------------------------------------------------
+def _qsize(workQueue):
+    try:
+        return workQueue.qsize()
+    except NotImplementedError: # macOS
+        return -1
+
+#-----------------------------------------------------------------------------
+def sendReports(records, port=SOCK_PORT, host=HOST_IP):
+    """ Send the report records (list of dict) to the ingest service socket."""
+    with socket.create_connection((host, port)) as sock:
+        sock.sendall(''.join(json.dumps(record) + '\n' for record in records).encode('utf-8'))
+
+#-----------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='Gateway state ingest service.')
+    parser.add_argument('--db', default=gv.DB_PATH, help='database file path.')
+    parser.add_argument('--host', default=HOST_IP)
+    parser.add_argument('--http-port', type=int, default=HTTP_PORT, help='HTTP port, 0: disabled.')
+    parser.add_argument('--sock-port', type=int, default=SOCK_PORT, help='json lines TCP port, 0: disabled.')
+    parser.add_argument('--unix', help='json lines UNIX socket path (instead of the TCP port).')
+    parser.add_argument('--workers', type=int, default=PARSE_WORKERS, help='parse worker processes number.')
+    parser.add_argument('--queue', type=int, default=QUEUE_SIZE, help='max queued chunks.')
+    args = parser.parse_args()
+    service = IngestService(dbPath=args.db, workerNum=args.workers, queueSize=args.queue)
+    service.start()
+    if args.http_port: service.serveHttp(args.http_port, host=args.host)
+    if args.unix or args.sock_port: service.serveSocket(args.sock_port, host=args.host, unixPath=args.unix)
+    print("> Ingest service started (HTTP: %s, socket: %s)" % (args.http_port, args.unix or args.sock_port))
+    try:
+        while True:
+            time.sleep(10)
+            report = service.getReport()
+            print("> written %(written)d, invalid %(invalid)d, rejected %(rejected)d, pending %(pending)d, "
+                  "lag %(lag).3f sec" % report)
+    except KeyboardInterrupt:
+        service.stop()
+        print("> Ingest service stopped: %s" % json.dumps(service.getReport()))
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
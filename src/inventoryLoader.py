@@ -0,0 +1,196 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        inventoryLoader.py [python3]
+#
+# Purpose:     This module provides the bulk gateway inventory loader (API and
+#              command line tool) to validate the gateway/control hub records
+#              from NodesRcd.txt, CSV or JSON Lines file and upsert them into
+#              the gatewayInfo table in one transaction.
+#
+# Author:      Liu Yuancheng
+#
+# Version:     v_0.2
+# Created:     2022/01/04
+# Copyright:   Singtel Cyber Security Research & Development Laboratory
+# License:
+#-----------------------------------------------------------------------------
+""" Program Design:
+    The input file is read record by record (never loaded in memory as a whole),
+    each record is validated and converted to a gatewayInfo row, the rows are
+    streamed to one executemany() UPSERT. The UPSERT only writes the rows whose
+    value changed, so re-importing an unchanged file writes nothing (and does not
+    trigger the map host's inventory hot reload).
+    Input record fields (CSV header / json keys):
+        no, name, ipAddr, lat, lng, type ('GW'/'HB'), rptTo, actF
+    Usage example:
+        python3 inventoryLoader.py NodesRcd.txt
+        python3 inventoryLoader.py sites.csv --db node_database.db --prune
+"""
+import os
+import csv
+import json
+import time
+import argparse
+import ipaddress
+
+import ConfigLoader as cl
+import dbConnPool
+import dbSchema
+import globalVal as gv
+
+NODE_TYPES = ('GW', 'HB')       # gateway, control hub.
+FIELDS = ('no', 'name', 'ipAddr', 'lat', 'lng', 'actF', 'rptTo', 'type') # gatewayInfo column order.
+MAX_ERRORS = 100                # max number of invalid record messages kept in the report.
+
+# insert the new nodes, update the existing nodes only if any value changed.
+gwInfoUpsert = "INSERT INTO gatewayInfo(id, name, ipAddr, lat, lng, actF, rptTo, type) \
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET \
+    name = excluded.name, ipAddr = excluded.ipAddr, lat = excluded.lat, lng = excluded.lng, \
+    actF = excluded.actF, rptTo = excluded.rptTo, type = excluded.type \
+    WHERE name IS NOT excluded.name OR ipAddr IS NOT excluded.ipAddr OR lat IS NOT excluded.lat \
+    OR lng IS NOT excluded.lng OR actF IS NOT excluded.actF OR rptTo IS NOT excluded.rptTo \
+    OR type IS NOT excluded.type"
+
+#-----------------------------------------------------------------------------
+class RawLine(str):
+    """ Not parsed json text of an inventory file line, parsed (and reported with
+        its line number if invalid) by loadInventory().
+    """
+    def __new__(cls, text, lineNo):
+        line = super().__new__(cls, text)
+        line.lineNo = lineNo
+        return line
+
+#-----------------------------------------------------------------------------
+def iterNodesRcd(filePath):
+    """ Yield the node json texts (RawLine) of the NodesRcd.txt format file (name:{json})."""
+    with open(filePath, encoding=cl.ENCODE) as fh:
+        for lineNo, line in enumerate(fh, start=1):
+            if line[0] in ('#', '\n'): continue
+            line = line.strip()
+            if ':' in line: yield RawLine(line.split(':', 1)[1], lineNo)
+
+#-----------------------------------------------------------------------------
+def iterCSV(filePath):
+    """ Yield the node dicts of the CSV file, the first line is the header."""
+    with open(filePath, newline='', encoding='utf-8') as fh:
+        for node in csv.DictReader(fh): yield node
+
+#-----------------------------------------------------------------------------
+def iterJSONL(filePath):
+    """ Yield the node json texts (RawLine) of the JSON Lines file."""
+    with open(filePath, encoding='utf-8') as fh:
+        for lineNo, line in enumerate(fh, start=1):
+            line = line.strip()
+            if line: yield RawLine(line, lineNo)
+
+READERS = {'rcd': iterNodesRcd, 'csv': iterCSV, 'jsonl': iterJSONL}
+
+#-----------------------------------------------------------------------------
+def iterFile(filePath, fmt='auto'):
+    """ Yield the node records of the inventory file, <fmt>: 'auto', 'rcd', 'csv' or
+        'jsonl' ('auto' decides by the file extension).
+    """
+    if fmt == 'auto':
+        ext = os.path.splitext(filePath)[1].lower()
+        fmt = 'csv' if ext == '.csv' else 'jsonl' if ext in ('.jsonl', '.ndjson') else 'rcd'
+    return READERS[fmt](filePath)
+
+#-----------------------------------------------------------------------------
+def validateNode(node):
+    """ Validate the node dict and convert it to a gatewayInfo row tuple.
+        Raises ValueError if a field is missing or invalid.
+    """
+    try:
+        values = [node[field] for field in FIELDS]
+    except KeyError as err:
+        raise ValueError('missing field %s' % str(err))
+    nodeID, name, ipAddr, lat, lng, actF, rptTo, nodeType = values
+    nodeID, rptTo = int(nodeID), int(rptTo)
+    if nodeID < 0 or rptTo < 0: raise ValueError('negative node id')
+    name = str(name).strip()
+    if not name: raise ValueError('empty name')
+    ipAddr = str(ipaddress.ip_address(str(ipAddr).strip()))
+    lat, lng = float(lat), float(lng)
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180): raise ValueError('invalid GPS position (%s, %s)' % (lat, lng))
+    if isinstance(actF, str): actF = actF.strip().lower() in ('1', 'true', 'yes')
+    nodeType = str(nodeType).strip().upper()
+    if nodeType not in NODE_TYPES: raise ValueError('invalid node type %s' % nodeType)
+    return (nodeID, name, ipAddr, lat, lng, int(bool(actF)), rptTo, nodeType)
+
+#-----------------------------------------------------------------------------
+def loadInventory(conn, nodeIter, strictFlg=False, pruneFlg=False):
+    """ Validate the node records and upsert them into the gatewayInfo table in
+        one transaction.
+    Args:
+        conn ([sqlite3.Connection]): database connection.
+        nodeIter ([iterable]): iterable of the node dicts or their json texts.
+        strictFlg (bool, optional): roll back everything if any record is invalid,
+            otherwise the invalid records are skipped. Defaults to False.
+        pruneFlg (bool, optional): delete the nodes not in the input, skipped if any
+            record is invalid (its node would be deleted). Defaults to False.
+    Returns:
+        [dict]: report, example: {'rows': 100000, 'changed': 12, 'deleted': 0,
+            'invalid': 1, 'errors': ['record 3: invalid node type XX'], 'time': 0.9,
+            ('line N' instead of 'record N' for the RawLine records),
+            'pruneSkipped': True, 'rowsPerSec': 111111}
+    """
+    report = {'rows': 0, 'changed': 0, 'deleted': 0, 'invalid': 0, 'errors': [], 'pruneSkipped': False}
+    nodeIDs = set()
+
+    def iterRows():
+        for idx, node in enumerate(nodeIter, start=1):
+            report['rows'] += 1
+            label = 'line %s' % node.lineNo if isinstance(node, RawLine) else 'record %s' % idx
+            try:
+                if isinstance(node, str): node = json.loads(node)
+                row = validateNode(node)
+            except (ValueError, TypeError) as err:
+                report['invalid'] += 1
+                if len(report['errors']) < MAX_ERRORS: report['errors'].append('%s: %s' % (label, str(err)))
+                if strictFlg: raise ValueError('%s: %s' % (label, str(err)))
+                continue
+            if pruneFlg: nodeIDs.add(row[0])
+            yield row
+
+    startT = time.time()
+    conn.execute(dbSchema.gwInfoTable)
+    if conn.in_transaction: conn.commit()
+    with conn:
+        # rowcount only counts the inserted/updated gatewayInfo rows (not the trigger writes).
+        report['changed'] = conn.executemany(gwInfoUpsert, iterRows()).rowcount
+        # an invalid record's node is not in nodeIDs, pruning would delete the live node.
+        report['pruneSkipped'] = pruneFlg and report['invalid'] > 0
+        if pruneFlg and not report['pruneSkipped']:
+            oldIDs = [(nodeID,) for (nodeID,) in conn.execute('SELECT id FROM gatewayInfo') if nodeID not in nodeIDs]
+            conn.executemany('DELETE FROM gatewayInfo WHERE id = ?', oldIDs)
+            report['deleted'] = len(oldIDs)
+    report['time'] = time.time() - startT
+    report['rowsPerSec'] = report['rows'] / report['time'] if report['time'] > 0 else 0
+    return report
+
+#-----------------------------------------------------------------------------
+def loadFile(filePath, dbPath=gv.DB_PATH, fmt='auto', strictFlg=False, pruneFlg=False):
+    """ Load the inventory file into the database, returns the loadInventory() report."""
+    conn = dbConnPool.getPool(dbPath).getConnection()
+    dbSchema.migrate(conn)
+    return loadInventory(conn, iterFile(filePath, fmt=fmt), strictFlg=strictFlg, pruneFlg=pruneFlg)
+
+#-----------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='Bulk load the gateway inventory into the gatewayInfo table.')
+    parser.add_argument('file', nargs='?', default=gv.NODES_FILE, help='NodesRcd.txt, .csv or .jsonl file.')
+    parser.add_argument('--db', default=gv.DB_PATH, help='database file path.')
+    parser.add_argument('--format', default='auto', choices=('auto',) + tuple(READERS.keys()))
+    parser.add_argument('--strict', action='store_true', help='abort the import if any record is invalid.')
+    parser.add_argument('--prune', action='store_true', help='delete the nodes not in the file.')
+    args = parser.parse_args()
+    report = loadFile(args.file, dbPath=args.db, fmt=args.format, strictFlg=args.strict, pruneFlg=args.prune)
+    for msg in report['errors']: print('> Invalid %s' % msg)
+    print('> Loaded %(rows)d records in %(time).3f sec (%(rowsPerSec).0f rows/sec): %(changed)d changed, '
+          '%(deleted)d deleted, %(invalid)d invalid.' % report)
+    if report['pruneSkipped']: print('> Prune skipped: fix the invalid records and import again.')
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
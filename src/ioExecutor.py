@@ -0,0 +1,72 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        ioExecutor.py [python3]
+#
+# Purpose:     This module provides the bounded worker thread pool used by the
+#              cooperative (SocketIO background task) map data manager to run the
+#              blocking sqlite3 reads and the record decoding off the event loop.
+#
+# Author:      Liu Yuancheng
+#
+# Version:     v_0.2
+# Created:     2022/01/05
+# Copyright:   Singtel Cyber Security Research & Development Laboratory
+# License:
+#-----------------------------------------------------------------------------
+""" Program Design:
+    The caller task waits for the result the way the SocketIO async mode needs:
+    - 'eventlet': eventlet.tpool runs the call in its native thread pool and only
+        the calling green thread waits.
+    - 'gevent': the gevent hub's thread pool does the same for the greenlet.
+    - 'threading': a concurrent.futures thread pool, the caller thread blocks.
+    The sqlite3 connections are per thread (dbConnPool), so the called function
+    must get its connection from the pool inside the worker thread.
+    Usage example:
+        executor = IOExecutor(gv.iSocketIO, size=2)
+        rows = executor.call(dbSchema.fetchStates, dbPool.getConnection(), 0) # wrong: caller's conn
+        rows = executor.call(lambda: dbSchema.fetchStates(dbPool.getConnection(), 0)) # right
+        executor.shutdown()
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+IO_WORKERS = 2      # default max number of worker threads.
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class IOExecutor(object):
+    """ Bounded worker thread pool for the blocking I/O calls of a SocketIO task."""
+    def __init__(self, socketIO, size=IO_WORKERS):
+        self.asyncMode = getattr(socketIO, 'async_mode', None) or 'threading'
+        self.size = size
+        self.pool = None
+        if self.asyncMode == 'eventlet':
+            from eventlet import tpool
+            tpool.set_num_threads(size)
+            self.pool = tpool
+        elif self.asyncMode == 'gevent':
+            from gevent.threadpool import ThreadPool
+            self.pool = ThreadPool(size)
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix='ioExecutor')
+
+#-----------------------------------------------------------------------------
+    def call(self, func, *args, **kwargs):
+        """ Run func(*args, **kwargs) in a worker thread and return its result (the
+            exception raised by the function is raised again in the caller).
+        """
+        if self.asyncMode == 'eventlet':
+            return self.pool.execute(func, *args, **kwargs)
+        if self.asyncMode == 'gevent':
+            return self.pool.apply(func, args, kwargs)
+        return self.pool.submit(func, *args, **kwargs).result()
+
+#-----------------------------------------------------------------------------
+    def shutdown(self):
+        """ Wait for the running calls and release the worker threads."""
+        if self.asyncMode == 'eventlet':
+            self.pool.killall()
+        elif self.asyncMode == 'gevent':
+            self.pool.join()
+            self.pool.kill()
+        else:
+            self.pool.shutdown(wait=True)
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        linkEngine.py [python3]
+#
+# Purpose:     This module provides the array-backed link state engine used by
+#              the map data manager to calculate all the links' active, key
+#              exchange and throughput state with a few NumPy vector operations
+#              instead of a Python loop over every link.
+#
+# Author:      Liu Yuancheng
+#
+# Version:     v_0.2
+# Created:     2021/12/28
+# Copyright:   Singtel Cyber Security Research & Development Laboratory
+# License:
+#-----------------------------------------------------------------------------
+""" Program Design:
+    - Node state (activeFlag, inThrput) is saved in arrays indexed by a dense
+        node index (nodeID -> idx).
+    - Links are saved as two int32 end point index arrays in the link registry order.
+    - Key exchange is a sparse boolean adjacency: the sorted int64 array of the
+        codes (idx1 * N + idx2) of the directed pairs "node idx1 has node idx2 in
+        its keyExchange list".
+    Install numpy lib: pip3 install numpy, the data manager falls back to the
+    per link Python loop if numpy is not installed.
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class LinkStateEngine(object):
+    """ Vectorized link state calculator over the link registry."""
+    def __init__(self, linkReg):
+        self.linkReg = linkReg
+        self.linkVer = None     # (registry nextNo, links number, nodes number) when the link arrays were built.
+        self.links = []         # link dicts under the array order.
+        self.nodeIdx = {}       # node ID -> dense node index.
+        self.ep1 = self.ep2 = None  # int32 end point node index arrays.
+        self.prevState = None   # state arrays of the last calculation.
+
+#-----------------------------------------------------------------------------
+    def _buildLinkArrays(self, nodeIDs):
+        """ Rebuild the dense node index and the link end point arrays."""
+        self.nodeIdx = {nodeID: idx for idx, nodeID in enumerate(nodeIDs)}
+        self.links = self.linkReg.getLinks()
+        self.ep1 = np.fromiter((self.nodeIdx[link['ids'][0]] for link in self.links), dtype=np.int32, count=len(self.links))
+        self.ep2 = np.fromiter((self.nodeIdx[link['ids'][1]] for link in self.links), dtype=np.int32, count=len(self.links))
+        self.linkVer = (self.linkReg.nextNo, len(self.linkReg), len(self.nodeIdx))
+        self.prevState = None
+
+#-----------------------------------------------------------------------------
+    def compute(self, nodeDict):
+        """ Calculate all the links state from the nodes state, update the link
+            dicts whose state changed.
+        Args:
+            nodeDict ([dict]): node ID -> DevNode (dict or topologyMapHost.NodeStore).
+        Returns:
+            [list]: the changed link dicts.
+        """
+        nodes = list(nodeDict.values())
+        if self.linkVer != (self.linkReg.nextNo, len(self.linkReg), len(nodes)) or \
+                any(self.nodeIdx.get(node.devID) != idx for idx, node in enumerate(nodes)):
+            self._buildLinkArrays([node.devID for node in nodes])
+        nodeNum = len(nodes)
+        actArr = np.fromiter((bool(node.activeFlag) for node in nodes), dtype=bool, count=nodeNum)
+        thrArr = np.fromiter((node.inThrput for node in nodes), dtype=np.float64, count=nodeNum)
+        kxCodes = np.unique(np.fromiter((idx * nodeNum + self.nodeIdx[pairID] for idx, node in enumerate(nodes)
+                                         for pairID in node.keyExchange if pairID in self.nodeIdx), dtype=np.int64))
+        ep1, ep2 = self.ep1, self.ep2
+        # link is active if both of the end nodes are active.
+        active = actArr[ep1] & actArr[ep2]
+        # key exchange if node 1 in node 2's keyExchange list and node 2 in node 1's keyExchange list.
+        keyExchange = np.isin(ep2.astype(np.int64) * nodeNum + ep1, kxCodes, assume_unique=True) & \
+            np.isin(ep1.astype(np.int64) * nodeNum + ep2, kxCodes, assume_unique=True)
+        thr1 = np.where(active, thrArr[ep1], 0.0)
+        thr2 = np.where(active, thrArr[ep2], 0.0)
+        if self.prevState is None:
+            changed = np.arange(len(self.links))
+        else:
+            pAct, pKey, pThr1, pThr2 = self.prevState
+            changed = np.flatnonzero((active != pAct) | (keyExchange != pKey) | (thr1 != pThr1) | (thr2 != pThr2))
+        self.prevState = (active, keyExchange, thr1, thr2)
+        # write the changed state back to the link dicts.
+        links = self.links
+        changedLinks = [links[i] for i in changed.tolist()]
+        for link, act, key, t1, t2 in zip(changedLinks, active[changed].tolist(),
+                                          keyExchange[changed].tolist(), thr1[changed].tolist(), thr2[changed].tolist()):
+            link['active'] = act
+            link['keyExchange'] = key
+            link['throughput1'] = t1
+            link['throughput2'] = t2
+        return changedLinks
+
+#-----------------------------------------------------------------------------
+    def reset(self):
+        """ Drop the previous state so the next compute() writes all the links, call
+            it after the link dicts are changed outside compute() (delta updates).
+        """
+        self.prevState = None
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        linkRegistry.py [python3]
+#
+# Purpose:     This module provides an indexed communication link table used by
+#              the topology map data manager. Each link is keyed by the canonical
+#              "<small_id>-<big_id>" node pair string so lookup, insert and remove
+#              are all constant time.
+#
+# Author:      Liu Yuancheng
+#
+# Version:     v_0.2
+# Created:     2021/12/20
+# Copyright:   Singtel Cyber Security Research & Development Laboratory
+# License:
+#-----------------------------------------------------------------------------
+
+# link data example:
+# {'no':1, 'pts':'0-1', 'ids':(0, 1), 'active':True, 'keyExchange': True, 'throughput1':10.21, 'throughput2': 5.52}
+LINK_TEMPLATE = {'no': None, 'pts': None, 'ids': None, 'active': None,
+                 'keyExchange': None, 'throughput1': None, 'throughput2': None}
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class LinkRegistry(object):
+    """ Communication link table keyed by the canonical pts string. The links keep
+        the insert order and each link gets a stable number which is never reused
+        after the link is removed.
+    """
+    def __init__(self):
+        self.links = {}     # pts string -> link dict.
+        self.nodeLinks = {} # node ID -> set of pts strings of the links touch the node.
+        self.nextNo = 0     # next link number to assign.
+
+#-----------------------------------------------------------------------------
+    @staticmethod
+    def getKey(id1, id2):
+        """ Build the canonical link key follow format '<smaller_id>-<bigger_id>'.
+            example: getKey(3, 1) -> '1-3'
+        """
+        id1, id2 = int(id1), int(id2)
+        return '%d-%d' % ((id1, id2) if id1 <= id2 else (id2, id1))
+
+#-----------------------------------------------------------------------------
+    def addLink(self, id1, id2, active=None):
+        """ Add the link between node <id1> and <id2> if it is not in the table.
+        Args:
+            id1 ([int]): node ID of one end point.
+            id2 ([int]): node ID of the other end point.
+            active ([bool], optional): init link active flag. Defaults to None.
+        Returns:
+            [tuple]: (link dict, True if the link is new created).
+        """
+        id1, id2 = int(id1), int(id2)
+        ids = (id1, id2) if id1 <= id2 else (id2, id1)
+        key = '%d-%d' % ids
+        link = self.links.get(key)
+        if link is not None: return (link, False)
+        link = dict(LINK_TEMPLATE)
+        link['no'] = self.nextNo
+        link['pts'] = key
+        link['ids'] = ids
+        link['active'] = active
+        self.links[key] = link
+        for nodeID in set(ids):
+            self.nodeLinks.setdefault(nodeID, set()).add(key)
+        self.nextNo += 1
+        return (link, True)
+
+#-----------------------------------------------------------------------------
+    def getLink(self, key):
+        """ Return the link dict of the input pts key, None if not exist."""
+        return self.links.get(key)
+
+#-----------------------------------------------------------------------------
+    def hasLink(self, key):
+        """ Check whether a link is exist. Input: a link pts str (example: '1-2')"""
+        return key in self.links
+
+#-----------------------------------------------------------------------------
+    def removeLink(self, key):
+        """ Remove the link from the table, return the removed link or None."""
+        link = self.links.pop(key, None)
+        if link is not None:
+            for nodeID in set(link['ids']):
+                keys = self.nodeLinks.get(nodeID)
+                keys.discard(key)
+                if not keys: self.nodeLinks.pop(nodeID)
+        return link
+
+#-----------------------------------------------------------------------------
+    def getNodeLinks(self, nodeIDs):
+        """ Return the list of links (sorted by link number) which touch any node in 
+            the input node ID list.
+        """
+        keys = set()
+        for nodeID in nodeIDs:
+            keys.update(self.nodeLinks.get(int(nodeID), ()))
+        return sorted((self.links[key] for key in keys), key=lambda link: link['no'])
+
+#-----------------------------------------------------------------------------
+    def getLinks(self):
+        """ Return a list of all the links under insert order."""
+        return list(self.links.values())
+
+#-----------------------------------------------------------------------------
+    def clear(self):
+        self.links.clear()
+        self.nodeLinks.clear()
+        self.nextNo = 0
+
+#-----------------------------------------------------------------------------
+    def __contains__(self, key):
+        return key in self.links
+
+    def __iter__(self):
+        return iter(self.links.values())
+
+    def __len__(self):
+        return len(self.links)
+
+    def __repr__(self):
+        return repr(list(self.links.values()))
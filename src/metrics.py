@@ -0,0 +1,373 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        metrics.py [python3]
+#
+# Purpose:     This module provides the low overhead counters, gauges, timing
+#              histograms and the sampling profiler used to instrument the map
+#              host, the data fetcher and the database creater hot paths. The
+#              metrics are exposed in the Prometheus text format at /metrics.
+#
+# Author:      Liu Yuancheng
+#
+# Version:     v_0.2
+# Created:     2022/01/06
+# Copyright:   Singtel Cyber Security Research & Development Laboratory
+# License:
+#-----------------------------------------------------------------------------
+""" Program Design:
+    The metrics are registered once in the module level registry (per process)
+    and updated in place, the hot path only takes a lock and adds a number. The
+    label children should be bound once (metric.labels(...)) outside the loop.
+    Usage example:
+        gTickTime = metrics.histogram('datamgr_tick_seconds', 'Tick duration.')
+        gRows = metrics.counter('datamgr_rows_total', 'Rows fetched.', labelNames=('table',))
+        gStateRows = gRows.labels('gatewayState')
+        with gTickTime.time():
+            gStateRows.inc(len(rows))
+        metrics.instrumentApp(app, 'topologyMapHost') # adds /metrics (profileFlg=True: /metrics/profile)
+        metrics.startHttpServer(9101)                 # /metrics of a process without flask
+    Profiler (off by default, instrumentApp(..., profileFlg=True)): POST /metrics/profile
+    with action=start[&interval=0.01] starts sampling all the thread stacks, action=stop
+    returns the collapsed stacks ('frame;frame;... count', flamegraph.pl input). Under
+    eventlet/gevent only the OS threads are sampled.
+"""
+import sys
+import time
+import bisect
+import threading
+from contextlib import ContextDecorator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# timing histogram buckets (sec).
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# payload size histogram buckets (bytes).
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+PROFILE_INTV = 0.01     # sec, default profiler sampling interval.
+PROFILE_DEPTH = 64      # max number of frames kept in one sampled stack.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+gRegistry = {}          # metric name -> metric, rendered under the registration order.
+gRegistryLock = threading.Lock()
+gProfiler = None        # running SamplingProfiler.
+gProfilerLock = threading.Lock()
+
+#-----------------------------------------------------------------------------
+def _formatLabels(labelNames, labelValues, extra=()):
+    pairs = list(zip(labelNames, labelValues)) + list(extra)
+    if not pairs: return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for key, val in pairs)
+
+def _formatValue(value):
+    if value == float('inf'): return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class _Metric(object):
+    """ Base class of the metric types: a metric without labels keeps its value
+        itself, a metric with labels keeps one child metric per label values.
+    """
+    typeName = 'untyped'
+
+    def __init__(self, name, helpStr, labelNames=(), labelValues=()):
+        self.name = name
+        self.helpStr = helpStr
+        self.labelNames = tuple(labelNames)
+        self.labelValues = tuple(labelValues)
+        self.children = {}      # label values tuple -> child metric.
+        self.lock = threading.Lock()
+
+#-----------------------------------------------------------------------------
+    def _newChild(self, labelValues):
+        return self.__class__(self.name, self.helpStr, labelNames=self.labelNames, labelValues=labelValues)
+
+    def labels(self, *labelValues):
+        """ Return the child metric of the label values (created if not exist)."""
+        labelValues = tuple(str(val) for val in labelValues)
+        child = self.children.get(labelValues)
+        if child is None:
+            if len(labelValues) != len(self.labelNames):
+                raise ValueError('%s expects labels %s' % (self.name, self.labelNames))
+            with self.lock:
+                child = self.children.setdefault(labelValues, self._newChild(labelValues))
+        return child
+
+#-----------------------------------------------------------------------------
+    def _samples(self):
+        """ Yield the (name suffix, extra labels, value) samples of this metric."""
+        return ()
+
+    def render(self):
+        """ Return the metric in the Prometheus text format lines."""
+        lines = ['# HELP %s %s' % (self.name, self.helpStr), '# TYPE %s %s' % (self.name, self.typeName)]
+        metrics = list(self.children.values()) if self.labelNames else [self]
+        for metric in metrics:
+            for suffix, extra, value in metric._samples():
+                lines.append('%s%s%s %s' % (self.name, suffix, _formatLabels(self.labelNames, metric.labelValues, extra),
+                                            _formatValue(value)))
+        return lines
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class Counter(_Metric):
+    """ Monotonic increasing counter."""
+    typeName = 'counter'
+
+    def __init__(self, name, helpStr, labelNames=(), labelValues=()):
+        _Metric.__init__(self, name, helpStr, labelNames=labelNames, labelValues=labelValues)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def _samples(self):
+        yield ('_total' if not self.name.endswith('_total') else '', (), self.value)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class Gauge(_Metric):
+    """ Value which can go up and down, or read from a function when rendered."""
+    typeName = 'gauge'
+
+    def __init__(self, name, helpStr, labelNames=(), labelValues=()):
+        _Metric.__init__(self, name, helpStr, labelNames=labelNames, labelValues=labelValues)
+        self.value = 0
+        self.func = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def setFunction(self, func):
+        """ Read the gauge value by calling func() when the metrics are rendered."""
+        self.func = func
+
+    def _samples(self):
+        yield ('', (), self.func() if self.func else self.value)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class _Timer(ContextDecorator):
+    """ Context manager/decorator observing the time used into the histogram."""
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.startT = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.startT)
+        return False
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class Histogram(_Metric):
+    """ Cumulative bucket histogram (time in sec or size in bytes)."""
+    typeName = 'histogram'
+
+    def __init__(self, name, helpStr, labelNames=(), labelValues=(), buckets=TIME_BUCKETS):
+        _Metric.__init__(self, name, helpStr, labelNames=labelNames, labelValues=labelValues)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)   # last one is the +Inf bucket.
+        self.sum = 0.0
+        self.count = 0
+
+    def _newChild(self, labelValues):
+        return Histogram(self.name, self.helpStr, labelNames=self.labelNames, labelValues=labelValues,
+                         buckets=self.buckets)
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """ Return a timer context manager/decorator: with hist.time(): ..."""
+        return _Timer(self)
+
+    def _samples(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, num in zip(self.buckets + (float('inf'),), counts):
+            cumulative += num
+            yield ('_bucket', (('le', _formatValue(bound)),), cumulative)
+        yield ('_sum', (), total)
+        yield ('_count', (), count)
+
+#-----------------------------------------------------------------------------
+def _register(metricCls, name, helpStr, **kwargs):
+    """ Return the registered metric <name>, create it if not registered."""
+    with gRegistryLock:
+        metric = gRegistry.get(name)
+        if metric is None:
+            metric = gRegistry[name] = metricCls(name, helpStr, **kwargs)
+        elif not isinstance(metric, metricCls):
+            raise ValueError('metric %s is already registered as %s' % (name, metric.typeName))
+        return metric
+
+def counter(name, helpStr, labelNames=()):
+    return _register(Counter, name, helpStr, labelNames=labelNames)
+
+def gauge(name, helpStr, labelNames=()):
+    return _register(Gauge, name, helpStr, labelNames=labelNames)
+
+def histogram(name, helpStr, labelNames=(), buckets=TIME_BUCKETS):
+    return _register(Histogram, name, helpStr, labelNames=labelNames, buckets=buckets)
+
+#-----------------------------------------------------------------------------
+def render():
+    """ Return all the registered metrics in the Prometheus text format."""
+    with gRegistryLock:
+        metrics = list(gRegistry.values())
+    lines = []
+    for metric in metrics: lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class SamplingProfiler(threading.Thread):
+    """ Sample the call stacks of all the other threads every <interval> sec and
+        count the collapsed stacks.
+    """
+    def __init__(self, interval=PROFILE_INTV, depth=PROFILE_DEPTH):
+        threading.Thread.__init__(self, name='samplingProfiler', daemon=True)
+        self.interval = interval
+        self.depth = depth
+        self.stacks = {}        # collapsed stack str -> sample count.
+        self.sampleCount = 0
+        self.startT = time.time()
+        self.stopEvent = threading.Event()
+
+    def run(self):
+        selfID = threading.get_ident()
+        while not self.stopEvent.wait(self.interval):
+            for threadID, frame in sys._current_frames().items():
+                if threadID == selfID: continue
+                frames = []
+                while frame is not None and len(frames) < self.depth:
+                    code = frame.f_code
+                    frames.append('%s:%s:%d' % (code.co_filename.rsplit('/', 1)[-1], code.co_name, frame.f_lineno))
+                    frame = frame.f_back
+                stack = ';'.join(reversed(frames))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.sampleCount += 1
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def getReport(self):
+        """ Return the collapsed stacks text, the most sampled stack first."""
+        lines = ['# %d samples in %.1f sec, interval %s sec' % (self.sampleCount, time.time() - self.startT,
+                                                               self.interval)]
+        lines += ['%s %d' % (stack, num) for stack, num in sorted(self.stacks.items(), key=lambda x: -x[1])]
+        return '\n'.join(lines) + '\n'
+
+#-----------------------------------------------------------------------------
+def startProfiler(interval=PROFILE_INTV):
+    """ Start the sampling profiler, returns False if it is already running."""
+    global gProfiler
+    with gProfilerLock:
+        if gProfiler is not None: return False
+        gProfiler = SamplingProfiler(interval=interval)
+        gProfiler.start()
+        return True
+
+def stopProfiler():
+    """ Stop the sampling profiler, returns its report (None if not running)."""
+    global gProfiler
+    with gProfilerLock:
+        profiler, gProfiler = gProfiler, None
+    if profiler is None: return None
+    profiler.stop()
+    profiler.join()
+    return profiler.getReport()
+
+def isProfiling():
+    return gProfiler is not None
+
+#-----------------------------------------------------------------------------
+def instrumentApp(app, appName, profileFlg=False):
+    """ Time all the requests of the flask app and add the /metrics route (and
+        the POST only /metrics/profile profiler toggle route if <profileFlg>, so a 
+        crawler, link prefetcher or cross site GET can not switch it). The time of
+        a streamed response only covers the response creation.
+    """
+    from flask import Response, g, request
+    reqTime = histogram('http_request_duration_seconds', 'Flask request handle time.',
+                        labelNames=('app', 'route', 'method', 'status'))
+    respBytes = counter('http_response_bytes_total', 'Flask response body bytes (not streamed).',
+                        labelNames=('app', 'route'))
+
+    @app.before_request
+    def _startTimer():
+        g.metricsStartT = time.perf_counter()
+
+    @app.after_request
+    def _observeRequest(response):
+        startT = g.pop('metricsStartT', None)
+        if startT is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            reqTime.labels(appName, route, request.method, response.status_code).observe(time.perf_counter() - startT)
+            if not response.is_streamed and response.content_length:
+                respBytes.labels(appName, route).inc(response.content_length)
+        return response
+
+    def metricsView():
+        return Response(render(), mimetype=CONTENT_TYPE)
+    app.add_url_rule('/metrics', 'metrics', metricsView)
+
+    if not profileFlg: return
+
+    def profileView():
+        """ POST action=start[&interval=0.01] / stop (returns the collapsed stacks) / status"""
+        params = request.values # form body or query string parameters.
+        action = params.get('action', 'status')
+        if action == 'start':
+            try:
+                interval = float(params.get('interval', PROFILE_INTV))
+                if interval <= 0: raise ValueError
+            except ValueError:
+                return Response("'interval' must be a positive number.\n", status=400, mimetype='text/plain')
+            return Response('started\n' if startProfiler(interval) else 'already running\n', mimetype='text/plain')
+        if action == 'stop':
+            report = stopProfiler()
+            return Response(report or 'not running\n', mimetype='text/plain')
+        return Response('running\n' if isProfiling() else 'stopped\n', mimetype='text/plain')
+    app.add_url_rule('/metrics/profile', 'metricsProfile', profileView, methods=['POST'])
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def startHttpServer(port, host='127.0.0.1'):
+    """ Serve /metrics by a background thread http server (for the process
+        without a flask app), returns the server.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metricsServer', daemon=True).start()
+    return server
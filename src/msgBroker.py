@@ -0,0 +1,287 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        msgBroker.py [python3]
+#
+# Purpose:     This module provides the local message broker (UNIX or TCP socket
+#              pub/sub fan out) and its python-socketio client manager, used as
+#              the SocketIO message queue between the map data manager producer
+#              and the web worker processes when no Redis/RabbitMQ is installed.
+#
+# Author:      Liu Yuancheng
+#
+# Version:     v_0.2
+# Created:     2022/01/09
+# Copyright:   Singtel Cyber Security Research & Development Laboratory
+# License:
+#-----------------------------------------------------------------------------
+""" Program Design:
+    - Frame: 4 bytes big endian length + json message {'channel': ..., 'data': ...}.
+    - A client connection sends one role byte first: 'P' publisher (the broker
+        never writes to it) or 'S' subscriber (receives all the frames published
+        by the other connections).
+    - Each subscriber has a bounded send queue and its own sender thread, a
+        subscriber which can not keep up is disconnected (its manager reconnects
+        and the page gets the state back by the next full snapshot), so a slow
+        web worker never blocks the producer or the other workers.
+    Broker url: 'unix:///tmp/topologyMapBus.sock' or 'tcp://127.0.0.1:5012'
+    Usage example:
+        python3 msgBroker.py --url unix:///tmp/topologyMapBus.sock
+        mgr = msgBroker.BrokerManager(url, write_only=True)
+        socketIO = SocketIO(message_queue=url, client_manager=mgr)
+"""
+import os
+import json
+import time
+import queue
+import signal
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+
+import socketio
+
+BROKER_URL = 'unix:///tmp/topologyMapBus.sock'
+FRAME_HDR = struct.Struct('>I')
+MAX_FRAME = 64*1024*1024    # max frame size (bytes).
+SUB_QUEUE_SIZE = 1000       # max number of frames waiting for one subscriber.
+RECONNECT_DELAY = 1.0       # sec, subscriber reconnect delay.
+ROLE_PUB, ROLE_SUB = b'P', b'S'
+
+#-----------------------------------------------------------------------------
+def isBrokerUrl(url):
+    """ Check whether the message queue url is a local broker url."""
+    return bool(url) and url.startswith(('unix://', 'tcp://'))
+
+def parseUrl(url):
+    """ Convert the broker url to (socket family, address)."""
+    if url.startswith('unix://'): return socket.AF_UNIX, url[len('unix://'):]
+    if url.startswith('tcp://'):
+        host, _, port = url[len('tcp://'):].rpartition(':')
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    raise ValueError('unsupported broker url: %s' % url)
+
+#-----------------------------------------------------------------------------
+def connect(url, role):
+    """ Connect to the broker under the role (ROLE_PUB/ROLE_SUB)."""
+    family, address = parseUrl(url)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+        sock.sendall(role)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def sendFrame(sock, data):
+    sock.sendall(FRAME_HDR.pack(len(data)) + data)
+
+def _recvExact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        data = sock.recv(size - len(buf))
+        if not data: return None
+        buf += data
+    return bytes(buf)
+
+def recvFrame(sock):
+    """ Receive one frame, returns None if the connection is closed."""
+    header = _recvExact(sock, FRAME_HDR.size)
+    if header is None: return None
+    size = FRAME_HDR.unpack(header)[0]
+    if size > MAX_FRAME: raise OSError('frame too large: %s' % size)
+    return _recvExact(sock, size)
+
+def waitReady(url, timeout=5):
+    """ Wait until the broker accepts connections. Returns True if ready."""
+    endT = time.time() + timeout
+    while True:
+        try:
+            connect(url, ROLE_PUB).close()
+            return True
+        except OSError:
+            if time.time() >= endT: return False
+            time.sleep(0.1)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class _Subscriber(object):
+    """ Broker side subscriber connection with its bounded send queue."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.queue = queue.Queue(maxsize=SUB_QUEUE_SIZE)
+        self.closed = False
+        threading.Thread(target=self._sendLoop, daemon=True).start()
+
+    def put(self, frame):
+        if self.closed: return
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            self.close()    # too slow, drop the connection.
+
+    def _sendLoop(self):
+        while not self.closed:
+            frame = self.queue.get()
+            if frame is None: break
+            try:
+                sendFrame(self.sock, frame)
+            except OSError:
+                self.close()
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+#-----------------------------------------------------------------------------
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        broker, sock = self.server.broker, self.request
+        role = _recvExact(sock, 1)
+        sub = None
+        if role == ROLE_SUB:
+            sub = _Subscriber(sock)
+            broker.addSubscriber(sub)
+        elif role != ROLE_PUB:
+            return
+        try:
+            while True:
+                frame = recvFrame(sock)
+                if frame is None: break
+                broker.publish(frame, sub)
+        except OSError:
+            pass
+        finally:
+            if sub is not None:
+                broker.removeSubscriber(sub)
+                sub.close()
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class MessageBroker(object):
+    """ Local pub/sub broker: every frame is forwarded to all the other subscribers."""
+    def __init__(self, url=BROKER_URL):
+        self.url = url
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.frameCount = 0
+        family, address = parseUrl(url)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address): os.remove(address)
+            self.server = _UnixServer(address, _BrokerHandler)
+        else:
+            self.server = _TCPServer(address, _BrokerHandler)
+        self.server.broker = self
+
+    def addSubscriber(self, sub):
+        with self.lock:
+            self.subscribers.add(sub)
+
+    def removeSubscriber(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+
+    def publish(self, frame, sender=None):
+        with self.lock:
+            subs = [sub for sub in self.subscribers if sub is not sender]
+        self.frameCount += 1
+        for sub in subs: sub.put(frame)
+
+    def start(self):
+        """ Serve in a background thread."""
+        threading.Thread(target=self.server.serve_forever, name='msgBroker', daemon=True).start()
+        return self
+
+    def serveForever(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            subs, self.subscribers = list(self.subscribers), set()
+        for sub in subs: sub.close()
+        family, address = parseUrl(self.url)
+        if family == socket.AF_UNIX and os.path.exists(address): os.remove(address)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class BrokerManager(socketio.PubSubManager):
+    """ python-socketio client manager using the local message broker, pass it
+        to SocketIO(client_manager=...) in the producer and all the web workers.
+    """
+    name = 'localbroker'
+
+    def __init__(self, url=BROKER_URL, channel='flask-socketio', write_only=False, logger=None, json=None):
+        parseUrl(url)   # check the url.
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.url = url
+        self.pubSock = None
+        self.pubLock = threading.Lock()
+
+    def _publish(self, data):
+        frame = json.dumps({'channel': self.channel, 'data': data}).encode('utf-8')
+        with self.pubLock:
+            for retry in range(2):
+                try:
+                    if self.pubSock is None: self.pubSock = connect(self.url, ROLE_PUB)
+                    sendFrame(self.pubSock, frame)
+                    return
+                except OSError as err:
+                    if self.pubSock is not None: self.pubSock.close()
+                    self.pubSock = None
+                    if retry: self._get_logger().warning('msgBroker: message dropped: %s', str(err))
+
+    def _listen(self):
+        while True:
+            try:
+                sock = connect(self.url, ROLE_SUB)
+            except OSError:
+                time.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                while True:
+                    frame = recvFrame(sock)
+                    if frame is None: break
+                    message = json.loads(frame)
+                    if message.get('channel') == self.channel: yield message['data']
+            except (OSError, ValueError) as err:
+                self._get_logger().warning('msgBroker: subscriber connection error: %s', str(err))
+            finally:
+                sock.close()
+            time.sleep(RECONNECT_DELAY)
+
+#-----------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='Local SocketIO message broker.')
+    parser.add_argument('--url', default=BROKER_URL, help='unix:///path or tcp://host:port')
+    args = parser.parse_args()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    broker = MessageBroker(args.url)
+    print("> Message broker serving at %s" % args.url)
+    try:
+        broker.serveForever()
+    except KeyboardInterrupt:
+        broker.stop()
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
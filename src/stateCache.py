@@ -0,0 +1,106 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        stateCache.py [python3]
+#
+# Purpose:     This module provides the in-memory latest state store (one entry
+#              per gateway: actF, throughput, comTo) with a version counter and
+#              a snapshot + cursor API, shared by the map host data manager and
+#              the data fetcher routes.
+#
+# Author:      Liu Yuancheng
+#
+# Version:     v_0.2
+# Created:     2022/01/08
+# Copyright:   Singtel Cyber Security Research & Development Laboratory
+# License:
+#-----------------------------------------------------------------------------
+""" Program Design:
+    The writer (dbSchema.insertStates) upserts each gateway's last state of the
+    batch into the gatewayLatest table once per ingest batch, the row's seq is its
+    version. The cache keeps the decoded latest states in memory and refresh()
+    only reads the gateways whose version > the cache version (an index range
+    scan, empty most of the time), so every process decodes each change once and
+    all its consumers (DataMgr ticks, /updates, /states requests) read the memory.
+    The entries are kept under version order, getChanges(sinceVersion) walks back
+    from the newest entry and stops at the first older one.
+    Usage example:
+        cache = stateCache.getCache(gv.DB_PATH)
+        version, states = cache.getSnapshot()           # {gatewayID: infoDict}
+        version, changes = cache.getChanges(version)    # [(seq, time, gatewayID, infoDict), ...]
+"""
+import threading
+
+import dbConnPool
+import dbSchema
+import metrics
+
+gCaches = {}                # db path -> LatestStateCache
+gCachesLock = threading.Lock()
+
+gRefreshRows = metrics.counter('state_cache_refresh_rows_total', 'Changed gateway states loaded by the cache.')
+gCacheVersion = metrics.gauge('state_cache_version', 'Latest state cache version (gatewayLatest seq).')
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class LatestStateCache(object):
+    """ In-memory latest state of every gateway with a version cursor."""
+    def __init__(self, dbPath):
+        self.dbPool = dbConnPool.getPool(dbPath)
+        self.states = {}        # gateway ID -> (seq, time, gatewayID, infoDict), under seq order.
+        self.version = 0        # max seq of the loaded states.
+        self.lock = threading.Lock()
+        self.refreshLock = threading.Lock()
+
+#-----------------------------------------------------------------------------
+    def refresh(self):
+        """ Load the gateways' states changed after the cache version from the
+            database. Returns the number of changed gateways.
+        """
+        with self.refreshLock:  # concurrent callers wait for one read.
+            rows = dbSchema.fetchLatest(self.dbPool.getConnection(), self.version)
+            if not rows: return 0
+            with self.lock:
+                for row in rows:
+                    self.states.pop(row[2], None) # re-insert to keep the seq order.
+                    self.states[row[2]] = row
+                self.version = rows[-1][0]
+        gRefreshRows.inc(len(rows))
+        gCacheVersion.set(self.version)
+        return len(rows)
+
+#-----------------------------------------------------------------------------
+    def getSnapshot(self, refreshFlg=True):
+        """ Return (version, {gatewayID: infoDict}) of all the gateways."""
+        if refreshFlg: self.refresh()
+        with self.lock:
+            return self.version, {gwID: row[3] for gwID, row in self.states.items()}
+
+#-----------------------------------------------------------------------------
+    def getChanges(self, sinceVersion=0, refreshFlg=True):
+        """ Return (version, list of (seq, time, gatewayID, infoDict)) of the gateways
+            changed after <sinceVersion> under seq order, use the returned version
+            as the next call's sinceVersion.
+        """
+        if refreshFlg: self.refresh()
+        changes = []
+        with self.lock:
+            for row in reversed(self.states.values()):
+                if row[0] <= sinceVersion: break
+                changes.append(row)
+            version = self.version
+        changes.reverse()
+        return version, changes
+
+#-----------------------------------------------------------------------------
+    def get(self, gatewayID):
+        """ Return the cached (seq, time, gatewayID, infoDict) of the gateway or None."""
+        return self.states.get(gatewayID)
+
+#-----------------------------------------------------------------------------
+def getCache(dbPath):
+    """ Return the shared latest state cache of the database file."""
+    with gCachesLock:
+        cache = gCaches.get(dbPath)
+        if cache is None:
+            cache = gCaches[dbPath] = LatestStateCache(dbPath)
+        return cache
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        stateWatcher.py [python3]
+#
+# Purpose:     This module provides a single database watcher thread which detects
+#              the new committed gatewayState records and fans the records out to
+#              all the subscribers (SSE / long-poll clients of the data fetcher).
+#
+# Author:      Liu Yuancheng
+#
+# Version:     v_0.2
+# Created:     2021/12/23
+# Copyright:   Singtel Cyber Security Research & Development Laboratory
+# License:
+#-----------------------------------------------------------------------------
+""" Program Design:
+    The watcher checks sqlite 'PRAGMA data_version' (changes when any other
+    connection commits) every WATCH_INTV seconds, which costs no table read. When
+    the version changes it fetches all the new state records once and pushes the
+    coalesced batch to every subscriber's bounded queue. A subscriber whose queue
+    is full is marked overflow and will re-read its backlog from the database by
+    its own cursor, so a slow client never blocks the watcher or other clients.
+    Usage example:
+        sub = watcher.subscribe(sinceSeq)
+        batch = sub.get(timeout=30) # list of (seq, time, gatewayID, infoDict)
+        watcher.unsubscribe(sub)
+"""
+import queue
+import threading
+from sqlite3 import Error
+
+import Log
+import dbConnPool
+import dbSchema
+
+WATCH_INTV = 0.1        # sec, database change check interval.
+SUB_QUEUE_SIZE = 64     # max number of pending batches per subscriber.
+FETCH_LIMIT = 5000      # max records fetched from database in one read.
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class StateSubscriber(object):
+    """ One subscriber of the state watcher, keeps its own seq cursor."""
+    def __init__(self, dbPool, sinceSeq=0, queueSize=SUB_QUEUE_SIZE):
+        self.dbPool = dbPool
+        self.cursor = sinceSeq      # seq of the last record delivered to the client.
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.overflow = True        # True: read the backlog from database (also used for the first get).
+
+#-----------------------------------------------------------------------------
+    def put(self, batch):
+        """ Called by the watcher thread to push a new records batch."""
+        if self.overflow: return
+        try:
+            self.queue.put_nowait(batch)
+        except queue.Full:
+            self.overflow = True
+
+#-----------------------------------------------------------------------------
+    def get(self, timeout=None):
+        """ Get the next state records batch after the subscriber's cursor.
+        Args:
+            timeout ([float], optional): max wait time (sec). Defaults to None (wait forever).
+        Returns:
+            [list]: list of (seq, time, gatewayID, infoDict), empty list if timeout.
+        """
+        if self.overflow:
+            # clear the queue then read the backlog from the database.
+            self.overflow = False
+            while not self.queue.empty(): self.queue.get_nowait()
+            batch = dbSchema.fetchStates(self.dbPool.getConnection(), self.cursor, limit=FETCH_LIMIT)
+            if len(batch) == FETCH_LIMIT: self.overflow = True # more backlog to read.
+            if batch:
+                self.cursor = batch[-1][0]
+                return batch
+        try:
+            batch = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return []
+        batch = [data for data in batch if data[0] > self.cursor]
+        if batch: self.cursor = batch[-1][0]
+        return batch
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class StateWatcher(threading.Thread):
+    """ Database watcher thread which fans out the new state records."""
+    def __init__(self, dbPath, interval=WATCH_INTV):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dbPool = dbConnPool.getPool(dbPath)
+        self.interval = interval
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.latestSeq = None       # seq of the latest record pushed to subscribers.
+        self.terminate = False
+        self.stopEvent = threading.Event()
+
+#-----------------------------------------------------------------------------
+    def subscribe(self, sinceSeq=0, queueSize=SUB_QUEUE_SIZE):
+        """ Add a subscriber which receives the records after <sinceSeq>."""
+        sub = StateSubscriber(self.dbPool, sinceSeq=sinceSeq, queueSize=queueSize)
+        with self.lock:
+            self.subscribers.add(sub)
+        return sub
+
+#-----------------------------------------------------------------------------
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+
+#-----------------------------------------------------------------------------
+    def checkOnce(self, conn):
+        """ Fetch the new records after <latestSeq> and push them to the subscribers.
+            Returns: number of records pushed.
+        """
+        batch = dbSchema.fetchStates(conn, self.latestSeq, limit=FETCH_LIMIT)
+        if not batch: return 0
+        self.latestSeq = batch[-1][0]
+        with self.lock:
+            subs = list(self.subscribers)
+        for sub in subs: sub.put(batch)
+        return len(batch)
+
+#-----------------------------------------------------------------------------
+    def run(self):
+        """ Thread run() function call by start(). """
+        conn = self.dbPool.getConnection()
+        if self.latestSeq is None:
+            self.latestSeq = conn.execute('SELECT IFNULL(MAX(seq), 0) FROM gatewayState').fetchone()[0]
+        dataVersion = None
+        while not self.terminate:
+            try:
+                crtVersion = conn.execute('PRAGMA data_version').fetchone()[0]
+                if crtVersion != dataVersion:
+                    dataVersion = crtVersion
+                    # keep reading if there is more than one fetch limit records.
+                    while self.checkOnce(conn) == FETCH_LIMIT: pass
+            except Error as err:
+                Log.error("StateWatcher: check database error: %s", str(err))
+            self.stopEvent.wait(self.interval)
+        self.dbPool.closeConnection()
+
+#-----------------------------------------------------------------------------
+    def stop(self):
+        """ Stop the thread."""
+        self.terminate = True
+        self.stopEvent.set()
@@ -64,4 +64,50 @@ function animateSymbol(line, isReport) {
         icons[0].offset = (count / 2) + '%';
         line.set('icons', icons);
     }, 20);
-}
\ No newline at end of file
+}
+
+// Decode the compact binary 'newrequest' message (see wireFormat.py) to the same
+// links/activation objects as the json message. linkPts stores the link number
+// to connection string map, it is updated by the full messages.
+function decodeCompactMsg(msg, linkPts) {
+    var ids = new Int32Array(msg.ids);
+    var act = new Uint8Array(msg.act);
+    var key = new Uint8Array(msg.key);
+    var thr1 = new Float32Array(msg.thr1);
+    var thr2 = new Float32Array(msg.thr2);
+    var nodeIds = new Int32Array(msg.nodeIds);
+    var nodeAct = new Uint8Array(msg.nodeAct);
+    var getBit = function(bits, i) { return (bits[i >> 3] >> (i & 7)) & 1; };
+
+    if (msg.ends) {
+        var ends = new Int32Array(msg.ends);
+        for (var i = 0; i < ids.length; i++) {
+            linkPts[ids[i]] = ends[2 * i] + '-' + ends[2 * i + 1];
+        }
+    }
+
+    var links = {};
+    for (var i = 0; i < ids.length; i++) {
+        links[i] = {
+            'connection': linkPts[ids[i]],
+            'active': getBit(act, i),
+            'keyExchange': Boolean(getBit(key, i)),
+            'throughput1': Math.round(thr1[i] * 100) / 100,
+            'throughput2': Math.round(thr2[i] * 100) / 100
+        };
+    }
+
+    var activation = {};
+    for (var i = 0; i < nodeIds.length; i++) {
+        activation[nodeIds[i]] = getBit(nodeAct, i);
+    }
+    var removed = [];
+    if (msg.removed) {
+        var removedIds = new Int32Array(msg.removed);
+        for (var i = 0; i < removedIds.length; i++) {
+            removed.push(linkPts[removedIds[i]]);
+            delete linkPts[removedIds[i]];
+        }
+    }
+    return {'links': links, 'activation': activation, 'removed': removed};
+}
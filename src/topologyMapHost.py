@@ -16,20 +16,35 @@
 
 # import python built in modules.
 import os
+import sys
 import time
 import json
+import gzip
+import hashlib
+import signal
 import sqlite3
+import argparse
 import threading
-from copy import deepcopy
+import subprocess
 
 # import pip installed modules.
-from flask import Flask, render_template, request
+from flask import Flask, make_response, render_template, request
 # Install flask socketio library: pip3 install flask_socketio
 from flask_socketio import SocketIO
 
 # import project local modules.
 import Log
 import globalVal as gv
+import dbConnPool
+import dbSchema
+import dbRetention
+import wireFormat
+import linkEngine
+import ioExecutor
+import metrics
+import stateCache
+import msgBroker
+from linkRegistry import LinkRegistry
 
 # Set this module execution flags.
 TEST_MODE = True    # Test mode flag - True: test on local computer.
@@ -37,12 +52,46 @@ LOG_FLAG = True     # log information display flag.
 HOST_IP = '127.0.0.1' if TEST_MODE else '0.0.0.0'
 HOST_PORT = 5000
 NODE_INFO_QUERY = "SELECT * FROM gatewayInfo"
+DELTA_MODE = True   # Delta mode flag - True: only emit the changed links and node states.
+FULL_SYNC_INTV = 60 # Interval (sec) to emit the full links/nodes state snapshot under delta mode.
+VECTOR_MODE = True  # Use the NumPy link state engine (if numpy is installed) for the full update.
+WIRE_FORMAT = 'json'    # SocketIO 'newrequest' payload format: 'json' or 'binary' (compact columnar).
+WAKE_CHECK_INTV = 0.1   # Interval (sec) to check whether new state data is committed.
+DEBOUNCE_T = 0.3        # Update after no new data committed for this time (sec).
+DEBOUNCE_MAX = 1.0      # Max time (sec) to hold the update under continuous data burst.
+IO_WORKERS = 2          # Max number of worker threads running the data manager's database reads.
+LINK_MODE = 'observed'  # Gateway link source: 'observed' (comTo pairs + gatewayLink table) or 'mesh' (all gateway pairs).
+ASYNC_LOG = False       # Write the log file in the log queue listener thread instead of the caller thread.
+# (benchmark tickLog, 500 nodes: sync 625ms/async 507ms per tick in one run and async slower in another, the 
+# mutable node/link payloads are still formatted by the caller, so the sync file writer stays the default.)
+LOG_MODULE = 'DataMgr'  # Log module name of the data manager's node/link payload messages.
+DATA_LOG_LEVEL = 'INFO' # Min level of the LOG_MODULE messages, set 'DEBUG' to log the node/link payloads.
+# Multiple process mode: one 'producer' (DataMgr) emits through the message queue to N 'web' workers.
+MESSAGE_QUEUE = msgBroker.BROKER_URL # 'redis://host:6379/0' (pip3 install redis) or the local broker 'unix://...'/'tcp://...'.
+QUEUE_CHANNEL = 'topologyMap'       # message queue channel name.
+WEB_WORKERS = 2         # Number of web workers started by the '--workers' launcher (ports HOST_PORT, HOST_PORT+1, ...).
+PRODUCER_METRICS_PORT = 9102        # /metrics port of the producer process (no flask app).
+SYNC_REQ_FILE = 'fullSync.req'      # File (beside the database) web workers touch to request a full snapshot.
+METRICS_FLAG = True     # Serve the Prometheus metrics at /metrics.
+PROFILE_FLAG = False    # Also serve the POST /metrics/profile profiler toggle route (needs METRICS_FLAG).
+
+# DataMgr hot path metrics, exposed at /metrics.
+gTickTime = metrics.histogram('datamgr_tick_seconds', 'DataMgr.updateLink() tick duration.', labelNames=('type',))
+gStageTime = metrics.histogram('datamgr_stage_seconds', 'DataMgr tick stage duration.', labelNames=('stage',))
+gStageSync, gStageFetch, gStageApply, gStageRefresh, gStageEncode, gStageEmit = (
+    gStageTime.labels(stage) for stage in ('sync', 'fetch', 'apply', 'refresh', 'encode', 'emit'))
+gRowsFetched = metrics.counter('datamgr_state_rows_total', 'State records fetched by DataMgr.updateNodes().')
+gLinksChanged = metrics.counter('datamgr_links_changed_total', 'Links whose state changed in the ticks.')
+gPayloadBytes = metrics.histogram('socketio_payload_bytes', 'SocketIO newrequest payload size (fields sum).',
+                                  labelNames=('format',), buckets=metrics.BYTE_BUCKETS)
+gClients = metrics.gauge('socketio_clients', 'Connected map page SocketIO clients.')
 
 # Initialize the Flask application
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret_key'
 app.config['DEBUG'] = True  
 gv.iSocketIO = SocketIO(app)
+if METRICS_FLAG: metrics.instrumentApp(app, 'topologyMapHost', profileFlg=PROFILE_FLAG)
 
 #----------------------------------------------------------------------------------------------------
 # Server setup function
@@ -54,23 +103,137 @@ def home():
         for idx, data in enumerate(gv.gMapFilter):
             gv.gMapSetting[idx] = 1 if request.form.get(data) != None else 0
         if gv.iDataMgr: gv.iDataMgr.setUpdateRate(gv.gPeriod)
-    return render_template("index.html", 
-                            gateway=gv.iDataMgr.getMarkersJSON(), 
-                            period=gv.gPeriod, 
-                            setting=gv.gMapSetting)
+    page = getPageCache()
+    gzipFlg = request.accept_encodings['gzip'] > 0 # q-value parsed, 'gzip;q=0' refuses gzip.
+    response = make_response(page['gzip'] if gzipFlg else page['body'])
+    response.mimetype = 'text/html'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if gzipFlg: response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(page['etag'] + ('-gz' if gzipFlg else ''))
+    return response.make_conditional(request)
+
+@app.teardown_appcontext
+def closeDbConnection(exc):
+    """ Close the request thread's pooled connection opened by the web worker's marker view."""
+    if gv.iMarkerView: gv.iMarkerView.dbPool.closeConnection()
+
+gPageCache = {'key': None, 'etag': None, 'body': None, 'gzip': None} # rendered index page cache.
+gPageLock = threading.Lock()
+
+def getPageCache():
+    """ Return the rendered index page cache, the page is rendered again only when 
+        the nodes data or the user's map setting changed.
+    """
+    # the web worker has no DataMgr, its markers come from the read only marker view.
+    nodeSrc = gv.iDataMgr or gv.iMarkerView.refresh()
+    key = (nodeSrc.nodesVersion, gv.gPeriod, tuple(gv.gMapSetting))
+    with gPageLock:
+        if gPageCache['key'] != key:
+            body = render_template("index.html", 
+                                   gateway=nodeSrc.getMarkersJSON(), 
+                                   period=gv.gPeriod, 
+                                   setting=gv.gMapSetting).encode('utf-8')
+            gPageCache.update({'key': key,
+                               'etag': hashlib.md5(body).hexdigest(),
+                               'body': body,
+                               'gzip': gzip.compress(body)})
+        return gPageCache
 
 @gv.iSocketIO.on('connect', namespace='/test')
 def test_connect():
     Log.info("SocketIO: Client connected.", printFlag=LOG_FLAG)
+    gClients.inc()
+    # send the full state snapshot in next update so the new client can sync.
+    if gv.iDataMgr: 
+        gv.iDataMgr.requestFullSync()
+    else:
+        requestRemoteFullSync()
 
 @gv.iSocketIO.on('disconnect', namespace='/test')
 def test_disconnect():
     Log.info("SocketIO: Client disconnected.", printFlag=LOG_FLAG)
+    gClients.dec()
+
+#----------------------------------------------------------------------------------------------------
+def initSocketIO(messageQueue=None, producerFlg=False):
+    """ (Re)init the SocketIO server for the multiple process mode.
+        - messageQueue: message queue url shared by the producer and the web workers,
+            None: single process (clients served by the DataMgr process).
+        - producerFlg: write only server of the producer, emits to the queue only.
+    """
+    middleware = getattr(gv.iSocketIO, 'sockio_mw', None)
+    if middleware is not None: app.wsgi_app = middleware.wsgi_app # unwrap the previous server.
+    options = {}
+    if messageQueue:
+        options['message_queue'] = messageQueue
+        if msgBroker.isBrokerUrl(messageQueue):
+            options['client_manager'] = msgBroker.BrokerManager(messageQueue, channel=QUEUE_CHANNEL, 
+                                                                write_only=producerFlg)
+        else:
+            options['channel'] = QUEUE_CHANNEL
+    oldServer = gv.iSocketIO.server
+    gv.iSocketIO.init_app(None if producerFlg else app, **options)
+    # the decorated event handlers were registered to the previous server.
+    for namespace, handlers in oldServer.handlers.items():
+        for event, handler in handlers.items(): gv.iSocketIO.server.on(event, handler, namespace=namespace)
+
+def getSyncReqPath():
+    return os.path.join(os.path.dirname(os.path.abspath(gv.DB_PATH)), SYNC_REQ_FILE)
+
+def requestRemoteFullSync():
+    """ Ask the producer process for a full snapshot (touch the request file)."""
+    try:
+        with open(getSyncReqPath(), 'a'): pass
+        os.utime(getSyncReqPath())
+    except OSError as err:
+        Log.error("SocketIO: full sync request error: %s", str(err))
+
+#----------------------------------------------------------------------------------------------------
+def getMarkerInfo(devID, devName, devGPS):
+    """ Return the node's google map marker dict used by the Map front end."""
+    header = "" if "Hub" in devName else "Gateway[%s] " % str(devID)
+    return {'name': header + devName,
+            'number': devID,
+            'pos': {'lat': devGPS[0], 'lng': devGPS[1]}}
+
+#----------------------------------------------------------------------------------------------------
+#----------------------------------------------------------------------------------------------------
+class MarkerView(object):
+    """ Read only nodes markers view of the web worker process: reload the gatewayInfo
+        markers when the inventory change counter changed (no links/states computing).
+    """
+    def __init__(self, dbPath):
+        self.dbPool = dbConnPool.getPool(dbPath)
+        dbSchema.migrate(self.dbPool.getConnection())
+        self.infoVersion = None     # gatewayInfoVersion counter of the loaded markers.
+        self.nodesVersion = 0       # increased when the markers changed.
+        self.markersJSON = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """ Reload the markers if the inventory changed. Returns self."""
+        with self.lock:
+            conn = self.dbPool.getConnection()
+            version = dbSchema.getInfoVersion(conn)
+            if version != self.infoVersion:
+                data = conn.execute(NODE_INFO_QUERY).fetchall()
+                markersJSON = json.dumps({row[0]: getMarkerInfo(row[0], row[1], (row[3], row[4])) for row in data})
+                self.infoVersion = version
+                if markersJSON != self.markersJSON:
+                    self.markersJSON = markersJSON
+                    self.nodesVersion += 1
+        return self
+
+    def getMarkersJSON(self):
+        return self.markersJSON
 
 #----------------------------------------------------------------------------------------------------
 #----------------------------------------------------------------------------------------------------
 class DevNode(object):
     """ Create the device node object. This class was under editing."""
+    __slots__ = ('devID', 'devName', 'devType', 'devGPS', 'ipAddr', 'comNodeIDs', 'keyExchange',
+                 'rptNodeID', 'activeFlag', 'inThrput', 'outThrput', 'encryptEnable')
+
     def __init__(self, devID=None, devName=None, devType=None, devGPS=None):
         # parameter should be set during init.
         self.devID = devID
@@ -79,8 +242,8 @@ class DevNode(object):
         self.devGPS = devGPS
         # parameters with the default values
         self.ipAddr = "127.0.0.1"   # gateway public IP address.
-        self.comNodeIDs = []        # gateway ID list this node is communicating with.
-        self.keyExchange = []        # gateway ID list this node conducted key exchange with.
+        self.comNodeIDs = set()     # gateway ID set this node is communicating with.
+        self.keyExchange = set()    # gateway ID set this node conducted key exchange with.
         self.rptNodeID = 0          # the hub ID node need to report. None if the node is a hub.     
         self.activeFlag = True      # node activate flag
         self.inThrput = 0           # incoming data through put (Mbps/s)
@@ -93,97 +256,347 @@ class DevNode(object):
 
 #----------------------------------------------------------------------------------------------------
 #----------------------------------------------------------------------------------------------------
-class DataMgr(threading.Thread):
-    """ Map data manager thread running parallel with the main flask web host thread to load data 
-        from data base periodically and generate node makers, com links ..."""
+class NodeStore(object):
+    """ Compact node store keyed by the integer node ID. The nodes are saved in a 
+        dense list, <index> maps the node ID to the node's dense index. It provides
+        the read only dict API (keys/values/items/get/[]) of the old node dict.
+    """
+    __slots__ = ('nodes', 'index')
+
+    def __init__(self):
+        self.nodes = []     # DevNode list under dense index order.
+        self.index = {}     # node ID -> dense index.
+
+#----------------------------------------------------------------------------------------------------
+    def add(self, node):
+        """ Add the node or replace the node with the same ID."""
+        idx = self.index.get(node.devID)
+        if idx is None:
+            self.index[node.devID] = len(self.nodes)
+            self.nodes.append(node)
+        else:
+            self.nodes[idx] = node
+
+#----------------------------------------------------------------------------------------------------
+    def remove(self, nodeID):
+        """ Remove the node, the last node is moved to the removed node's index.
+            Returns the removed node or None.
+        """
+        idx = self.index.pop(nodeID, None)
+        if idx is None: return None
+        node, last = self.nodes[idx], self.nodes.pop()
+        if last is not node:
+            self.nodes[idx] = last
+            self.index[last.devID] = idx
+        return node
+
+#----------------------------------------------------------------------------------------------------
+    def getIndex(self, nodeID):
+        return self.index[nodeID]
+
+    def get(self, nodeID, default=None):
+        idx = self.index.get(nodeID)
+        return default if idx is None else self.nodes[idx]
+
+    def keys(self):
+        return [node.devID for node in self.nodes]
+
+    def values(self):
+        return self.nodes
+
+    def items(self):
+        return [(node.devID, node) for node in self.nodes]
+
+    def clear(self):
+        self.nodes.clear()
+        self.index.clear()
+
+    def __getitem__(self, nodeID):
+        return self.nodes[self.index[nodeID]]
+
+    def __contains__(self, nodeID):
+        return nodeID in self.index
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.nodes)
+
+#----------------------------------------------------------------------------------------------------
+#----------------------------------------------------------------------------------------------------
+class DataMgr(object):
+    """ Map data manager running as a SocketIO background task (cooperative with the flask
+        web host) to load data from data base periodically and generate node makers, com 
+        links ... The blocking database reads run in a bounded worker thread pool."""
     def __init__(self, parent, threadID, name):
-        threading.Thread.__init__(self)
         self.parent = parent
+        self.name = name
         self.hubID = []     # report hub ID list 
-        self.nodeDict = {}  # all nodes dict.
-        self.periodic = 10  # default update every 10 sec
-        self.linkDict = {'no':None, 'pts':None, 'active':None, 'keyExchange': None, 'throughput1':None, 'throughput2': None} 
-        # example: {'no':1, 'pts':'0-1', 'active':True, 'keyExchange': True, 'throughput1':10.21, 'throughput2': 5.52}
-        self.linkList = []  # link list, each element should be a linkDict.
+        self.nodeDict = NodeStore()  # all nodes, keyed by integer node ID.
+        self.periodic = 10  # max refresh interval, default update at least every 10 sec
+        # link table keyed by pts, each link example: 
+        # {'no':1, 'pts':'0-1', 'ids':(0, 1), 'active':True, 'keyExchange': True, 'throughput1':10.21, 'throughput2': 5.52}
+        self.linkReg = LinkRegistry()
+        self.linkEngine = linkEngine.LinkStateEngine(self.linkReg) if VECTOR_MODE and linkEngine.np else None
+        self.lastFullSyncT = 0      # last time the full state snapshot was emitted.
+        self.fullSyncFlg = True     # flag to emit full state snapshot in the next update.
+        self.stateSeq = 0           # latest state cache version (seq) of the loaded states.
+        self.dataVersion = None     # sqlite data_version, changed when other connections commit.
+        self.nodesData = None       # gatewayInfo rows of the last loadNodesData() call.
+        self.nodesVersion = 0       # increased when the loaded nodes set changed.
+        self.markersJSON = None     # getMarkersJSON() cache of the current nodesVersion.
+        self.linkTTL = gv.LINK_TTL  # observed link expire time (sec).
+        self.linkSeen = {}          # observed link pts -> last time the pair was seen in the state records.
+        self.fixedSeen = {}         # report/explicit adjacency link pts -> last time the pair was seen.
+        self.newLinkFlg = False     # new link created since the last emit.
+        self.infoVersion = None     # gatewayInfoVersion counter of the loaded inventory.
+        self.fixedPairs = set()     # explicit adjacency (gatewayLink) pairs of the loaded inventory.
+        self.syncReqPath = None     # web workers' full sync request file (producer mode), None: not used.
+        self.syncReqT = None        # modify time of the last handled full sync request.
         # Init the data base manager
         try:
-            self.dbMgr = sqlite3.connect(gv.DB_PATH, check_same_thread=False)
-            self.nodeCursor = self.dbMgr.cursor() # Cursor can be used to call execute method for SQL queries
+            # each thread (main thread and this data manager thread) reuses its own pooled connection.
+            self.dbPool = dbConnPool.getPool(gv.DB_PATH)
+            dbSchema.migrate(self.dbPool.getConnection())
+            self.stateCache = stateCache.getCache(gv.DB_PATH)
         except sqlite3.Error as Error:
             print("__init__ error: %s" %str(Error))
             exit()
         self.terminate = False
+        self.task = None            # SocketIO background task running run().
+        self.ioExecutor = None      # worker pool of the database reads, None: read in the caller.
+        self.runningFlg = False     # run() loop is running.
         Log.info("DataMgr: Data manager thread inited.", printFlag=LOG_FLAG)
 
+#------------------------------------------------------------------------------------
+    def _callIO(self, func, *args):
+        """ Run the blocking database read function in the worker pool."""
+        return self.ioExecutor.call(func, *args) if self.ioExecutor else func(*args)
+
 #------------------------------------------------------------------------------------
     def _buildComLink(self):
         """ build the communication link list based on the node's <DevNode.comNodeIDs>."""
+        linkNum = len(self.linkReg)
         for node in self.nodeDict.values():
             if node.devID in self.hubID: continue # jump over the control hub.
             # build the gateway->hub report link:
-            rptlink = deepcopy(self.linkDict)
-            rptlink['no'] = len(self.linkList)
-            rptlink['pts'] = '-'.join((str(node.rptNodeID), str(node.devID)))
-            rptlink['active'] = node.activeFlag
-            if not self._checkLinkExist(rptlink['pts']): self.linkList.append(rptlink)
-            # build the gateway<->gateway communication links:
+            if node.rptNodeID in self.nodeDict:
+                link, newFlg = self.linkReg.addLink(node.rptNodeID, node.devID, active=node.activeFlag)
+                if newFlg: Log.debug("DataMgr: created link: %s", link, printFlag=LOG_FLAG, module=LOG_MODULE)
+            # build the gateway<->gateway communication links, the registry makes sure 
+            # the pts format follow 'pts': <smaller_id>-<bigger_id> 
             for pairID in node.comNodeIDs:
-                comlink = deepcopy(self.linkDict)
-                comlink['no'] = len(self.linkList)
-                pair = [node.devID, pairID]
-                pair.sort() # make sure the pts format follow 'pts': <smaller_id>-<bigger_id> 
-                comlink['pts'] = '-'.join([str(i) for i in pair])
-                comlink['active'] = node.activeFlag
-                if not self._checkLinkExist(comlink['pts']): self.linkList.append(comlink)
-        
-        # print all the build link
-        _ = [Log.info("DataMgr: created link: %s", str(link), printFlag=LOG_FLAG) for link in self.linkList]
+                link, newFlg = self.linkReg.addLink(node.devID, pairID, active=node.activeFlag)
+                if newFlg: Log.debug("DataMgr: created link: %s", link, printFlag=LOG_FLAG, module=LOG_MODULE)
+        Log.info("DataMgr: created %s links.", len(self.linkReg) - linkNum, printFlag=LOG_FLAG)
+
+#----------------------------------------------------------------------------------------------------
+    def _createNode(self, nodeData, gwIDlist=()):
+        """ Create the DevNode from the gatewayInfo row and add it in the node dict.
+            - gwIDlist: node IDs the gateway communicates with under 'mesh' mode.
+        """
+        currList = list(nodeData)
+        nodeID = currList[0]
+        node = DevNode(devID=nodeID,
+                       devName=currList[1],
+                       devType=currList[7],
+                       devGPS=(currList[3], currList[4]))
+        # Set the node parameters:
+        node.ipAddr = currList[2]
+        if currList[7] == 'HB': 
+            if nodeID not in self.hubID: self.hubID.append(nodeID)
+            node.comNodeIDs = {nodeID}
+        elif currList[7] == 'GW':
+            # under 'observed' mode the gateway pairs are added by the adjacency 
+            # table and the state records' comTo list.
+            node.comNodeIDs = set(gwIDlist)
+            node.comNodeIDs.discard(nodeID)
+        node.rptNodeID = currList[6]
+        node.activeFlag = currList[5]
+        # Append the node it node dict.
+        self.nodeDict.add(node)
+        return node
 
 #----------------------------------------------------------------------------------------------------
     def loadNodesData(self):
         """ Load gateways and control hub google map markers data from the database."""
         # node data example : [5,Control Hub 2, 10.0.0.5, 1.3525, 103.9447, 0, 5, HB]
-        self.nodeCursor.execute(NODE_INFO_QUERY)
-        data = self.nodeCursor.fetchall()
-        Log.info("DataMgr : all nodes information: %s", str(data), printFlag=LOG_FLAG)
-        gwIDlist = [i[0] for i in data] 
-        for nodeData in data:
-            currList = list(nodeData)
-            nodeID = currList[0]
-            node = DevNode(devID=nodeID,
-                           devName=currList[1],
-                           devType=currList[7],
-                           devGPS=(currList[3], currList[4]))
-            # Set the node parameters:
-            node.ipAddr = currList[2]
-            node.comNodeIDs = []
-            if currList[7] == 'HB': 
-                self.hubID.append(nodeID)
-                node.comNodeIDs = [nodeID]  
-            elif currList[7] == 'GW':
-                node.comNodeIDs = deepcopy(gwIDlist)
-                node.comNodeIDs.remove(nodeID)
-            node.rptNodeID = currList[6]
-            node.activeFlag = currList[5]
-            # Append the node it node dict.
-            self.nodeDict[str(nodeID)] = node
+        conn = self.dbPool.getConnection()
+        self.infoVersion = dbSchema.getInfoVersion(conn) # read before the rows, a later change is synced.
+        data = self.dbPool.fetchall(NODE_INFO_QUERY)
+        Log.debug("DataMgr : all nodes information: %s", data, printFlag=LOG_FLAG, module=LOG_MODULE)
+        if data != self.nodesData:
+            self.nodesData = data
+            self.nodesVersion += 1
+            self.markersJSON = None
+        gwIDlist = [i[0] for i in data] if LINK_MODE == 'mesh' else []
+        for nodeData in data: self._createNode(nodeData, gwIDlist=gwIDlist)
+        if LINK_MODE != 'mesh':
+            # explicit adjacency pairs, the links never expire.
+            self.fixedPairs = set(dbSchema.fetchLinkPairs(conn))
+            for id1, id2 in self.fixedPairs: self._addComPair(id1, id2)
+            # keep the observed pairs which are not expired.
+            for pts in self.linkSeen: self._addComPair(*self.linkReg.getLink(pts)['ids'])
         # Buid the communication link based on the node com-pair relationship.
         self._buildComLink()
 
+#------------------------------------------------------------------------------------
+    def _addComPair(self, id1, id2):
+        """ Add the communication pair to both nodes' <DevNode.comNodeIDs>. Returns
+            False if the pair is invalid (same node or unknown node ID).
+        """
+        if id1 == id2 or id1 not in self.nodeDict or id2 not in self.nodeDict: return False
+        self.nodeDict[id1].comNodeIDs.add(id2)
+        self.nodeDict[id2].comNodeIDs.add(id1)
+        return True
+
+#------------------------------------------------------------------------------------
+    def _removeNode(self, nodeID):
+        """ Remove the node and all the links touching it. Returns: the removed links."""
+        self.nodeDict.remove(nodeID)
+        if nodeID in self.hubID: self.hubID.remove(nodeID)
+        removedLinks = self.linkReg.getNodeLinks([nodeID])
+        for link in removedLinks:
+            self.linkReg.removeLink(link['pts'])
+            self.linkSeen.pop(link['pts'], None)
+            self.fixedSeen.pop(link['pts'], None)
+            for endID in link['ids']:
+                peer = self.nodeDict.get(endID)
+                if peer is not None and peer.devType == 'GW': peer.comNodeIDs.discard(nodeID)
+        return removedLinks
+
+#------------------------------------------------------------------------------------
+    def syncNodes(self):
+        """ Check the inventory change counter and apply the gatewayInfo/gatewayLink 
+            changes (node add, remove, move, edit) to the node dict and the link
+            registry incrementally, then emit the 'topology' diff event to the map
+            page. Returns True if the inventory changed.
+        """
+        inventory = self._callIO(self._readInventory)
+        if inventory is None: return False
+        self.infoVersion, data, fixedPairs = inventory
+        if data == self.nodesData and fixedPairs == self.fixedPairs: return False
+        oldRows = {row[0]: row for row in self.nodesData or ()}
+        newRows = {row[0]: row for row in data}
+        changedIDs = [nodeID for nodeID, row in newRows.items() if oldRows.get(nodeID) != row]
+        removedIDs = [nodeID for nodeID in oldRows if nodeID not in newRows]
+        removedLinks = []
+        for nodeID in removedIDs: removedLinks += self._removeNode(nodeID)
+        for nodeID in changedIDs:
+            row, node = newRows[nodeID], self.nodeDict.get(nodeID)
+            if node is not None and (node.devType, node.rptNodeID) == (row[7], row[6]):
+                # name, ip address or position changed, update in place.
+                node.devName, node.ipAddr, node.devGPS = row[1], row[2], (row[3], row[4])
+                continue
+            # new node or node type/report hub changed: rebuild the node and its links.
+            if node is not None: removedLinks += self._removeNode(nodeID)
+            gwIDlist = newRows.keys() if LINK_MODE == 'mesh' else ()
+            self._createNode(row, gwIDlist=gwIDlist)
+            if LINK_MODE == 'mesh' and row[7] == 'GW':
+                for peer in self.nodeDict.values():
+                    if peer.devType == 'GW': self._addComPair(nodeID, peer.devID)
+        # explicit adjacency pairs removed: only drop the fixed flag, the link becomes an
+        # observed link and expires by the link TTL (_expireLinks) if it is not seen.
+        for id1, id2 in self.fixedPairs - fixedPairs:
+            link = self.linkReg.getLink(self.linkReg.getKey(id1, id2))
+            if link is None or link['pts'] in self.linkSeen or self._isReportLink(link): continue
+            self.linkSeen[link['pts']] = self.fixedSeen.pop(link['pts'], 0)
+        for id1, id2 in fixedPairs:
+            self._addComPair(id1, id2)
+            pts = self.linkReg.getKey(id1, id2)
+            seenT = self.linkSeen.pop(pts, None) # fixed link never expires.
+            if seenT is not None: self.fixedSeen[pts] = max(seenT, self.fixedSeen.get(pts, 0))
+        for pts in self.linkSeen: self._addComPair(*self.linkReg.getLink(pts)['ids'])
+        self.fixedPairs = fixedPairs
+        self._buildComLink()
+        self.nodesData = data
+        self.nodesVersion += 1
+        self.markersJSON = None
+        markers = json.loads(self.getMarkersJSON())
+        diff = {'nodes': {nodeID: markers[str(nodeID)] for nodeID in changedIDs},
+                'removed': removedIDs,
+                'removedLinks': [link['pts'] for link in removedLinks]}
+        Log.info("DataMgr: inventory changed: %s nodes added/changed, %s removed.", len(changedIDs), 
+                 len(removedIDs), printFlag=LOG_FLAG)
+        gv.iSocketIO.emit('topology', diff, namespace='/test')
+        # the link states are sent by the next full snapshot.
+        self.requestFullSync()
+        return True
+
+#------------------------------------------------------------------------------------
+    def _readInventory(self):
+        """ Read the inventory (change counter, gatewayInfo rows, explicit adjacency 
+            pairs), returns None if the change counter is not changed.
+        """
+        conn = self.dbPool.getConnection()
+        version = dbSchema.getInfoVersion(conn)
+        if version == self.infoVersion: return None
+        data = conn.execute(NODE_INFO_QUERY).fetchall()
+        fixedPairs = set(dbSchema.fetchLinkPairs(conn)) if LINK_MODE != 'mesh' else set()
+        return (version, data, fixedPairs)
+
+#------------------------------------------------------------------------------------
+    def _isReportLink(self, link):
+        """ Check whether the link is a gateway->hub report link."""
+        for nodeID in link['ids']:
+            node = self.nodeDict.get(nodeID)
+            if node is not None and node.devType == 'GW' and \
+                    self.linkReg.getKey(node.rptNodeID, nodeID) == link['pts']: return True
+        return False
+
+#------------------------------------------------------------------------------------
+    def _observeLink(self, id1, id2, seenT):
+        """ Record the communication pair seen in a state record at <seenT>, create 
+            the link if the pair has no link yet. 
+        """
+        pts = self.linkReg.getKey(id1, id2)
+        if pts in self.linkSeen:
+            if seenT > self.linkSeen[pts]: self.linkSeen[pts] = seenT
+            return
+        if self.linkReg.hasLink(pts):
+            # the report links and explicit adjacency links never expire, keep the last 
+            # seen time for the TTL if the pair is removed from the adjacency table.
+            if seenT > self.fixedSeen.get(pts, 0): self.fixedSeen[pts] = seenT
+            return
+        if not self._addComPair(id1, id2): return
+        link, _ = self.linkReg.addLink(id1, id2, active=self.nodeDict[id1].activeFlag)
+        self.linkSeen[pts] = seenT
+        self.newLinkFlg = True
+        Log.debug("DataMgr: created link: %s", link, printFlag=LOG_FLAG, module=LOG_MODULE)
+
+#------------------------------------------------------------------------------------
+    def _expireLinks(self, crtTime):
+        """ Remove the observed links which are not seen within the link TTL.
+            Returns: list of the removed link dicts.
+        """
+        cutoffT = crtTime - self.linkTTL
+        removedLinks = []
+        for pts in [pts for pts, seenT in self.linkSeen.items() if seenT < cutoffT]:
+            del self.linkSeen[pts]
+            link = self.linkReg.removeLink(pts)
+            id1, id2 = link['ids']
+            self.nodeDict[id1].comNodeIDs.discard(id2)
+            self.nodeDict[id2].comNodeIDs.discard(id1)
+            removedLinks.append(link)
+        if removedLinks:
+            Log.info("DataMgr: %s links expired.", len(removedLinks), printFlag=LOG_FLAG)
+            Log.debug("DataMgr: expired links: %s", removedLinks, printFlag=LOG_FLAG, module=LOG_MODULE)
+        return removedLinks
+
 #------------------------------------------------------------------------------------          
     def _checkLinkExist(self, ptsStr):
         """ Check whether a link is exist. Input: a link pts str (example: '1-2')"""
-        for link in self.linkList:
-            if link['pts'] == ptsStr: return True
-        return False
+        return self.linkReg.hasLink(ptsStr)
 
 #------------------------------------------------------------------------------------
-    def getCommJSON(self):
+    def getCommJSON(self, links=None):
         """ Convert the communication link data list to Json string which will
             be used by the Map front end javascript.
+            - links: link list to convert, convert all the links if None.
         """
         result = {}
-        for idx, data in enumerate(self.linkList):
+        for idx, data in enumerate(self.linkReg if links is None else links):
             result[idx] = {
                 'connection': data['pts'],
                 'active': data['active'],
@@ -196,84 +609,224 @@ class DataMgr(threading.Thread):
 #-----------------------------------------------------------------------------------
     def getMarkersJSON(self):
         """ Get the Nodes' markers JSON string which will be used by the Map front
-            end javascript.
+            end javascript. The result is cached until the nodes set changed.
         """
+        if self.markersJSON is not None: return self.markersJSON
         result = {}
         # Filter the data to get name and coordinates
         for node in self.nodeDict.values():
-            header = "" if "Hub" in node.devName else "Gateway[%s] " % str(
-                node.devID)
-            result[node.devID] = {
-                'name': header + node.devName,
-                'number': node.devID,
-                'pos': {'lat': node.devGPS[0], 'lng': node.devGPS[1]}
-            }
-        return json.dumps(result)
+            result[node.devID] = getMarkerInfo(node.devID, node.devName, node.devGPS)
+        self.markersJSON = json.dumps(result)
+        return self.markersJSON
 
 #------------------------------------------------------------------------------------
-    def getNodeActJSON(self):
+    def getNodeActJSON(self, nodeKeys=None):
         """ Get the nNode activation situation JSON string which will be used by the 
             Map front end java script.
+            - nodeKeys: node key list to convert, convert all the nodes if None.
         """
         result = {}
-        for nodePair in self.nodeDict.items():
-            (idx, node) = nodePair
-            result[idx] = node.activeFlag
+        for idx in (self.nodeDict.keys() if nodeKeys is None else nodeKeys):
+            result[idx] = self.nodeDict[idx].activeFlag
         return json.dumps(result)
 
+#------------------------------------------------------------------------------------
+    def _refreshLink(self, link):
+        """ Re-calculate the link state base on the two end nodes' state.
+            Returns True if the link state changed.
+        """
+        (id1, id2) = link['ids']  # Example: "1-2" = (1, 2)
+        node1, node2 = self.nodeDict[id1], self.nodeDict[id2]
+        # check if node 1 in node 2's keyExchange list and node 2 in node 1's keyExchange list.
+        keyExchange = id1 in node2.keyExchange and id2 in node1.keyExchange
+        # Check whether the link is active or not
+        linkAct = bool(node1.activeFlag and node2.activeFlag)
+        # Connect the server for throughput information else give 0
+        thrput1 = node1.inThrput if linkAct else 0
+        thrput2 = node2.inThrput if linkAct else 0
+        if (link['keyExchange'], link['active'], link['throughput1'], link['throughput2']) == \
+                (keyExchange, linkAct, thrput1, thrput2): return False
+        link['keyExchange'] = keyExchange
+        link['active'] = linkAct
+        link['throughput1'] = thrput1
+        link['throughput2'] = thrput2
+        return True
+
 #------------------------------------------------------------------------------------
     def updateLink(self):
         """ Load the current node state and create the communication link data for 
-            <SocketIO.emit()> to update the map page's link detail.
+            <SocketIO.emit()> to update the map page's link detail. Under delta mode 
+            only the links touching the updated nodes are re-calculated and only the 
+            changed links/nodes are emitted, a full snapshot is emitted every 
+            FULL_SYNC_INTV seconds.
+        """
+        tickStartT = startT = time.perf_counter()
+        self.syncNodes()
+        gStageSync.observe(time.perf_counter() - startT)
+        touchedKeys, actChangedKeys = self.updateNodes()
+        crtTime = time.time()
+        removedLinks = self._expireLinks(crtTime)
+        fullFlg = not DELTA_MODE or self.fullSyncFlg or crtTime - self.lastFullSyncT >= FULL_SYNC_INTV
+        if fullFlg:
+            # Go through link list to update the link active flag base on Node activate states.
+            startT = time.perf_counter()
+            if self.linkEngine:
+                gLinksChanged.inc(len(self.linkEngine.compute(self.nodeDict)))
+            else:
+                gLinksChanged.inc(sum(1 for link in self.linkReg if self._refreshLink(link)))
+            gStageRefresh.observe(time.perf_counter() - startT)
+            Log.debug("link list: %s", self.linkReg, printFlag=LOG_FLAG, module=LOG_MODULE)
+            self.fullSyncFlg = False
+            self.lastFullSyncT = crtTime
+            # Update the web page link
+            self._emitState(None, None, True)
+            gTickTime.labels('full').observe(time.perf_counter() - tickStartT)
+            return
+        # Only re-calculate the links connected to the nodes updated in this tick.
+        startT = time.perf_counter()
+        changedLinks = [link for link in self.linkReg.getNodeLinks(touchedKeys) if self._refreshLink(link)]
+        gStageRefresh.observe(time.perf_counter() - startT)
+        gLinksChanged.inc(len(changedLinks))
+        # the engine's previous state is stale after the links are changed here.
+        if changedLinks and self.linkEngine: self.linkEngine.reset()
+        if changedLinks or actChangedKeys or removedLinks:
+            Log.debug("changed link list: %s", changedLinks, printFlag=LOG_FLAG, module=LOG_MODULE)
+            self._emitState(changedLinks, actChangedKeys, False, removedLinks=removedLinks)
+        gTickTime.labels('delta').observe(time.perf_counter() - tickStartT)
+
+#------------------------------------------------------------------------------------
+    def _emitState(self, links, nodeKeys, fullFlg, removedLinks=()):
+        """ Emit the links and nodes state to the map page under WIRE_FORMAT.
+            - links: link list to emit, all the links if None.
+            - nodeKeys: node key list to emit, all the nodes if None.
+            - removedLinks: expired link list the page need to remove (delta message),
+                a full message removes all the links not in the message.
         """
-        self.updateNodes()
-        # Go through link list to update the link active flag base on Node activate states.
-        for i in range(len(self.linkList)):
-            linkAct = True  # Check whether the link is active or not
-            self.linkList[i]['keyExchange'] = False # Check whether the nodes have done key exchange
-            commList = self.linkList[i]['pts'].split('-') # Example: "1-2" = ["1", "2"]
-            # check if node 1 in node 2's keyExchange list and node 2 in node 1's keyExchange list.
-            if int(commList[0]) in self.nodeDict[str(commList[1])].keyExchange and int(commList[1]) in self.nodeDict[str(commList[0])].keyExchange:
-                self.linkList[i]['keyExchange'] = True # Set key exchange to true if both node contains comTo
-            #self.linkList[i]['keyExchange'] = linkKey
-
-            for idx in [int(i) for i in commList]:
-                linkAct = linkAct and self.nodeDict[str(idx)].activeFlag
-            self.linkList[i]['active'] = linkAct
-
-            # Connect the server for throughput information else give 0
-            self.linkList[i]['throughput1'] = self.nodeDict[str(commList[0])].inThrput if linkAct else 0
-            self.linkList[i]['throughput2'] = self.nodeDict[str(commList[1])].inThrput if linkAct else 0
-
-        Log.info("link list: %s" %str(self.linkList))
-        # Update the web page link
-        gv.iSocketIO.emit('newrequest', {'comm': self.getCommJSON(),
-                                         'activation_circles': self.getNodeActJSON()}, namespace='/test')
+        startT = time.perf_counter()
+        if WIRE_FORMAT == 'binary':
+            links = self.linkReg.getLinks() if links is None else links
+            nodeKeys = self.nodeDict.keys() if nodeKeys is None else nodeKeys
+            msg = wireFormat.encodeState(links, [(key, self.nodeDict[key].activeFlag) for key in nodeKeys], fullFlg,
+                                         endsFlg=self.newLinkFlg, removedIDs=[link['no'] for link in removedLinks])
+        else:
+            msg = {'comm': self.getCommJSON(links=links),
+                   'activation_circles': self.getNodeActJSON(nodeKeys=nodeKeys),
+                   'removed': [link['pts'] for link in removedLinks],
+                   'full': fullFlg}
+        self.newLinkFlg = False
+        emitT = time.perf_counter()
+        gStageEncode.observe(emitT - startT)
+        gPayloadBytes.labels(WIRE_FORMAT).observe(sum(len(val) for val in msg.values() if isinstance(val, (str, bytes)))
+                                                  + sum(len(pts) for pts in msg.get('removed', ()) if isinstance(pts, str)))
+        gv.iSocketIO.emit('newrequest', msg, namespace='/test')
+        gStageEmit.observe(time.perf_counter() - emitT)
 
 #------------------------------------------------------------------------------------
     def updateNodes(self):
-        """ Connet to the QSG-manager host to load the latest Node update information."""
-        self.nodeCursor.execute("SELECT * FROM gatewayState WHERE time > {}".format(gv.gLatestTime))
-        data = self.nodeCursor.fetchall()
-        if len(data) > 0: gv.gLatestTime = data[-1][0]
-        #changeList = [] # e.g. [{'no': [1], 'updateInfo': {'id1': {'comTo': [], 'throughputIn': 0, 'throughputOut': 0, 'actF': 0}}}]
-        Log.info("DataMgr: Node update data : %s", str(data), printFlag=LOG_FLAG)
+        """ Connet to the QSG-manager host to load the latest Node update information.
+            Returns: (set of updated node IDs, set of node IDs whose active flag changed).
+        """
+        # state data example: [(seq, time, id, {'comTo': [], 'throughputIn': 0, 'throughputOut': 0, 'actF': 0}), ...]
+        startT = time.perf_counter()
+        # latest state of the gateways changed since the last tick (one record per gateway).
+        self.stateSeq, data = self._callIO(self.stateCache.getChanges, self.stateSeq)
+        applyT = time.perf_counter()
+        gStageFetch.observe(applyT - startT)
+        gRowsFetched.inc(len(data))
+        Log.debug("DataMgr: Node update data : %s", data, printFlag=LOG_FLAG, module=LOG_MODULE)
+        touchedKeys, actChangedKeys = set(), set()
+        observeFlg = LINK_MODE != 'mesh'
+        cutoffT = time.time() - self.linkTTL
         for state in data:
-            key, val = str(state[1]), json.loads(state[2])
-            self.nodeDict[key].keyExchange = val['comTo']
-            self.nodeDict[key].inThrput = val['throughputIn']
-            self.nodeDict[key].outThrput = val['throughputOut']
-            self.nodeDict[key].activeFlag = val['actF']
+            key, val = state[2], state[3]
+            node = self.nodeDict.get(key)
+            if node is None: continue # node not in (or removed from) the inventory.
+            node.keyExchange = set(val['comTo'])
+            if observeFlg and state[1] >= cutoffT:
+                for pairID in node.keyExchange: self._observeLink(key, pairID, state[1])
+            node.inThrput = val['throughputIn']
+            node.outThrput = val['throughputOut']
+            if node.activeFlag != val['actF']: actChangedKeys.add(key)
+            node.activeFlag = val['actF']
+            touchedKeys.add(key)
+        gStageApply.observe(time.perf_counter() - applyT)
+        return (touchedKeys, actChangedKeys)
+
+#-----------------------------------------------------------------------------------
+    def requestFullSync(self):
+        """ Emit the full links and nodes state snapshot in the next update."""
+        self.fullSyncFlg = True
+
+#-----------------------------------------------------------------------------------
+    def start(self):
+        """ Start the run() loop as a SocketIO background task."""
+        self.terminate = False
+        self.runningFlg = True
+        self.ioExecutor = ioExecutor.IOExecutor(gv.iSocketIO, size=IO_WORKERS)
+        self.task = gv.iSocketIO.start_background_task(self.run)
 
 #-----------------------------------------------------------------------------------
     def run(self):
-        """ Thread run() function call by start(). """
+        """ Background task function call by start(). """
         Log.info("gv.iDataMgr: run() function loop start, terminate flag [%s]", str(
             self.terminate), printFlag=LOG_FLAG)
-        time.sleep(1)  # sleep 1 second to wait socketIO start to run.
+        try:
+            gv.iSocketIO.sleep(1)  # sleep 1 second to wait socketIO start to run.
+            self.dataVersion = self._getDataVersion()
+            while not self.terminate:
+                try:
+                    self.updateLink()
+                except sqlite3.Error as err:
+                    Log.error("DataMgr: update error: %s", str(err))
+                self._waitForChange()
+        finally:
+            self.dbPool.closeConnection()
+            self.runningFlg = False
+            Log.info("gv.iDataMgr: run() function loop stopped.", printFlag=LOG_FLAG)
+
+#-----------------------------------------------------------------------------------
+    def _getDataVersion(self):
+        # data_version is per connection, so it is always read by the task's own 
+        # connection (a cheap shared memory read, not sent to the worker pool).
+        return self.dbPool.getConnection().execute('PRAGMA data_version').fetchone()[0]
+
+#-----------------------------------------------------------------------------------
+    def _waitForChange(self):
+        """ Sleep until new data is committed by the ingest side or the max refresh
+            interval <self.periodic> passed. A burst of commits is debounced into 
+            one update: wait until no commit for DEBOUNCE_T sec (max DEBOUNCE_MAX sec).
+            Returns True if woken up by the data change.
+        """
+        startT = time.time()
+        firstChangeT = lastChangeT = None
         while not self.terminate:
-            self.updateLink()
-            gv.iSocketIO.sleep(self.periodic)
+            if self._checkSyncRequest(): return True
+            crtT = time.time()
+            version = self._getDataVersion()
+            if version != self.dataVersion:
+                self.dataVersion = version
+                lastChangeT = crtT
+                if firstChangeT is None: firstChangeT = crtT
+            if firstChangeT is not None and (crtT - lastChangeT >= DEBOUNCE_T or crtT - firstChangeT >= DEBOUNCE_MAX):
+                return True
+            if crtT - startT >= self.periodic: return False
+            gv.iSocketIO.sleep(WAKE_CHECK_INTV)
+        return False
+
+#-----------------------------------------------------------------------------------
+    def _checkSyncRequest(self):
+        """ Check the web workers' full sync request file (a new client connected to 
+            a web worker), returns True if a new full snapshot is requested.
+        """
+        if self.syncReqPath is None: return False
+        try:
+            reqT = os.stat(self.syncReqPath).st_mtime_ns
+        except OSError:
+            return False
+        if reqT == self.syncReqT: return False
+        self.syncReqT = reqT
+        self.requestFullSync()
+        return True
 
 #-----------------------------------------------------------------------------------
     def setUpdateRate(self, periodic):        
@@ -281,15 +834,31 @@ class DataMgr(threading.Thread):
         Log.info("gv.iDataMgr: Set update periodic to %s", str(self.periodic), printFlag=LOG_FLAG)
 
 #----------------------------------------------------------------------------------------------------
-    def stop(self):
-        """ Stop the thread."""
+    def stop(self, timeout=5):
+        """ Stop the run() loop, wait for it to exit (max <timeout> sec), then release
+            the worker pool (the workers' database connections are closed by the
+            pool's closeAll() when the host exits).
+        """
         self.terminate = True
+        self.join(timeout=timeout)
+        if self.ioExecutor is not None:
+            self.ioExecutor.shutdown()
+            self.ioExecutor = None
+
+#----------------------------------------------------------------------------------------------------
+    def join(self, timeout=None):
+        """ Wait (cooperatively) until the run() loop exits. Returns True if exited."""
+        startT = time.time()
+        while self.runningFlg:
+            if timeout is not None and time.time() - startT >= timeout: return False
+            gv.iSocketIO.sleep(WAKE_CHECK_INTV)
+        return True
 
 
 #----------------------------------------------------------------------------------------------------
 #----------------------------------------------------------------------------------------------------
-def main():
-    # Init the logger: 
+def initLogger(filePrefix):
+    """ Init the logger, each process of the multiple process mode uses its own log file."""
     TOPDIR = 'src'                      # folder name where we put Logs, Maps, etc
     gWD = os.getcwd()
     idx = gWD.find(TOPDIR)
@@ -298,14 +867,119 @@ def main():
     else:
         gTopDir = gWD   # did not find TOPDIR - use WD
     print('gTopDir:%s' % gTopDir)
-    Log.initLogger(gTopDir, 'Logs', gv.APP_NAME, gv.APP_NAME,
+    Log.initLogger(gTopDir, 'Logs', gv.APP_NAME, filePrefix,
             historyCnt=100, 
-            fPutLogsUnderDate=True)
+            fPutLogsUnderDate=True,
+            asyncFlg=ASYNC_LOG)
+    Log.setModuleLevel(LOG_MODULE, DATA_LOG_LEVEL)
 
+#----------------------------------------------------------------------------------------------------
+def startDataMgr():
+    """ Start the map data manager and the state history retention manager."""
     gv.iDataMgr = DataMgr(None, 0, "server thread")
     gv.iDataMgr.loadNodesData()
+    metrics.gauge('datamgr_links', 'Links in the DataMgr link registry.').setFunction(lambda: len(gv.iDataMgr.linkReg))
+    metrics.gauge('datamgr_nodes', 'Nodes loaded by DataMgr.').setFunction(lambda: len(gv.iDataMgr.nodeDict))
     gv.iDataMgr.start()
-    gv.iSocketIO.run(app, host=HOST_IP, port=HOST_PORT)
+    # roll up and prune the old state history in background.
+    gv.iRetentionMgr = dbRetention.RetentionMgr(gv.DB_PATH)
+    gv.iRetentionMgr.start()
+
+def stopDataMgr():
+    gv.iDataMgr.stop()
+    gv.iRetentionMgr.stop()
+    gv.iRetentionMgr.join(timeout=5)
+    dbConnPool.getPool(gv.DB_PATH).closeAll()
+
+#----------------------------------------------------------------------------------------------------
+def runProducer(messageQueue):
+    """ Producer process: run the DataMgr computation once and emit the map updates 
+        to all the web workers' clients through the message queue.
+    """
+    initSocketIO(messageQueue, producerFlg=True)
+    startDataMgr()
+    gv.iDataMgr.syncReqPath = getSyncReqPath()
+    gv.iDataMgr._checkSyncRequest() # skip the old request, the first update is a full snapshot.
+    metrics.startHttpServer(PRODUCER_METRICS_PORT)
+    Log.info("Producer: emit to the message queue %s", messageQueue, printFlag=LOG_FLAG)
+    try:
+        while gv.iDataMgr.runningFlg: gv.iSocketIO.sleep(1)
+    except KeyboardInterrupt:
+        Log.info("Producer: stop.", printFlag=LOG_FLAG)
+    finally:
+        stopDataMgr()
+
+#----------------------------------------------------------------------------------------------------
+def runWeb(messageQueue, port):
+    """ Web worker process: serve the map page and the SocketIO clients, the map 
+        updates come from the producer through the message queue.
+    """
+    initSocketIO(messageQueue)
+    gv.iMarkerView = MarkerView(gv.DB_PATH)
+    try:
+        # the worker is started by the launcher or a process supervisor (no tty, no reloader).
+        gv.iSocketIO.run(app, host=HOST_IP, port=port, use_reloader=False, allow_unsafe_werkzeug=True)
+    finally:
+        dbConnPool.getPool(gv.DB_PATH).closeAll()
+
+#----------------------------------------------------------------------------------------------------
+def launchWorkers(workerNum, messageQueue, basePort=HOST_PORT):
+    """ Start the local broker (for a local broker url), the producer and <workerNum> 
+        web workers (ports basePort, basePort+1, ...) as child processes, stop all
+        of them when one exits or on Ctrl-C.
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--mq', messageQueue, '--db', gv.DB_PATH]
+    procs = []
+    try:
+        if msgBroker.isBrokerUrl(messageQueue):
+            procs.append(subprocess.Popen([sys.executable, os.path.abspath(msgBroker.__file__), '--url', messageQueue]))
+            if not msgBroker.waitReady(messageQueue): print("> Message broker %s is not ready." % messageQueue)
+        procs.append(subprocess.Popen(cmd + ['--role', 'producer']))
+        for i in range(workerNum):
+            procs.append(subprocess.Popen(cmd + ['--role', 'web', '--port', str(basePort + i)]))
+        while all(proc.poll() is None for proc in procs): time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in reversed(procs):
+            if proc.poll() is None: proc.terminate()
+        for proc in reversed(procs):
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+#----------------------------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='Gateway topology map host.')
+    parser.add_argument('--role', default='all', choices=('all', 'producer', 'web'),
+                        help="all: single process, producer: DataMgr only, web: map page/SocketIO worker.")
+    parser.add_argument('--workers', type=int, nargs='?', const=WEB_WORKERS, default=0, 
+                        help='start the broker, the producer and this number of web workers.')
+    parser.add_argument('--port', type=int, default=HOST_PORT, help='web port (first web worker port).')
+    parser.add_argument('--mq', default=MESSAGE_QUEUE, help='message queue url of the producer/web roles.')
+    parser.add_argument('--db', default=gv.DB_PATH, help='database file path.')
+    args = parser.parse_args()
+    gv.DB_PATH = args.db
+    # stop (and clean up) on kill/supervisor stop the same as Ctrl-C.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if args.workers > 0:
+        launchWorkers(args.workers, args.mq, basePort=args.port)
+        return
+    if args.role == 'producer':
+        initLogger(gv.APP_NAME + '_producer')
+        runProducer(args.mq)
+        return
+    if args.role == 'web':
+        initLogger('%s_web%s' % (gv.APP_NAME, args.port))
+        runWeb(args.mq, args.port)
+        return
+    initLogger(gv.APP_NAME)
+    startDataMgr()
+    try:
+        gv.iSocketIO.run(app, host=HOST_IP, port=args.port)
+    finally:
+        stopDataMgr()
 
 #----------------------------------------------------------------------------------------------------
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        wireFormat.py [python3]
+#
+# Purpose:     This module encodes the link/node state update into the compact
+#              columnar binary format sent to the map page by SocketIO. Each
+#              column is a binary attachment decoded by the page with JavaScript
+#              typed arrays (see decodeCompactMsg() in static/js/maps.js).
+#
+# Author:      Liu Yuancheng
+#
+# Version:     v_0.2
+# Created:     2021/12/27
+# Copyright:   Singtel Cyber Security Research & Development Laboratory
+# License:
+#-----------------------------------------------------------------------------
+""" Program Design:
+    Message format (all the numbers are little endian):
+    {
+        'fmt':      'bin',
+        'full':     True if the message contains all the links/nodes.
+        'ids':      int32[L]   link number ('no') of each link.
+        'ends':     int32[2L]  link end point node IDs [id1, id2, ...], only in full message
+                               or the message contains new created links.
+        'act':      bitset[L]  link active flag.
+        'key':      bitset[L]  link key exchange flag.
+        'thr1':     float32[L] link end point 1 throughput.
+        'thr2':     float32[L] link end point 2 throughput.
+        'nodeIds':  int32[N]   node IDs.
+        'nodeAct':  bitset[N]  node active flag.
+        'removed':  int32[R]   link number of the expired links.
+    }
+    bitset: bit i is saved in byte[i>>3] at bit (i&7).
+"""
+import sys
+from array import array
+
+#-----------------------------------------------------------------------------
+def _toBytes(arr):
+    """ Convert the array to little endian bytes."""
+    if sys.byteorder != 'little': arr.byteswap()
+    return arr.tobytes()
+
+#-----------------------------------------------------------------------------
+def packBits(flags):
+    """ Pack the list of bool flags into a bitset bytes."""
+    buf = bytearray((len(flags)+7)//8)
+    for i, flag in enumerate(flags):
+        if flag: buf[i >> 3] |= 1 << (i & 7)
+    return bytes(buf)
+
+#-----------------------------------------------------------------------------
+def encodeState(links, nodeStates, fullFlg, endsFlg=False, removedIDs=()):
+    """ Encode the link and node states to the compact binary message.
+    Args:
+        links ([list]): list of the link dict (see linkRegistry.LINK_TEMPLATE).
+        nodeStates ([list]): list of (node ID, active flag) tuple.
+        fullFlg ([bool]): whether the message contains all the links/nodes.
+        endsFlg ([bool], optional): add the link end points. Defaults to False (only for full message).
+        removedIDs ([list], optional): link numbers of the expired links. Defaults to ().
+    Returns:
+        [dict]: the message dict which can be emitted by SocketIO.
+    """
+    msg = {
+        'fmt': 'bin',
+        'full': fullFlg,
+        'ids': _toBytes(array('i', [link['no'] for link in links])),
+        'act': packBits([link['active'] for link in links]),
+        'key': packBits([link['keyExchange'] for link in links]),
+        'thr1': _toBytes(array('f', [link['throughput1'] or 0 for link in links])),
+        'thr2': _toBytes(array('f', [link['throughput2'] or 0 for link in links])),
+        'nodeIds': _toBytes(array('i', [int(nodeID) for nodeID, _ in nodeStates])),
+        'nodeAct': packBits([actF for _, actF in nodeStates]),
+        'removed': _toBytes(array('i', removedIDs))
+    }
+    if fullFlg or endsFlg:
+        msg['ends'] = _toBytes(array('i', [nodeID for link in links for nodeID in link['ids']]))
+    return msg